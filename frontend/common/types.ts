@@ -7,6 +7,10 @@ export type ContextRecord = {
 export type FileInfo = {
     file_name: string;
     node_count: number;
+    bytes: number | null;
+    ingested_at: string | null;
+    hash: string | null;
+    version: number;
 };
 export type Content = {
     app_name: string;
@@ -0,0 +1,142 @@
+"""Sparse (BM25) keyword index over the nodes of the index.
+
+Dense retrieval is poor at exact identifiers - product codes, error strings and
+the like - which keyword matching handles well. The inverted index maps each
+term to the nodes containing it and how often, and is updated as nodes are
+inserted and deleted, so it never has to be rebuilt from scratch."""
+
+from collections import Counter, defaultdict
+import json
+import logging
+import math
+import os
+import re
+import threading
+
+from llama_index.core.schema import MetadataMode
+
+from rag_studio.segment_log import write_json_atomically
+
+logger = logging.getLogger(__name__)
+
+# Words, plus identifiers joined by -, _, . or / (like "ERR-1042" or "v2.3.1")
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+
+
+def tokenize(text):
+    """Lowercased terms - compound identifiers are kept whole as well as split
+    into their parts, so both "err-1042" and "1042" match."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        parts = re.split(r"[-_./]", token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+class BM25Index:
+    def __init__(self, path, k1=1.5, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        # term -> {node_id: term frequency}
+        self._postings = defaultdict(dict)
+        # node_id -> [term, ...] (distinct terms, so removal is cheap)
+        self._node_terms = {}
+        self._node_lengths = {}
+        self._total_length = 0
+        # Inserts happen on upload threads while queries are being served
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "r", encoding="UTF-8") as f:
+            data = json.load(f)
+        for term, posting in data["postings"].items():
+            self._postings[term] = posting
+        self._node_lengths = data["node_lengths"]
+        self._total_length = sum(self._node_lengths.values())
+        node_terms = defaultdict(list)
+        for term, posting in self._postings.items():
+            for node_id in posting:
+                node_terms[node_id].append(term)
+        self._node_terms = dict(node_terms)
+
+    def save(self):
+        with self._lock:
+            write_json_atomically(
+                self.path,
+                {"postings": self._postings, "node_lengths": self._node_lengths},
+            )
+
+    def __len__(self):
+        return len(self._node_lengths)
+
+    def __contains__(self, node_id):
+        return node_id in self._node_lengths
+
+    def add(self, nodes):
+        with self._lock:
+            for node in nodes:
+                self._remove(node.node_id)
+                counts = Counter(
+                    tokenize(node.get_content(metadata_mode=MetadataMode.EMBED))
+                )
+                for term, count in counts.items():
+                    self._postings[term][node.node_id] = count
+                length = sum(counts.values())
+                self._node_terms[node.node_id] = list(counts)
+                self._node_lengths[node.node_id] = length
+                self._total_length += length
+
+    def remove(self, node_ids):
+        with self._lock:
+            for node_id in node_ids:
+                self._remove(node_id)
+
+    def _remove(self, node_id):
+        for term in self._node_terms.pop(node_id, []):
+            posting = self._postings[term]
+            posting.pop(node_id, None)
+            if not posting:
+                del self._postings[term]
+        self._total_length -= self._node_lengths.pop(node_id, 0)
+
+    def sync(self, docstore, node_ids):
+        """Bring the index in line with the given set of live node ids - adding
+        any that are missing (from the docstore) and dropping any that aren't
+        live. Only the missing nodes are read from the docstore."""
+        missing = [node_id for node_id in node_ids if node_id not in self]
+        stale = [node_id for node_id in self._node_lengths if node_id not in node_ids]
+        if missing:
+            logger.info("Adding %d nodes to the BM25 index", len(missing))
+            self.add(docstore.get_nodes(missing))
+        if stale:
+            self.remove(stale)
+        return bool(missing or stale)
+
+    def search(self, query, top_k, node_ids=None):
+        """Returns up to top_k (node_id, score) pairs, best first - only from
+        node_ids, if given."""
+        scores = defaultdict(float)
+        with self._lock:
+            node_count = len(self._node_lengths)
+            if node_count == 0:
+                return []
+            avg_length = self._total_length / node_count
+            for term in set(tokenize(query)):
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                df = len(posting)
+                idf = math.log(1 + (node_count - df + 0.5) / (df + 0.5))
+                for node_id, tf in posting.items():
+                    if node_ids is not None and node_id not in node_ids:
+                        continue
+                    norm = self.k1 * (
+                        1 - self.b + self.b * self._node_lengths[node_id] / avg_length
+                    )
+                    scores[node_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
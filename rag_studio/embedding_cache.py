@@ -0,0 +1,181 @@
+"""On-disk cache of chunk embeddings, so that identical text is only ever
+embedded once per embedding model - across re-uploads, re-chunking and
+switching back to a previously used embedding model."""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, List
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+logger = logging.getLogger(__name__)
+
+# SQLite's default limit on the number of ? parameters in one statement
+MAX_QUERY_PARAMS = 900
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+def to_stored_precision(embedding):
+    """Rounds an embedding as storing it in the cache does, so a text embeds the
+    same whether or not it was already cached."""
+    return np.asarray(embedding, dtype=np.float16).astype(np.float32).tolist()
+
+
+class EmbeddingCache:
+    """SQLite table of key -> float16 vector, evicting the least recently used
+    entries once it holds more than max_entries."""
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def key(model_name, text):
+        content = f"{model_name}\0{normalize_text(text)}"
+        return hashlib.sha256(content.encode("UTF-8")).hexdigest()
+
+    def get_many(self, keys):
+        """Returns a dict of the cached embeddings for whichever keys are present."""
+        found = {}
+        with self._lock:
+            now = time.time_ns()
+            for start in range(0, len(keys), MAX_QUERY_PARAMS):
+                batch = keys[start : start + MAX_QUERY_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float16).astype(
+                        np.float32
+                    )
+                self._conn.execute(
+                    f"UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})",
+                    [now, *batch],
+                )
+            self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return {key: vector.tolist() for key, vector in found.items()}
+
+    def put_many(self, embeddings_by_key):
+        with self._lock:
+            now = time.time_ns()
+            cursor = self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [
+                    (key, np.asarray(embedding, dtype=np.float16).tobytes(), now)
+                    for key, embedding in embeddings_by_key.items()
+                ],
+            )
+            self._count += cursor.rowcount
+            if self._count > self.max_entries:
+                evict_count = self._count - self.max_entries
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (evict_count,),
+                )
+                self._count -= evict_count
+                logger.debug("Evicted %d entries from embedding cache", evict_count)
+            self._conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "entries": self._count,
+            "max_entries": self.max_entries,
+        }
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Wraps an embedding model so that text (i.e. chunk) embeddings are served
+    from the cache where possible. Query embeddings go straight to the model -
+    or, when a query batcher is set, async ones are batched with those of other
+    concurrent requests."""
+
+    _inner: Any = PrivateAttr()
+    _cache: Any = PrivateAttr()
+    _query_batcher: Any = PrivateAttr(default=None)
+
+    def __init__(self, inner: BaseEmbedding, cache: EmbeddingCache, **kwargs):
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            **kwargs,
+        )
+        self._inner = inner
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def cache_stats(self):
+        return self._cache.stats()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._inner.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        if self._query_batcher is not None:
+            return await self._query_batcher.submit(query)
+        return await self._inner.aget_query_embedding(query)
+
+    def set_query_batcher(self, batcher):
+        """batcher is a MicroBatcher over get_query_embedding_batch."""
+        self._query_batcher = batcher
+
+    def get_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        """Embeds several queries in one forward pass where the model allows."""
+        embed = getattr(self._inner, "_embed", None)
+        if embed is None:
+            return [self._inner.get_query_embedding(query) for query in queries]
+        # HuggingFaceEmbedding embeds a query as _embed(query, prompt_name="query"),
+        # which takes a list just as well. _embed is private, and its signature
+        # is as of llama-index-embeddings-huggingface 0.2 (llama-index-core
+        # 0.10) - recheck it when upgrading. Calling it directly also skips
+        # llama_index's embedding callback events for these queries.
+        return [list(embedding) for embedding in embed(queries, prompt_name="query")]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._cache.key(self.model_name, text) for text in texts]
+        embeddings_by_key = self._cache.get_many(keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in embeddings_by_key}
+        if missing:
+            fresh = self._inner.get_text_embedding_batch(list(missing.values()))
+            fresh_by_key = {
+                key: to_stored_precision(embedding)
+                for key, embedding in zip(missing.keys(), fresh)
+            }
+            self._cache.put_many(fresh_by_key)
+            embeddings_by_key.update(fresh_by_key)
+        return [embeddings_by_key[key] for key in keys]
@@ -0,0 +1,107 @@
+"""Persisted record of the files that have been added to the index.
+
+For each file name we keep a hash of the file's content, a version number that
+goes up each time a changed copy of the file is added, the ids of the
+documents (ref docs) that it produced in the docstore, plus its size, node
+count and when it was ingested. It is kept up to date as files are added and
+removed, so listing files never needs to walk the docstore."""
+
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+
+from llama_index.core.schema import MetadataMode
+
+from rag_studio.segment_log import write_json_atomically
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def chunk_hash(node):
+    """Hash of exactly the text that gets embedded for a node."""
+    content = node.get_content(metadata_mode=MetadataMode.EMBED)
+    return hashlib.sha256(content.encode("UTF-8")).hexdigest()
+
+
+class FileManifest:
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="UTF-8") as f:
+                self.files = json.load(f)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def rebuild_from_docstore(self, docstore):
+        """Build entries for an index that was created before the manifest
+        existed. The content hashes aren't known, so the next upload of each of
+        these files will be treated as a change."""
+        for ref_doc_id, doc_info in docstore.get_all_ref_doc_info().items():
+            file_name = doc_info.metadata.get("file_name")
+            entry = self.files.setdefault(
+                file_name,
+                {
+                    "hash": None,
+                    "version": 1,
+                    "ref_doc_ids": [],
+                    "node_count": 0,
+                    "bytes": doc_info.metadata.get("file_size"),
+                    "ingested_at": None,
+                },
+            )
+            entry["ref_doc_ids"].append(ref_doc_id)
+            entry["node_count"] += len(doc_info.node_ids)
+        logger.info("Rebuilt file manifest for %d files from docstore", len(self.files))
+
+    def is_unchanged(self, file_name, file_hash):
+        entry = self.files.get(file_name)
+        return entry is not None and entry["hash"] == file_hash
+
+    def ref_doc_ids(self, file_name):
+        entry = self.files.get(file_name)
+        return list(entry["ref_doc_ids"]) if entry else []
+
+    def record(self, file_name, file_hash, ref_doc_ids, node_count, size_bytes):
+        previous = self.files.get(file_name)
+        self.files[file_name] = {
+            "hash": file_hash,
+            "version": previous["version"] + 1 if previous else 1,
+            "ref_doc_ids": list(ref_doc_ids),
+            "node_count": node_count,
+            "bytes": size_bytes,
+            "ingested_at": datetime.now().isoformat(timespec="seconds"),
+        }
+
+    def remove(self, file_name):
+        return self.files.pop(file_name, None)
+
+    def list_files(self):
+        return [
+            {
+                "file_name": file_name,
+                "node_count": entry["node_count"],
+                "bytes": entry["bytes"],
+                "ingested_at": entry["ingested_at"],
+                "hash": entry["hash"],
+                "version": entry["version"],
+            }
+            for file_name, entry in self.files.items()
+        ]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_json_atomically(self.path, self.files)
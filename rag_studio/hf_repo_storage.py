@@ -37,11 +37,16 @@ def create_repo(repo_name):
     api.create_repo(repo_id=repo_name, private=True, exist_ok=False)
 
 
-def upload_folder(repo_name, model_path, path_in_repo=None):
+def upload_folder(repo_name, model_path, path_in_repo=None, delete_patterns=None):
+    """Remote files matching delete_patterns are deleted in the same commit,
+    unless they were just uploaded."""
     logger.info("Uploading folder %s to repo %s", model_path, repo_name)
     repo_id = api.get_full_repo_name(repo_name)
     api.upload_folder(
-        repo_id=repo_id, folder_path=model_path, path_in_repo=path_in_repo
+        repo_id=repo_id,
+        folder_path=model_path,
+        path_in_repo=path_in_repo,
+        delete_patterns=delete_patterns,
     )
 
 
@@ -0,0 +1,70 @@
+"""Retriever fusing dense (vector) and sparse (BM25) results.
+
+The two result lists are merged with reciprocal rank fusion: each node scores
+sum(1 / (rrf_k + rank)) over the lists it appears in. Fusing by rank avoids
+having to calibrate cosine similarities against BM25 scores."""
+
+from collections import defaultdict
+from typing import List
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+DEFAULT_RRF_K = 60
+
+
+def reciprocal_rank_fusion(ranked_id_lists, rrf_k=DEFAULT_RRF_K):
+    """Returns (node_id, fused score) pairs, best first."""
+    scores = defaultdict(float)
+    for ranked_ids in ranked_id_lists:
+        for rank, node_id in enumerate(ranked_ids):
+            scores[node_id] += 1.0 / (rrf_k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    def __init__(
+        self,
+        vector_retriever,
+        bm25_index,
+        docstore,
+        similarity_top_k,
+        candidate_k,
+        rrf_k=DEFAULT_RRF_K,
+        node_ids=None,
+        **kwargs,
+    ):
+        """vector_retriever should be set up to return candidate_k nodes - the
+        same number are taken from BM25 before fusing down to similarity_top_k.
+        If node_ids is given, BM25 results are restricted to those nodes (and
+        vector_retriever should be restricted likewise)."""
+        self._vector_retriever = vector_retriever
+        self._bm25_index = bm25_index
+        self._docstore = docstore
+        self._similarity_top_k = similarity_top_k
+        self._candidate_k = candidate_k
+        self._rrf_k = rrf_k
+        self._node_ids = None if node_ids is None else set(node_ids)
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        dense = self._vector_retriever.retrieve(query_bundle)
+        sparse = self._bm25_index.search(
+            query_bundle.query_str, self._candidate_k, node_ids=self._node_ids
+        )
+        nodes_by_id = {result.node.node_id: result.node for result in dense}
+        fused = reciprocal_rank_fusion(
+            [
+                [result.node.node_id for result in dense],
+                [node_id for node_id, _ in sparse],
+            ],
+            self._rrf_k,
+        )[: self._similarity_top_k]
+        # Sparse-only hits still need their nodes fetching from the docstore
+        missing = [node_id for node_id, _ in fused if node_id not in nodes_by_id]
+        for node in self._docstore.get_nodes(missing):
+            nodes_by_id[node.node_id] = node
+        return [
+            NodeWithScore(node=nodes_by_id[node_id], score=score)
+            for node_id, score in fused
+        ]
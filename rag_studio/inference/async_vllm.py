@@ -0,0 +1,430 @@
+"""llama_index LLM backed by vLLM's AsyncLLMEngine.
+
+The llama_index Vllm class wraps the offline vllm.LLM, which can only run one
+blocking generate() at a time and can't stream. The async engine instead
+batches whatever requests are in flight (continuous batching) and streams
+outputs as they are generated. It runs on its own event loop thread, so it can
+be called both from sync code (the llama_index engines, on worker threads) and
+from async request handlers on the web server's loop."""
+
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+import logging
+import queue
+import threading
+import uuid
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence
+
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+from llama_index.core.base.llms.generic_utils import (
+    completion_response_to_chat_response,
+    stream_completion_response_to_chat_response,
+)
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stream of outputs passed between threads
+_END = object()
+
+# The LLM fields that become vLLM SamplingParams, and can be set per request
+SAMPLING_FIELDS = (
+    "temperature",
+    "top_p",
+    "presence_penalty",
+    "frequency_penalty",
+    "stop",
+    "max_new_tokens",
+    "n",
+    "best_of",
+)
+
+# Generation calls made through llama_index's chat APIs, and the rest
+CHAT_STAGE = "chat"
+COMPLETE_STAGE = "complete"
+
+_sampling_overrides: ContextVar = ContextVar("sampling_overrides", default=None)
+_generations: ContextVar = ContextVar("generations", default=None)
+
+
+@contextmanager
+def sampling_scope(samples_stage=None, **overrides):
+    """Sampling settings for the generation calls made within this block (and
+    any tasks / threads started from it), leaving the shared LLM untouched, so
+    concurrent requests can each use their own settings.
+
+    If samples_stage is given, n and best_of only apply to calls of that stage
+    - e.g. CHAT_STAGE for the answer from a chat engine, whose condense step is
+    a complete call and only needs one sample."""
+    unknown = set(overrides) - set(SAMPLING_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown sampling settings: {sorted(unknown)}")
+    token = _sampling_overrides.set((overrides, samples_stage))
+    try:
+        yield
+    finally:
+        _sampling_overrides.reset(token)
+
+
+def current_sampling_settings(defaults, stage=COMPLETE_STAGE):
+    """defaults, with the overrides of the active sampling_scope applied."""
+    overrides, samples_stage = _sampling_overrides.get() or ({}, None)
+    settings = {**defaults, **overrides}
+    if samples_stage is not None and stage != samples_stage:
+        settings["n"] = 1
+        settings["best_of"] = None
+    return settings
+
+
+@contextmanager
+def record_generations(generations=None):
+    """Yields a list (generations, if given) that fills with (stage, vLLM
+    RequestOutput) for each generation call finished within the block. Unlike
+    the llama_index responses, these have all n samples of a call, and their
+    token ids."""
+    generations = [] if generations is None else generations
+    token = _generations.set(generations)
+    try:
+        yield generations
+    finally:
+        _generations.reset(token)
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(model_name, download_dir=None):
+    """The model's tokenizer, loaded once - from the files vLLM downloaded."""
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_name, cache_dir=download_dir)
+
+
+class AsyncVllm(CustomLLM):
+    model: str = Field(description="The HuggingFace name of the model")
+    temperature: float = 1.0
+    top_p: float = 1.0
+    presence_penalty: float = 0.0
+    frequency_penalty: float = 0.0
+    stop: Optional[List[str]] = None
+    max_new_tokens: int = 512
+    n: int = 1
+    best_of: Optional[int] = None
+    context_window: int = 4096
+
+    _engine: Any = PrivateAttr()
+    _loop: Any = PrivateAttr()
+    _thread: Any = PrivateAttr()
+    _download_dir: Any = PrivateAttr()
+
+    def __init__(
+        self, model: str, engine_kwargs: Optional[Dict[str, Any]] = None, **kwargs
+    ):
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
+
+        engine_kwargs = engine_kwargs or {}
+        super().__init__(
+            model=model,
+            context_window=engine_kwargs.get("max_model_len", 4096),
+            **kwargs,
+        )
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="vllm-engine-loop", daemon=True
+        )
+        self._thread.start()
+        self._engine = AsyncLLMEngine.from_engine_args(
+            AsyncEngineArgs(model=model, **engine_kwargs)
+        )
+        self._download_dir = engine_kwargs.get("download_dir")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AsyncVllm"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.max_new_tokens,
+            model_name=self.model,
+        )
+
+    def sampling_params(self, stage=COMPLETE_STAGE):
+        """SamplingParams for a generation call - from the LLM's own settings
+        and the active sampling_scope, read when the call is made."""
+        from vllm import SamplingParams
+
+        settings = current_sampling_settings(
+            {name: getattr(self, name) for name in SAMPLING_FIELDS}, stage
+        )
+        return SamplingParams(
+            temperature=settings["temperature"],
+            top_p=settings["top_p"],
+            presence_penalty=settings["presence_penalty"],
+            frequency_penalty=settings["frequency_penalty"],
+            stop=settings["stop"] or None,
+            max_tokens=settings["max_new_tokens"],
+            n=settings["n"],
+            best_of=settings["best_of"],
+        )
+
+    async def _pump_outputs(self, prompt, sampling_params, request_id, put):
+        """Runs on the engine loop, passing each RequestOutput to put and then
+        _END (or the exception that ended the stream)."""
+        try:
+            async for output in self._engine.generate(
+                prompt, sampling_params, request_id
+            ):
+                put(output)
+            put(_END)
+        except BaseException as e:  # pylint: disable=broad-except
+            put(e)
+
+    @property
+    def tokenizer(self):
+        return load_tokenizer(self.model, self._download_dir)
+
+    def _abort(self, request_id):
+        asyncio.run_coroutine_threadsafe(self._engine.abort(request_id), self._loop)
+
+    def generate_outputs(self, prompt, sampling_params) -> Iterator[Any]:
+        """Yields the vLLM RequestOutputs for the prompt as they're produced.
+        Closing the iterator early aborts the request."""
+        request_id = uuid.uuid4().hex
+        outputs = queue.Queue()
+        asyncio.run_coroutine_threadsafe(
+            self._pump_outputs(prompt, sampling_params, request_id, outputs.put),
+            self._loop,
+        )
+        finished = False
+        try:
+            while True:
+                output = outputs.get()
+                if output is _END:
+                    finished = True
+                    return
+                if isinstance(output, BaseException):
+                    finished = True
+                    raise output
+                yield output
+        finally:
+            if not finished:
+                self._abort(request_id)
+
+    async def agenerate_outputs(self, prompt, sampling_params) -> AsyncIterator[Any]:
+        """Async version of generate_outputs, for use on any event loop."""
+        request_id = uuid.uuid4().hex
+        outputs = asyncio.Queue()
+        caller_loop = asyncio.get_running_loop()
+
+        def put(output):
+            caller_loop.call_soon_threadsafe(outputs.put_nowait, output)
+
+        asyncio.run_coroutine_threadsafe(
+            self._pump_outputs(prompt, sampling_params, request_id, put), self._loop
+        )
+        finished = False
+        try:
+            while True:
+                output = await outputs.get()
+                if output is _END:
+                    finished = True
+                    return
+                if isinstance(output, BaseException):
+                    finished = True
+                    raise output
+                yield output
+        finally:
+            if not finished:
+                self._abort(request_id)
+
+    async def _final_outputs(self, prompts, sampling_params, return_exceptions):
+        """Runs on the engine loop. Every prompt is added to the engine before
+        any is awaited, so they're all scheduled together."""
+
+        async def final_output(prompt, request_id):
+            output = None
+            async for output in self._engine.generate(
+                prompt, sampling_params, request_id
+            ):
+                pass
+            return output
+
+        request_ids = [uuid.uuid4().hex for _ in prompts]
+        try:
+            return await asyncio.gather(
+                *(
+                    final_output(prompt, request_id)
+                    for prompt, request_id in zip(prompts, request_ids)
+                ),
+                return_exceptions=return_exceptions,
+            )
+        except BaseException:
+            for request_id in request_ids:
+                await self._engine.abort(request_id)
+            raise
+
+    async def agenerate_batch(
+        self, prompts, stage=COMPLETE_STAGE, return_exceptions=False
+    ):
+        """The final vLLM RequestOutput for each prompt, generated with one
+        submission of all of them to the engine. With return_exceptions, a
+        prompt that fails (say, for being too long) gets its exception in
+        place of an output, rather than failing the whole batch."""
+        sampling_params = self.sampling_params(stage)
+        generations = _generations.get()
+        outputs = await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(
+                self._final_outputs(prompts, sampling_params, return_exceptions),
+                self._loop,
+            )
+        )
+        if generations is not None:
+            generations.extend(
+                (stage, output)
+                for output in outputs
+                if not isinstance(output, BaseException)
+            )
+        return outputs
+
+    @staticmethod
+    def _to_response(output, previous_text=""):
+        # With n > 1 the engines carry on with the first sample - the rest are
+        # in the raw output, and recorded by record_generations
+        text = output.outputs[0].text
+        return CompletionResponse(
+            text=text, delta=text[len(previous_text) :], raw={"output": output}
+        )
+
+    def _complete(self, prompt, stage):
+        generations = _generations.get()
+        final = None
+        for final in self.generate_outputs(prompt, self.sampling_params(stage)):
+            pass
+        if generations is not None:
+            generations.append((stage, final))
+        return self._to_response(final)
+
+    def _stream_complete(self, prompt, stage):
+        # Read the parameters now, not when the caller starts iterating (which
+        # may be in another context)
+        sampling_params = self.sampling_params(stage)
+        generations = _generations.get()
+
+        def gen() -> CompletionResponseGen:
+            text = ""
+            output = None
+            for output in self.generate_outputs(prompt, sampling_params):
+                response = self._to_response(output, text)
+                text = response.text
+                yield response
+            if generations is not None and output is not None:
+                generations.append((stage, output))
+
+        return gen()
+
+    async def _acomplete(self, prompt, stage):
+        generations = _generations.get()
+        final = None
+        async for final in self.agenerate_outputs(
+            prompt, self.sampling_params(stage)
+        ):
+            pass
+        if generations is not None:
+            generations.append((stage, final))
+        return self._to_response(final)
+
+    def _astream_complete(self, prompt, stage):
+        sampling_params = self.sampling_params(stage)
+        generations = _generations.get()
+
+        async def gen() -> CompletionResponseAsyncGen:
+            text = ""
+            output = None
+            async for output in self.agenerate_outputs(prompt, sampling_params):
+                response = self._to_response(output, text)
+                text = response.text
+                yield response
+            if generations is not None and output is not None:
+                generations.append((stage, output))
+
+        return gen()
+
+    @llm_completion_callback()
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        return self._complete(prompt, COMPLETE_STAGE)
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        return self._stream_complete(prompt, COMPLETE_STAGE)
+
+    @llm_completion_callback()
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        return await self._acomplete(prompt, COMPLETE_STAGE)
+
+    @llm_completion_callback()
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        return self._astream_complete(prompt, COMPLETE_STAGE)
+
+    @llm_chat_callback()
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        prompt = self.messages_to_prompt(messages)
+        return completion_response_to_chat_response(
+            self._complete(prompt, CHAT_STAGE)
+        )
+
+    @llm_chat_callback()
+    def stream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseGen:
+        prompt = self.messages_to_prompt(messages)
+        return stream_completion_response_to_chat_response(
+            self._stream_complete(prompt, CHAT_STAGE)
+        )
+
+    @llm_chat_callback()
+    async def achat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponse:
+        prompt = self.messages_to_prompt(messages)
+        return completion_response_to_chat_response(
+            await self._acomplete(prompt, CHAT_STAGE)
+        )
+
+    @llm_chat_callback()
+    async def astream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseAsyncGen:
+        completions = self._astream_complete(
+            self.messages_to_prompt(messages), CHAT_STAGE
+        )
+
+        async def gen() -> ChatResponseAsyncGen:
+            async for completion in completions:
+                yield ChatResponse(
+                    message=ChatMessage(role="assistant", content=completion.text),
+                    delta=completion.delta,
+                    raw=completion.raw,
+                )
+
+        return gen()
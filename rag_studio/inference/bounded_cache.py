@@ -0,0 +1,90 @@
+"""Bookkeeping shared by the inference server's answer caches.
+
+Entries are kept least recently used first, expire after a TTL, are evicted
+beyond max_entries, and are all dropped when the generation passed with a
+lookup or store - the index commit and prompts the answers came from -
+changes. Subclasses decide how a lookup finds its entry, and
+hold self._lock around any use of the helpers here."""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+import threading
+from typing import Any, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    created_at: float
+
+
+class BoundedCache:
+    # Names the cache in log messages
+    name = "cache"
+
+    def __init__(self, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # Least recently used first
+        self._entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+        self._counts = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+
+    def _entries_changed(self):
+        """Called whenever entries are added or removed - for subclasses that
+        keep something derived from them."""
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            if self._entries:
+                logger.info("Index or prompts changed - clearing %s", self.name)
+                self._counts["invalidations"] += 1
+            self._entries.clear()
+            self._entries_changed()
+            self._generation = generation
+
+    def _is_expired(self, entry, now):
+        return now - entry.created_at > self.ttl_seconds
+
+    def _remove_expired(self, keys):
+        for key in keys:
+            del self._entries[key]
+        if keys:
+            self._counts["expirations"] += len(keys)
+            self._entries_changed()
+
+    def _add(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counts["evictions"] += 1
+        self._entries_changed()
+
+    def _hit(self, key):
+        self._counts["hits"] += 1
+        self._entries.move_to_end(key)
+        return self._entries[key].value
+
+    def _miss(self):
+        self._counts["misses"] += 1
+        return None
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counts["hits"] + self._counts["misses"]
+            return {
+                **self._counts,
+                "entries": len(self._entries),
+                "hit_rate": self._counts["hits"] / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,101 @@
+"""Groups work submitted by concurrent requests into batches.
+
+Requests arrive one at a time, but work like embedding a query costs about the
+same for a batch of queries as for one. A MicroBatcher holds each submitted
+item for at most a short window, then runs everything that arrived in that
+window as one batch and hands each caller back its own result."""
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """process_batch is a blocking function from a list of items to a list of
+    results (in the same order); it runs on a worker thread. A batch starts
+    once max_batch_size items are waiting, or window_seconds after the first
+    of them arrived. All submits must come from the same event loop."""
+
+    def __init__(self, process_batch, window_seconds, max_batch_size):
+        self.process_batch = process_batch
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        # (item, future for its result, arrival time)
+        self._pending = []
+        self._flush_handle = None
+        self._running = set()
+        self._batches = 0
+        self._items = 0
+        self._largest_batch = 0
+        self._total_wait_seconds = 0.0
+        self._longest_wait_seconds = 0.0
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future, time.perf_counter()))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window_seconds, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch = self._pending[: self.max_batch_size]
+        self._pending = self._pending[self.max_batch_size :]
+        if self._pending:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.window_seconds, self._flush
+            )
+        if not batch:
+            return
+
+        now = time.perf_counter()
+        waits = [now - arrived for _, _, arrived in batch]
+        self._batches += 1
+        self._items += len(batch)
+        self._largest_batch = max(self._largest_batch, len(batch))
+        self._total_wait_seconds += sum(waits)
+        self._longest_wait_seconds = max(self._longest_wait_seconds, max(waits))
+        logger.debug(
+            "Running batch of %d, longest wait %.1fms", len(batch), 1000 * max(waits)
+        )
+
+        # Keep a reference, so the task isn't garbage collected mid-run
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch):
+        try:
+            results = await asyncio.to_thread(
+                self.process_batch, [item for item, _, _ in batch]
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            for _, future, _ in batch:
+                # Callers that went away have cancelled their future
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self._batches,
+            "items": self._items,
+            "mean_batch_size": self._items / self._batches if self._batches else 0.0,
+            "max_batch_size": self._largest_batch,
+            "mean_wait_ms": (
+                1000 * self._total_wait_seconds / self._items if self._items else 0.0
+            ),
+            "max_wait_ms": 1000 * self._longest_wait_seconds,
+            "window_ms": 1000 * self.window_seconds,
+            "batch_size_limit": self.max_batch_size,
+        }
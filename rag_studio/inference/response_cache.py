@@ -0,0 +1,39 @@
+"""Cache of answers to requests identical to one already answered.
+
+The key is built by the caller from the normalised prompt or conversation,
+the sampling settings and the model, so a hit needs no embedding, retrieval
+or generation at all - which is why it is checked before the semantic cache.
+Keys are hashed as they are, with no similarity search."""
+
+import time
+
+from rag_studio.inference.bounded_cache import BoundedCache, CacheEntry
+
+
+def normalize_text(text):
+    """Whitespace differences don't change the answer."""
+    return " ".join(str(text).split())
+
+
+class ResponseCache(BoundedCache):
+    name = "response cache"
+
+    def __init__(self, ttl_seconds=600, max_entries=10000):
+        super().__init__(ttl_seconds, max_entries)
+
+    def lookup(self, key, generation):
+        """The cached value for key, or None."""
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry, time.monotonic()):
+                self._remove_expired([key])
+                entry = None
+            if entry is None:
+                return self._miss()
+            return self._hit(key)
+
+    def store(self, key, value, generation):
+        with self._lock:
+            self._check_generation(generation)
+            self._add(key, CacheEntry(value, time.monotonic()))
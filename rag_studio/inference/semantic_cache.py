@@ -0,0 +1,83 @@
+"""In-memory cache of answers, looked up by the meaning of the question.
+
+A question whose embedding is within the similarity threshold of one already
+answered (in the same scope - the same conversation so far and sampling
+settings) gets the earlier answer back, skipping retrieval and generation.
+Lookups compare the question against every live entry at once, with one
+product against the stacked entry vectors."""
+
+from dataclasses import dataclass
+import itertools
+import time
+from typing import Any, Hashable
+
+import numpy as np
+
+from rag_studio.inference.bounded_cache import BoundedCache, CacheEntry
+
+
+@dataclass
+class SemanticCacheEntry(CacheEntry):
+    scope: Hashable
+    vector: Any
+
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticCache(BoundedCache):
+    name = "semantic cache"
+
+    def __init__(self, similarity_threshold=0.95, ttl_seconds=3600, max_entries=1000):
+        super().__init__(ttl_seconds, max_entries)
+        self.similarity_threshold = similarity_threshold
+        self._next_key = itertools.count()
+        # Stacked entry vectors, rebuilt lazily after the entries change
+        self._matrix = None
+        self._matrix_keys = []
+
+    def _entries_changed(self):
+        self._matrix = None
+
+    def _expire(self, now):
+        self._remove_expired(
+            [key for key, entry in self._entries.items() if self._is_expired(entry, now)]
+        )
+
+    def _stacked(self):
+        if self._matrix is None:
+            self._matrix_keys = list(self._entries)
+            self._matrix = (
+                np.stack([self._entries[key].vector for key in self._matrix_keys])
+                if self._matrix_keys
+                else None
+            )
+        return self._matrix, self._matrix_keys
+
+    def lookup(self, scope, embedding, generation):
+        """The cached value for the closest question in scope, or None."""
+        with self._lock:
+            self._check_generation(generation)
+            self._expire(time.monotonic())
+            matrix, keys = self._stacked()
+            if matrix is not None:
+                scores = matrix @ normalize(embedding)
+                for row in np.argsort(-scores):
+                    if scores[row] < self.similarity_threshold:
+                        break
+                    if self._entries[keys[row]].scope == scope:
+                        return self._hit(keys[row])
+            return self._miss()
+
+    def store(self, scope, embedding, value, generation):
+        with self._lock:
+            self._check_generation(generation)
+            self._add(
+                next(self._next_key),
+                SemanticCacheEntry(
+                    value, time.monotonic(), scope, normalize(embedding)
+                ),
+            )
@@ -0,0 +1,50 @@
+"""Token usage of a request, counted from the vLLM outputs of the generation
+calls it made - the prompt tokens each call prefilled and the tokens of every
+sample it generated."""
+
+from llama_index.core.schema import MetadataMode
+
+from rag_studio.inference.async_vllm import CHAT_STAGE
+
+
+def context_tokens(tokenizer, source_nodes):
+    """Tokens of the retrieved context, as it appears in the prompt. Tokenizes
+    every node, so is best kept off the event loop."""
+    return sum(
+        len(
+            tokenizer.encode(
+                node.node.get_content(metadata_mode=MetadataMode.LLM),
+                add_special_tokens=False,
+            )
+        )
+        for node in source_nodes
+    )
+
+
+def generation_usage(generations, chat=False, retrieved_context_tokens=None):
+    """Usage in the OpenAI format from (stage, output) pairs - none, for a
+    cached answer. In chat requests, complete calls are the condense step.
+    With retrieved_context_tokens, a breakdown by stage is added along with
+    them (they're counted in the answer's prompt tokens)."""
+    stages = {}
+    for stage, output in generations:
+        name = "condense" if chat and stage != CHAT_STAGE else "answer"
+        counts = stages.setdefault(name, {"prompt_tokens": 0, "completion_tokens": 0})
+        counts["prompt_tokens"] += len(output.prompt_token_ids)
+        counts["completion_tokens"] += sum(
+            len(sample.token_ids) for sample in output.outputs
+        )
+    prompt_tokens = sum(counts["prompt_tokens"] for counts in stages.values())
+    completion_tokens = sum(counts["completion_tokens"] for counts in stages.values())
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    if retrieved_context_tokens is not None:
+        # Extension - not part of the OpenAI API
+        usage["stages"] = {
+            **stages,
+            "retrieved_context": {"prompt_tokens": retrieved_context_tokens},
+        }
+    return usage
@@ -1,26 +1,40 @@
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime
+import json
 import os
 import shutil
 from pathlib import Path
 import sys
 import logging
 import secrets
-from typing import Union
+from typing import Optional, Union
 
 
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
 
 from llama_index.core.base.llms.types import ChatMessage
+from llama_index.core.base.response.schema import Response
+from llama_index.core.schema import QueryBundle
 
 # from flask_cors import CORS
 from rag_studio import LOG_FILE_FOLDER, attach_handlers
 from rag_studio.chat_history import ChatHistory
+from rag_studio.inference.async_vllm import (
+    CHAT_STAGE,
+    record_generations,
+    sampling_scope,
+)
+from rag_studio.inference.micro_batcher import MicroBatcher
 from rag_studio.inference.repo_handling import infer_repo_id
+from rag_studio.inference.response_cache import ResponseCache, normalize_text
+from rag_studio.inference.semantic_cache import SemanticCache
+from rag_studio.inference.usage import context_tokens, generation_usage
 from rag_studio.log_files import tail_logs
 from rag_studio.model_builder import ModelBuilder
 from rag_studio.model_settings import (
@@ -28,22 +42,38 @@ from rag_studio.model_settings import (
     app_name_from_settings,
     chat_prompts_from_settings,
     embedding_model_from_settings,
+    index_settings_from_settings,
     query_prompts_from_settings,
     read_settings,
+    response_cache_settings_from_settings,
+    semantic_cache_settings_from_settings,
+    serving_settings_from_settings,
 )
 from rag_studio.ragstore import RagStore
 from rag_studio.hf_repo_storage import download_from_repo, get_last_commit
+from rag_studio.stage_timings import collect_stage_timings, timed_stage
 from rag_studio.openai.schema import ChatCompletionRequest, CompletionRequest
+from rag_studio.openai.streaming import (
+    UNKNOWN_USAGE,
+    add_contexts_if_needed,
+    openai_event_stream,
+)
 
 logger = logging.getLogger(__name__)
 
 
 def skeleton_openai_chat_response(
-    req_id, response_obj, model_name="rag-chat", include_contexts=False
+    req_id,
+    response_obj,
+    model_name="rag-chat",
+    include_contexts=False,
+    samples=None,
+    usage=None,
 ):
     """Construct a response that's representative of OpenAI format responses,
     even though we don't have most of the data that would be needed to construct it.
-    Just fill in what we don't have with blanks"""
+    Just fill in what we don't have with blanks. samples are the texts of each
+    answer when n > 1 were asked for."""
     # Example OpenAI chat completion response:
     #     {
     #   "id": "chatcmpl-123",
@@ -66,49 +96,63 @@ def skeleton_openai_chat_response(
     #     "total_tokens": 21
     #   }
     # }
-    choice_obj = {
-        "index": 0,
-        "message": {
-            "role": "assistant",
-            "content": response_obj.response,
-        },
-        "logprobs": None,
-        "finish_reason": "stop",
-    }
-    add_contexts_if_needed(response_obj, include_contexts, choice_obj)
+    choices = []
+    for index, text in enumerate(samples or [response_obj.response]):
+        choice_obj = {
+            "index": index,
+            "message": {
+                "role": "assistant",
+                "content": text,
+            },
+            "logprobs": None,
+            "finish_reason": "stop",
+        }
+        add_contexts_if_needed(response_obj, include_contexts, choice_obj)
+        choices.append(choice_obj)
     return {
         "id": f"chatcmpl-{req_id}",
         "object": "chat.completion",
         "created": int(datetime.now().timestamp()),
         "model": model_name,
         "system_fingerprint": req_id,
-        "choices": [choice_obj],
-        "usage": {
-            "prompt_tokens": -1,
-            "completion_tokens": -1,
-            "total_tokens": -1,
-        },
+        "choices": choices,
+        "usage": usage or UNKNOWN_USAGE,
     }
 
 
-def add_contexts_if_needed(response_obj, include_contexts, choice_obj):
-    if include_contexts:
-        choice_obj["contexts"] = [
-            {
-                "context": sn.text,
-                "score": sn.score,
-                "filename": sn.metadata.get("file_name"),
-            }
-            for sn in response_obj.source_nodes
-        ]
-
-
 def skeleton_openai_completion_response(
-    req_id, responseObj, model_name="rag-query", include_contexts=False
+    req_id,
+    responseObj,
+    model_name="rag-query",
+    include_contexts=False,
+    samples=None,
+    usage=None,
 ):
     """Construct a response that's representative of OpenAI format responses,
     even though we don't have most of the data that would be needed to construct it.
-    Just fill in what we don't have with blanks"""
+    Just fill in what we don't have with blanks. samples are the texts of each
+    answer when n > 1 were asked for."""
+    return skeleton_openai_batch_completion_response(
+        req_id,
+        [(responseObj, samples or [responseObj.response])],
+        model_name,
+        include_contexts,
+        usage,
+    )
+
+
+def skeleton_openai_batch_completion_response(
+    req_id,
+    results,
+    model_name="rag-query",
+    include_contexts=False,
+    usage=None,
+    errors=None,
+):
+    """As skeleton_openai_completion_response, for a batch of prompts - results
+    has a (response object, sample texts) pair per prompt. As with OpenAI, the
+    choices for prompt i are at indexes i * n to (i + 1) * n - 1. errors maps
+    the indexes of prompts that failed to why."""
     # Example OpenAI completion response:
     #     {
     #   "id": "cmpl-uqkvlQyYK7bGYrRHQ0eXlWi7",
@@ -130,28 +174,85 @@ def skeleton_openai_completion_response(
     #     "total_tokens": 12
     #   }
     # }
-    choice_obj = {
-        "text": responseObj.response,
-        "index": 0,
-        "logprobs": None,
-        "finish_reason": "length",
-    }
-    add_contexts_if_needed(responseObj, include_contexts, choice_obj)
+    errors = errors or {}
+    choices = []
+    for prompt_index, (response_obj, texts) in enumerate(results):
+        for text in texts:
+            choice_obj = {
+                "text": text,
+                "index": len(choices),
+                "logprobs": None,
+                "finish_reason": "length",
+            }
+            if prompt_index in errors:
+                # Extension - not part of the OpenAI API
+                choice_obj["finish_reason"] = "error"
+                choice_obj["error"] = errors[prompt_index]
+            add_contexts_if_needed(response_obj, include_contexts, choice_obj)
+            choices.append(choice_obj)
     return {
         "id": f"cmpl-{req_id}",
         "object": "text_completion",
         "created": int(datetime.now().timestamp()),
         "model": model_name,
         "system_fingerprint": req_id,
-        "choices": [choice_obj],
-        "usage": {
-            "prompt_tokens": -1,
-            "completion_tokens": -1,
-            "total_tokens": -1,
-        },
+        "choices": choices,
+        "usage": usage or UNKNOWN_USAGE,
     }
 
 
+def streaming_response(req, req_id, chat, start, **kwargs):
+    include_usage = bool(req.stream_options and req.stream_options.include_usage)
+    return StreamingResponse(
+        openai_event_stream(
+            req_id,
+            chat,
+            start,
+            MODEL_NAME,
+            include_usage=include_usage,
+            slot=request_slot,
+            **kwargs,
+        ),
+        media_type="text/event-stream",
+    )
+
+
+def answer_samples(generations, stage=None):
+    """The texts of every sample of the answer - i.e. of the last generation
+    call (of the given stage), as later calls build on earlier ones."""
+    outputs = [
+        output for call_stage, output in generations if stage in (None, call_stage)
+    ]
+    if not outputs:
+        return None
+    return [sample.text for sample in outputs[-1].outputs]
+
+
+async def request_usage(generations, source_nodes=(), chat=False, include_stages=False):
+    """Token usage of a request (see generation_usage), also added to the
+    server totals. include_stages adds a breakdown by stage, along with the
+    tokens of retrieved context."""
+    retrieved_context_tokens = None
+    if include_stages:
+        # Tokenizing every retrieved chunk would hold up the event loop
+        retrieved_context_tokens = await asyncio.to_thread(
+            context_tokens, tokenizer, source_nodes
+        )
+    usage = generation_usage(generations, chat, retrieved_context_tokens)
+    usage_totals["prompt_tokens"] += usage["prompt_tokens"]
+    usage_totals["completion_tokens"] += usage["completion_tokens"]
+    return usage
+
+
+def cached_answer(result):
+    """A start function for streaming an answer we already have."""
+
+    async def start():
+        return [result.response], result
+
+    return start
+
+
 app = FastAPI()
 
 app.add_middleware(
@@ -183,6 +284,11 @@ if os.path.exists(rag_storage_path):
     # Remove the directory tree at rag_storage_path, even if the dir is not empty
     shutil.rmtree(rag_storage_path)
 
+# Taken before downloading - a commit pushed part way through the download
+# would otherwise be credited with a partly older index
+index_commit = get_last_commit(rag_repo_id)
+index_commit_id = index_commit.commit_id if index_commit else None
+logger.info("Index commit: %s", index_commit_id)
 download_from_repo(rag_repo_id, rag_storage_path)
 
 # Read model settings from the downloaded repo
@@ -197,6 +303,7 @@ rag_storage = RagStore(
     embed_model=model_builder.make_embedding_model(
         embedding_model_from_settings(settings)
     ),
+    index_settings=index_settings_from_settings(settings),
 )
 
 
@@ -210,13 +317,140 @@ def healthcheck_api():
 
 
 MODEL_NAME = settings["model"]
-llm = model_builder.make_llm(MODEL_NAME)
+# The async engine batches concurrent requests and can stream tokens
+llm = model_builder.make_async_llm(MODEL_NAME)
+# Loaded now rather than by the first request that counts tokens, which
+# could otherwise block on downloading it
+tokenizer = llm.tokenizer
 chat_prompts = chat_prompts_from_settings(settings)
-chat_engine = rag_storage.make_chat_engine(llm=llm, chat_prompts=chat_prompts)
 query_prompts = query_prompts_from_settings(settings)
-query_engine = rag_storage.make_query_engine(llm=llm, query_prompts=query_prompts)
 chat_history = ChatHistory()
 
+serving_settings = serving_settings_from_settings(settings)
+# Bounds the requests retrieving / generating at once, so that under load the
+# rest wait here in turn rather than all competing inside the engines
+request_slots = asyncio.Semaphore(serving_settings["max_concurrent_requests"])
+request_slot_stats = {"active": 0, "waiting": 0}
+# Tokens processed since startup, for throughput monitoring
+usage_totals = {"prompt_tokens": 0, "completion_tokens": 0}
+# The query embeddings of concurrent requests are computed as a batch
+query_embedding_batcher = MicroBatcher(
+    rag_storage.embed_model.get_query_embedding_batch,
+    window_seconds=serving_settings["batch_window_ms"] / 1000,
+    max_batch_size=serving_settings["max_batch_size"],
+)
+rag_storage.embed_model.set_query_batcher(query_embedding_batcher)
+
+
+@asynccontextmanager
+async def request_slot():
+    request_slot_stats["waiting"] += 1
+    try:
+        await request_slots.acquire()
+    finally:
+        request_slot_stats["waiting"] -= 1
+    request_slot_stats["active"] += 1
+    try:
+        yield
+    finally:
+        request_slot_stats["active"] -= 1
+        request_slots.release()
+
+
+semantic_cache_settings = semantic_cache_settings_from_settings(settings)
+semantic_cache = None
+if semantic_cache_settings["enabled"]:
+    semantic_cache = SemanticCache(
+        similarity_threshold=semantic_cache_settings["similarity_threshold"],
+        ttl_seconds=semantic_cache_settings["ttl_seconds"],
+        max_entries=semantic_cache_settings["max_entries"],
+    )
+
+response_cache_settings = response_cache_settings_from_settings(settings)
+response_cache = None
+if response_cache_settings["enabled"]:
+    response_cache = ResponseCache(
+        ttl_seconds=response_cache_settings["ttl_seconds"],
+        max_entries=response_cache_settings["max_entries"],
+    )
+
+# Request fields that change the answer generated for the same question
+ANSWER_FIELDS = {
+    "filters",
+    "temperature",
+    "top_p",
+    "max_tokens",
+    "stop",
+    "presence_penalty",
+    "frequency_penalty",
+    "n",
+    "best_of",
+}
+
+
+def answer_key(req):
+    return json.dumps(req.model_dump(include=ANSWER_FIELDS), sort_keys=True)
+
+
+def cache_generation():
+    """Cached answers are only valid for the index and prompts they came from.
+    The index is fixed for the life of the server, so is identified by the
+    repo commit it was downloaded at."""
+    return (
+        index_commit_id,
+        json.dumps([chat_prompts, query_prompts], sort_keys=True),
+    )
+
+
+def response_cache_key(req, kind, question, use_response_cache=None):
+    """The exact-match cache key of a request, or None if it mustn't be
+    answered from the cache. By default only requests at temperature 0 - whose
+    answer doesn't change between runs - are, but a request can opt in or out."""
+    if response_cache is None:
+        return None
+    if use_response_cache is None:
+        use_response_cache = req.temperature == 0
+    if not use_response_cache:
+        return None
+    return (kind, question, answer_key(req), MODEL_NAME)
+
+
+def normalized_messages(messages):
+    return json.dumps(
+        [[m.get("role"), normalize_text(m.get("content") or "")] for m in messages]
+    )
+
+
+def normalized_prompt(prompt):
+    if isinstance(prompt, str):
+        return normalize_text(prompt)
+    # Batches of texts, or token ids
+    return json.dumps(
+        [normalize_text(p) if isinstance(p, str) else p for p in prompt]
+    )
+
+
+def response_cache_lookup(key):
+    if key is None:
+        return None
+    return response_cache.lookup(key, cache_generation())
+
+
+def response_cache_store(key, value):
+    if key is not None:
+        response_cache.store(key, value, cache_generation())
+
+
+def semantic_cache_lookup(scope, embedding):
+    if semantic_cache is None:
+        return None
+    return semantic_cache.lookup(scope, embedding, cache_generation())
+
+
+def semantic_cache_store(scope, embedding, result):
+    if semantic_cache is not None:
+        semantic_cache.store(scope, embedding, result, cache_generation())
+
 
 @app.on_event("startup")
 async def startup_event():
@@ -261,7 +495,12 @@ def get_chat_history(user_id: str):
 
 
 @app.post("/v1/chat/completions")
-def chat_completions(req: ChatCompletionRequest, include_contexts: bool = False):
+async def chat_completions(
+    req: ChatCompletionRequest,
+    include_contexts: bool = False,
+    include_usage_stages: bool = False,
+    use_response_cache: Optional[bool] = None,
+):
     """API to get completions for a given prompt."""
     req_id = secrets.token_hex(16)
     logger.info("Request ID: %s", req_id)
@@ -274,38 +513,351 @@ def chat_completions(req: ChatCompletionRequest, include_contexts: bool = False)
         )
     history = [ChatMessage(**m) for m in messages[:-1]]
 
-    problem_str = req.set_model_params_from_request(llm)
+    problem_str = req.request_problem()
     if problem_str:
-        return HTTPException(status_code=400, detail=problem_str)
-    result = chat_engine.chat(messages[-1]["content"], chat_history=history)
+        raise HTTPException(status_code=400, detail=problem_str)
+    sampling = req.sampling_params()
+
+    async def usage_for(generations, response_obj):
+        return await request_usage(
+            generations,
+            response_obj.source_nodes,
+            chat=True,
+            include_stages=include_usage_stages,
+        )
+
+    exact_key = response_cache_key(
+        req, "chat", normalized_messages(messages), use_response_cache
+    )
+    cache_scope = ("chat", json.dumps(messages[:-1], sort_keys=True), answer_key(req))
+    result = embedding = samples = None
+    cached = response_cache_lookup(exact_key)
+    if cached is not None:
+        result, samples = cached
+    # Sampled answers (n > 1) aren't cached semantically
+    elif semantic_cache is not None and req.n == 1:
+        embedding = await rag_storage.embed_model.aget_query_embedding(
+            new_message["content"]
+        )
+        result = semantic_cache_lookup(cache_scope, embedding)
+    if result is not None:
+        record_chat_history(req, messages, result.response)
+        if req.stream:
+            return streaming_response(
+                req,
+                req_id,
+                True,
+                cached_answer(result),
+                include_contexts=include_contexts,
+                usage=lambda response_obj: usage_for([], response_obj),
+            )
+        return skeleton_openai_chat_response(
+            req_id,
+            result,
+            MODEL_NAME,
+            include_contexts=include_contexts,
+            samples=samples,
+            usage=await usage_for([], result),
+        )
+
+    # Chat engines hold the conversation memory, so each request gets its own
+    engine = rag_storage.make_chat_engine(llm, chat_prompts, filters=req.filters)
+    if req.stream:
+        # Filled as the condense and answer calls finish
+        streamed_generations = []
+
+        async def start():
+            with sampling_scope(samples_stage=CHAT_STAGE, **sampling):
+                with record_generations(streamed_generations):
+                    with collect_stage_timings() as timings:
+                        streamed = await engine.astream_chat(
+                            new_message["content"], chat_history=history
+                        )
+            logger.info("Request %s stage timings: %s", req_id, timings)
+            return streamed.async_response_gen(), streamed
+
+        def on_finished(answer, streamed):
+            record_chat_history(req, messages, answer)
+            answer_response = Response(answer, source_nodes=streamed.source_nodes)
+            response_cache_store(exact_key, (answer_response, None))
+            if embedding is not None:
+                semantic_cache_store(cache_scope, embedding, answer_response)
+
+        return streaming_response(
+            req,
+            req_id,
+            True,
+            start,
+            include_contexts=include_contexts,
+            on_finished=on_finished,
+            usage=lambda response_obj: usage_for(streamed_generations, response_obj),
+        )
+
+    async with request_slot():
+        # Only the answer is sampled n times - from one retrieval and one
+        # prefill of the prompt - not the condensed question
+        with sampling_scope(samples_stage=CHAT_STAGE, **sampling):
+            with record_generations() as generations:
+                with collect_stage_timings() as timings:
+                    result = await engine.achat(
+                        new_message["content"], chat_history=history
+                    )
+    logger.info("Request %s stage timings: %s", req_id, timings)
+    samples = answer_samples(generations, CHAT_STAGE) if req.n > 1 else None
+    response_cache_store(exact_key, (result, samples))
+    if embedding is not None:
+        semantic_cache_store(cache_scope, embedding, result)
+    record_chat_history(req, messages, result.response)
+    return skeleton_openai_chat_response(
+        req_id,
+        result,
+        MODEL_NAME,
+        include_contexts=include_contexts,
+        samples=samples,
+        usage=await usage_for(generations, result),
+    )
+
+
+def record_chat_history(req, messages, answer):
     if req.user:
         logger.info("Tracking chat history for user %s", req.user)
         chat_history.update_user_chat_history(
             user_id=req.user,
             prev_messages=messages[:-1],
-            new_question=new_message,
-            new_answer={"role": "assistant", "content": result.response},
+            new_question=messages[-1],
+            new_answer={"role": "assistant", "content": answer},
         )
 
-    return skeleton_openai_chat_response(
-        req_id, result, MODEL_NAME, include_contexts=include_contexts
-    )
-
 
 @app.post("/v1/completions")
-def completions(req: CompletionRequest, include_contexts: bool = False):
+async def completions(
+    req: CompletionRequest,
+    include_contexts: bool = False,
+    include_usage_stages: bool = False,
+    use_response_cache: Optional[bool] = None,
+):
     """API to get completions for a given prompt."""
     req_id = secrets.token_hex(16)
     logger.info("Request ID: %s", req_id)
-    problem_str = req.set_model_params_from_request(llm)
+    problem_str = req.request_problem()
     if problem_str:
-        return HTTPException(status_code=400, detail=problem_str)
-    result = query_engine.query(req.prompt)
+        raise HTTPException(status_code=400, detail=problem_str)
+    sampling = req.sampling_params()
+    exact_key = response_cache_key(
+        req, "completion", normalized_prompt(req.prompt), use_response_cache
+    )
+    cached = response_cache_lookup(exact_key)
+    if not isinstance(req.prompt, str):
+        if cached is not None:
+            return skeleton_openai_batch_completion_response(
+                req_id,
+                cached,
+                MODEL_NAME,
+                include_contexts=include_contexts,
+                usage=await request_usage(
+                    [],
+                    [node for result, _ in cached for node in result.source_nodes],
+                    include_stages=include_usage_stages,
+                ),
+            )
+        return await batch_completions(
+            req, req_id, sampling, include_contexts, include_usage_stages, exact_key
+        )
+
+    async def usage_for(generations, response_obj):
+        return await request_usage(
+            generations,
+            response_obj.source_nodes,
+            include_stages=include_usage_stages,
+        )
+
+    result = embedding = samples = None
+    cache_scope = ("completion", answer_key(req))
+    if cached is not None:
+        result, samples = cached
+    else:
+        # Embedded up front (batched with concurrent requests' queries) for
+        # both the semantic cache lookup and retrieval
+        embedding = await rag_storage.embed_model.aget_query_embedding(req.prompt)
+        if req.n == 1:
+            result = semantic_cache_lookup(cache_scope, embedding)
+    if result is not None:
+        if req.stream:
+            return streaming_response(
+                req,
+                req_id,
+                False,
+                cached_answer(result),
+                include_contexts=include_contexts,
+                usage=lambda response_obj: usage_for([], response_obj),
+            )
+        return skeleton_openai_completion_response(
+            req_id,
+            result,
+            MODEL_NAME,
+            include_contexts=include_contexts,
+            samples=samples,
+            usage=await usage_for([], result),
+        )
+
+    query = QueryBundle(query_str=req.prompt, embedding=embedding)
+    engine = rag_storage.make_query_engine(
+        llm, query_prompts, filters=req.filters, streaming=req.stream
+    )
+    if req.stream:
+        streamed_generations = []
+
+        async def start():
+            # llama_index's async synthesizers don't stream, so the streaming
+            # query runs on a worker thread (generation is still on the
+            # async engine) and its deltas are read from there
+            with sampling_scope(**sampling), record_generations(streamed_generations):
+                with collect_stage_timings() as timings:
+                    streamed = await asyncio.to_thread(engine.query, query)
+            logger.info("Request %s stage timings: %s", req_id, timings)
+            return streamed.response_gen, streamed
+
+        def on_finished(answer, streamed):
+            answer_response = Response(answer, source_nodes=streamed.source_nodes)
+            response_cache_store(exact_key, (answer_response, None))
+            semantic_cache_store(cache_scope, embedding, answer_response)
+
+        return streaming_response(
+            req,
+            req_id,
+            False,
+            start,
+            include_contexts=include_contexts,
+            on_finished=on_finished,
+            usage=lambda response_obj: usage_for(streamed_generations, response_obj),
+        )
+
+    async with request_slot():
+        # n > 1 samples share one retrieval and one prefill of the prompt
+        with sampling_scope(**sampling):
+            with record_generations() as generations:
+                with collect_stage_timings() as timings:
+                    result = await engine.aquery(query)
+    logger.info("Request %s stage timings: %s", req_id, timings)
+    samples = answer_samples(generations) if req.n > 1 else None
+    response_cache_store(exact_key, (result, samples))
+    if req.n == 1:
+        semantic_cache_store(cache_scope, embedding, result)
     return skeleton_openai_completion_response(
-        req_id, result, MODEL_NAME, include_contexts=include_contexts
+        req_id,
+        result,
+        MODEL_NAME,
+        include_contexts=include_contexts,
+        samples=samples,
+        usage=await usage_for(generations, result),
+    )
+
+
+def prompt_texts(prompt):
+    """The prompts of a completion request as texts - token ids are decoded."""
+    if isinstance(prompt, str):
+        return [prompt]
+    if isinstance(prompt[0], int):
+        return [tokenizer.decode(prompt)]
+    if isinstance(prompt[0], str):
+        return list(prompt)
+    return [tokenizer.decode(tokens) for tokens in prompt]
+
+
+def qa_prompt_or_error(question, nodes):
+    try:
+        return rag_storage.qa_prompt(llm, query_prompts, question, nodes)
+    except ValueError as e:
+        # The question alone doesn't fit in the context window
+        return e
+
+
+async def batch_completions(
+    req, req_id, sampling, include_contexts, include_usage_stages, exact_key=None
+):
+    """A batch of prompts in one request: they're embedded in one call,
+    retrieved for together, and all the answer prompts are submitted to vLLM
+    at once. A prompt that fails gets an error in its choices, rather than
+    failing the whole batch."""
+    questions = await asyncio.to_thread(prompt_texts, req.prompt)
+    async with request_slot():
+        with sampling_scope(**sampling), collect_stage_timings() as timings:
+            with timed_stage("embed_query"):
+                embeddings = await asyncio.to_thread(
+                    rag_storage.embed_model.get_query_embedding_batch, questions
+                )
+            nodes_per_question = await asyncio.to_thread(
+                rag_storage.retrieve_batch, questions, embeddings, req.filters
+            )
+            # Prompt or exception, replaced by the output once generated
+            outcomes = await asyncio.to_thread(
+                lambda: [
+                    qa_prompt_or_error(question, nodes)
+                    for question, nodes in zip(questions, nodes_per_question)
+                ]
+            )
+            to_generate = [
+                i for i, outcome in enumerate(outcomes) if isinstance(outcome, str)
+            ]
+            with record_generations() as generations:
+                with timed_stage("generate"):
+                    outputs = await llm.agenerate_batch(
+                        [outcomes[i] for i in to_generate], return_exceptions=True
+                    )
+    for i, output in zip(to_generate, outputs):
+        outcomes[i] = output
+    logger.info(
+        "Request %s (%d prompts) stage timings: %s", req_id, len(questions), timings
+    )
+    results = []
+    errors = {}
+    for i, (outcome, nodes) in enumerate(zip(outcomes, nodes_per_question)):
+        if isinstance(outcome, BaseException):
+            logger.warning("Request %s prompt %d failed: %s", req_id, i, outcome)
+            errors[i] = str(outcome)
+            results.append((Response("", source_nodes=nodes), [""] * req.n))
+        else:
+            results.append(
+                (
+                    Response(outcome.outputs[0].text, source_nodes=nodes),
+                    [sample.text for sample in outcome.outputs],
+                )
+            )
+    if not errors:
+        response_cache_store(exact_key, results)
+    return skeleton_openai_batch_completion_response(
+        req_id,
+        results,
+        MODEL_NAME,
+        include_contexts=include_contexts,
+        usage=await request_usage(
+            generations,
+            [node for nodes in nodes_per_question for node in nodes],
+            include_stages=include_usage_stages,
+        ),
+        errors=errors,
     )
 
 
+@app.get("/metrics")
+def get_metrics():
+    """API to get serving metrics."""
+    return {
+        "semantic_cache": semantic_cache.stats() if semantic_cache else None,
+        "response_cache": response_cache.stats() if response_cache else None,
+        "requests": {
+            **request_slot_stats,
+            "max_concurrent": serving_settings["max_concurrent_requests"],
+        },
+        "query_embedding_batches": query_embedding_batcher.stats(),
+        "tokens": {
+            **usage_totals,
+            "completion_tokens_per_second": usage_totals["completion_tokens"]
+            / max(1.0, (datetime.now() - startTime).total_seconds()),
+        },
+    }
+
+
 file_infos = rag_storage.list_files()
 
 
@@ -0,0 +1,102 @@
+"""Posting index from node metadata values to node ids.
+
+Used to restrict retrieval to matching nodes - e.g. the chunks of a few named
+files - so that only their vectors are scored, rather than searching the whole
+index and filtering the results afterwards. It is updated as nodes are
+inserted and deleted, like the BM25 index."""
+
+from collections import defaultdict
+import json
+import logging
+import os
+import threading
+
+from rag_studio.segment_log import write_json_atomically
+
+logger = logging.getLogger(__name__)
+
+# Longer values (e.g. summaries added by metadata extractors) aren't filterable
+MAX_VALUE_LENGTH = 256
+
+
+def indexable_items(metadata):
+    for key, value in metadata.items():
+        if isinstance(value, (str, int, float, bool)) and len(str(value)) <= (
+            MAX_VALUE_LENGTH
+        ):
+            yield key, str(value)
+
+
+class MetadataIndex:
+    def __init__(self, path):
+        self.path = path
+        # key -> value -> set of node ids
+        self._postings = defaultdict(lambda: defaultdict(set))
+        # node id -> [(key, value), ...]
+        self._node_items = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "r", encoding="UTF-8") as f:
+            node_items = json.load(f)["node_items"]
+        for node_id, items in node_items.items():
+            self._add(node_id, [tuple(item) for item in items])
+
+    def save(self):
+        with self._lock:
+            write_json_atomically(self.path, {"node_items": self._node_items})
+
+    def __contains__(self, node_id):
+        return node_id in self._node_items
+
+    def _add(self, node_id, items):
+        self._node_items[node_id] = items
+        for key, value in items:
+            self._postings[key][value].add(node_id)
+
+    def _remove(self, node_id):
+        for key, value in self._node_items.pop(node_id, []):
+            node_ids = self._postings[key][value]
+            node_ids.discard(node_id)
+            if not node_ids:
+                del self._postings[key][value]
+
+    def add(self, nodes):
+        with self._lock:
+            for node in nodes:
+                self._remove(node.node_id)
+                self._add(node.node_id, list(indexable_items(node.metadata)))
+
+    def remove(self, node_ids):
+        with self._lock:
+            for node_id in node_ids:
+                self._remove(node_id)
+
+    def sync(self, docstore, node_ids):
+        """Bring the index in line with the given set of live node ids - only
+        the missing nodes are read from the docstore."""
+        missing = [node_id for node_id in node_ids if node_id not in self]
+        stale = [node_id for node_id in self._node_items if node_id not in node_ids]
+        if missing:
+            logger.info("Adding %d nodes to the metadata index", len(missing))
+            self.add(docstore.get_nodes(missing))
+        if stale:
+            self.remove(stale)
+        return bool(missing or stale)
+
+    def match(self, filters):
+        """Node ids matching all of the filters, where each filter maps a
+        metadata key to a value or a list of accepted values."""
+        matched = None
+        with self._lock:
+            for key, values in filters.items():
+                if not isinstance(values, (list, tuple, set)):
+                    values = [values]
+                postings = self._postings.get(key, {})
+                node_ids = set().union(
+                    *(postings.get(str(value), ()) for value in values)
+                )
+                matched = node_ids if matched is None else matched & node_ids
+        return matched if matched is not None else set(self._node_items)
@@ -1,9 +1,18 @@
 import gc
 import logging
+import os
 import time
 
+from rag_studio.embedding_cache import CachedEmbedding, EmbeddingCache
+
 logger = logging.getLogger(__name__)
 
+# Bigger than the llama_index default of 10, so that bulk ingestion
+# keeps the embedding model busy with fewer, larger forward passes
+EMBED_BATCH_SIZE = 64
+# At 768 float16 dims this is roughly 300MB of cached embeddings
+EMBEDDING_CACHE_MAX_ENTRIES = 200_000
+
 
 def get_desired_dtype(model_name, download_dir):
     from vllm.engine.arg_utils import EngineArgs
@@ -116,6 +125,18 @@ def calculate_max_content_window(model_name, download_dir, inferred_dtype):
 class ModelBuilder:
     def __init__(self, models_download_folder):
         self.models_download_folder = models_download_folder
+        self._embedding_cache = None
+
+    def embedding_cache(self):
+        """The cache is shared by every embedding model we build - entries are
+        keyed by model name as well as text."""
+        if self._embedding_cache is None:
+            os.makedirs(self.models_download_folder, exist_ok=True)
+            self._embedding_cache = EmbeddingCache(
+                f"{self.models_download_folder}/embedding-cache.sqlite",
+                max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+            )
+        return self._embedding_cache
 
     def derive_max_possible_model_len(self, llm_model):
         """Derive the max model length from the model name."""
@@ -133,18 +154,18 @@ class ModelBuilder:
         logger.info("Initialising embedding model %s", model_name)
 
         # embedding model
-        return HuggingFaceEmbedding(
+        embed_model = HuggingFaceEmbedding(
             model_name=model_name,
             cache_folder=f"{self.models_download_folder}/.hf-cache",
+            embed_batch_size=EMBED_BATCH_SIZE,
         )
+        return CachedEmbedding(embed_model, self.embedding_cache())
 
-    def make_llm(self, llm_model):
-        """Initialise the LLM model with the given config."""
-        from llama_index.llms.vllm import Vllm
+    def vllm_engine_kwargs(self, llm_model):
+        """Work out the vLLM engine arguments that fit this model on the
+        available GPUs."""
         import torch
 
-        logger.info("Initialising LLM model %s", llm_model)
-
         inferred_dtype = infer_dtype_to_use(llm_model, self.vllm_models_folder())
         max_possible_model_len = self.derive_max_possible_model_len(llm_model)
         logger.info("Max possible model length: %d", max_possible_model_len)
@@ -166,19 +187,42 @@ class ModelBuilder:
         max_model_len = min(max_possible_model_len, max_possible_content_window)
         logger.info("Choosing max model length: %d", max_model_len)
 
+        return {
+            "download_dir": self.vllm_models_folder(),
+            "dtype": inferred_dtype,
+            # Calculate number of available GPUs
+            "tensor_parallel_size": torch.cuda.device_count(),
+            "max_model_len": max_model_len,
+            "disable_custom_all_reduce": True,
+        }
+
+    def make_llm(self, llm_model):
+        """Initialise the LLM model with the given config."""
+        from llama_index.llms.vllm import Vllm
+
+        logger.info("Initialising LLM model %s", llm_model)
+
+        engine_kwargs = self.vllm_engine_kwargs(llm_model)
         vllm = Vllm(
             model=llm_model,
-            download_dir=self.vllm_models_folder(),
-            dtype=inferred_dtype,
-            # Calculate number of available GPUs
-            tensor_parallel_size=torch.cuda.device_count(),
-            vllm_kwargs={
-                "max_model_len": max_model_len,
-                "disable_custom_all_reduce": True,
-            },
+            download_dir=engine_kwargs.pop("download_dir"),
+            dtype=engine_kwargs.pop("dtype"),
+            tensor_parallel_size=engine_kwargs.pop("tensor_parallel_size"),
+            vllm_kwargs=engine_kwargs,
         )
         return vllm
 
+    def make_async_llm(self, llm_model):
+        """Initialise the LLM on vLLM's async engine, which batches concurrent
+        requests and can stream tokens - used by the inference server."""
+        from rag_studio.inference.async_vllm import AsyncVllm
+
+        logger.info("Initialising async LLM model %s", llm_model)
+
+        return AsyncVllm(
+            model=llm_model, engine_kwargs=self.vllm_engine_kwargs(llm_model)
+        )
+
     def vllm_models_folder(self):
         return f"{self.models_download_folder}/vllm-via-llama-models"
 
@@ -11,6 +11,76 @@ from llama_index.core.prompts.default_prompts import (
 DEFAULT_LLM_MODEL = "mistralai/Mistral-7B-Instruct-v0.1"
 DEFAULT_EMBEDDING_MODEL = "BAAI/bge-base-en-v1.5"
 DEFAULT_APP_NAME = "RAG Studio Application"
+DEFAULT_INDEX_SETTINGS = {
+    # "simple" is the llama_index JSON store, "numpy" is a memory-mapped matrix,
+    # "ivf" adds an approximate nearest neighbour index over the numpy matrix
+    "vector_store": "simple",
+    # IVF tuning - None means choose the number of lists from the corpus size
+    "ivf_nlist": None,
+    "ivf_nprobe": 16,
+    "ivf_min_train_size": 10000,
+    # "none", "float16", "int8" or "binary" - queries score against quantized
+    # copies of the embeddings, optionally rescoring the best candidates with
+    # the full precision vectors (which stay memory-mapped on disk)
+    "quantization": "none",
+    "quantization_rescore": True,
+    "quantization_rescore_factor": 4,
+    # Above 1, the vector store is partitioned by document across this many
+    # shards, which are loaded and queried in parallel
+    "shard_count": 1,
+    # "full" rewrites the whole index on every checkpoint, "segments" appends
+    # only the new nodes and compacts in the background
+    "persistence": "full",
+    "segment_compaction_threshold": 8,
+    # Compact once this fraction of the vector store rows belong to deleted files
+    "tombstone_compaction_ratio": 0.25,
+    # "json" is the llama_index persist format, "snapshot" a binary format that
+    # loads faster and only parses nodes as they are retrieved
+    "storage_format": "json",
+    # Text and PDF files at least this big are read, chunked, embedded and
+    # inserted a batch of nodes at a time, to bound memory use
+    "streaming_ingest_min_bytes": 64 * 1024 * 1024,
+    "streaming_ingest_batch_size": 256,
+    # "vector" is dense retrieval only, "hybrid" fuses it with BM25 keyword
+    # search (maintaining a BM25 index alongside the vector store)
+    "retriever": "vector",
+    "similarity_top_k": 2,
+    # Candidates taken from each of the dense and sparse retrievers for fusion
+    "hybrid_candidate_k": 20,
+    "hybrid_rrf_k": 60,
+    # Cross-encoder to rerank with (e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2"),
+    # None to send the retrieved chunks straight to the LLM. When set, this many
+    # candidates are retrieved and reranked down to similarity_top_k
+    "rerank_model": None,
+    "rerank_candidate_k": 20,
+    # Reranked chunks scoring below this are dropped - None keeps all top_k
+    "rerank_score_threshold": None,
+}
+
+DEFAULT_SEMANTIC_CACHE_SETTINGS = {
+    "enabled": False,
+    # Cosine similarity between question embeddings needed to reuse an answer
+    "similarity_threshold": 0.95,
+    "ttl_seconds": 3600,
+    "max_entries": 1000,
+}
+
+DEFAULT_RESPONSE_CACHE_SETTINGS = {
+    "enabled": False,
+    # Requests are answered from the cache at temperature 0, or when they
+    # opt in
+    "ttl_seconds": 600,
+    "max_entries": 10000,
+}
+
+# Settings for how the inference server runs requests
+DEFAULT_SERVING_SETTINGS = {
+    # Requests retrieving / generating at once - more wait for a free slot
+    "max_concurrent_requests": 64,
+    # Query embeddings of requests arriving within this window are batched
+    "batch_window_ms": 5,
+    "max_batch_size": 32,
+}
 
 
 def query_prompts_from_settings(settings):
@@ -37,6 +107,22 @@ def embedding_model_from_settings(settings):
     return settings.get("embedding_model", DEFAULT_EMBEDDING_MODEL)
 
 
+def index_settings_from_settings(settings):
+    return {**DEFAULT_INDEX_SETTINGS, **settings.get("index", {})}
+
+
+def semantic_cache_settings_from_settings(settings):
+    return {**DEFAULT_SEMANTIC_CACHE_SETTINGS, **settings.get("semantic_cache", {})}
+
+
+def response_cache_settings_from_settings(settings):
+    return {**DEFAULT_RESPONSE_CACHE_SETTINGS, **settings.get("response_cache", {})}
+
+
+def serving_settings_from_settings(settings):
+    return {**DEFAULT_SERVING_SETTINGS, **settings.get("serving", {})}
+
+
 def read_settings(settings_path):
     with open(settings_path, "r", encoding="UTF-8") as f:
         return json.load(f)
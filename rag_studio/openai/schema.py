@@ -2,19 +2,20 @@ from typing import Any, Dict, List, Literal, Optional, Union
 from pydantic import BaseModel, Field
 from openai.types.chat import ChatCompletionMessageParam
 
-from llama_index.llms.vllm import Vllm
-
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+MetadataValue = Union[str, int, float, bool]
+
+
 class ResponseFormat(BaseModel):
     type: Literal["json_object", "text"]
 
 
 class StreamOptions(BaseModel):
-    include_usage: Optional[bool]
+    include_usage: Optional[bool] = False
 
 
 class ChatCompletionNamedFunction(BaseModel):
@@ -55,56 +56,23 @@ class CommonRequestFields(BaseModel):
     user: Optional[str] = None
 
     response_format: Optional[ResponseFormat] = None
+    # Extension - restrict retrieval to chunks whose metadata matches, e.g.
+    # {"file_name": ["manual-a.pdf", "manual-b.pdf"]}
+    filters: Optional[Dict[str, Union[MetadataValue, List[MetadataValue]]]] = None
 
-    def set_model_params_from_request(self, llm: Vllm):
-        """Set the model parameters from the request data."""
-        # temperature: float = 1.0,
-        # n: int = 1,
-        # presence_penalty: float = 0.0,
-        # frequency_penalty: float = 0.0,
-        # top_p: float = 1.0,
-        # stop: Optional[List[str]] = None,
-        # max_tokens ->    # max_new_tokens: int = 512,
-        # logprobs: Optional[int] = None,
+    def request_problem(self):
+        """Why the request can't be served, or None if it can."""
         # NOTE: cannot set model
         if self.model != "rag_model":
             return "No ability to change model from rag_model - this has been baked into the API"
-        logger.info(
-            "Setting model params from request data: %s",
-            self.model_dump(
-                exclude_unset=True, exclude={"messages", "prompt", "model"}
-            ),
-        )
-        if self.temperature:
-            llm.temperature = self.temperature
-        else:
-            llm.temperature = 0.7
-        if self.n and self.n != 1:
-            logger.error("Currently returning n > 1 completions is unsupported")
-            # llm.n = self.n
-            return "Currently returning n > 1 completions is unsupported"
-        if self.presence_penalty:
-            llm.presence_penalty = self.presence_penalty
-        else:
-            llm.presence_penalty = 0.0
-        if self.frequency_penalty:
-            llm.frequency_penalty = self.frequency_penalty
-        else:
-            llm.frequency_penalty = 0.0
-        if self.top_p:
-            llm.top_p = self.top_p
-        else:
-            llm.top_p = 1.0
-        if self.stop:
-            llm.stop = self.stop
-        else:
-            llm.stop = []
-        if self.max_tokens:
-            llm.max_new_tokens = self.max_tokens
-        else:
-            llm.max_new_tokens = 512
+        if self.n < 1:
+            return "n must be at least 1"
+        if self.best_of is not None and self.best_of < self.n:
+            return "best_of must be at least n"
+        if self.stream and (self.n > 1 or (self.best_of or 1) > 1):
+            logger.error("Currently streaming more than one sample is unsupported")
+            return "Currently streaming with n > 1 or best_of > 1 is unsupported"
         if self.logprobs:
-            # llm.logprobs = self.logprobs
             logger.error("Currently logprobs output is unsupported")
             return "Currently logprobs output is unsupported"
         if self.response_format and self.response_format.type != "text":
@@ -113,21 +81,34 @@ class CommonRequestFields(BaseModel):
         if self.logit_bias:
             logger.error("Currently logit_bias is unsupported")
             return "Currently logit_bias is unsupported"
-        if self.stream:
-            logger.error("Currently streaming response is unsupported")
-            return "Currently streaming response is unsupported"
-        # Additionally the old completions API supports:
-        # best_of: Optional[int] = None,
-        if self.best_of:
-            llm.best_of = self.best_of
-        else:
-            llm.best_of = 1
+        if self.stream_options and not self.stream:
+            logger.error("stream_options is only allowed when stream is set")
+            return "stream_options is only allowed when stream is set"
+        return None
 
+    def sampling_params(self):
+        """The LLM sampling settings for this request, to be applied to its
+        generation calls only (see async_vllm.sampling_scope)."""
         logger.info(
-            "LLM settings after setting from request: %s",
-            {k: v for k, v in llm.__dict__.items() if not k.startswith("_")},
+            "Sampling params from request data: %s",
+            self.model_dump(
+                exclude_unset=True,
+                exclude={"messages", "prompt", "model", "filters"},
+            ),
         )
-        return None
+        return {
+            # 0 is valid (greedy sampling), so only fall back when unset
+            "temperature": 0.7 if self.temperature is None else self.temperature,
+            "presence_penalty": self.presence_penalty or 0.0,
+            "frequency_penalty": self.frequency_penalty or 0.0,
+            "top_p": self.top_p or 1.0,
+            "stop": self.stop or [],
+            "max_new_tokens": self.max_tokens or 512,
+            "n": self.n,
+            # Additionally the old completions API supports best_of - vLLM
+            # defaults it to n
+            "best_of": self.best_of,
+        }
 
 
 class ChatCompletionRequest(CommonRequestFields):
@@ -138,16 +119,24 @@ class ChatCompletionRequest(CommonRequestFields):
         Union[Literal["none"], ChatCompletionNamedToolChoiceParam]
     ] = "none"
 
-    def set_model_params_from_request(self, llm: Vllm):
+    def request_problem(self):
         if self.tools or self.tool_choice != "none":
             logger.error("Currently use of tools / functions is unsupported")
             return "Currently use of tools / functions is unsupported"
         if self.top_logprobs:
             logger.error("Currently logprobs output is unsupported")
             return "Currently logprobs output is unsupported"
-        return super().set_model_params_from_request(llm)
+        return super().request_problem()
 
 
 class CompletionRequest(CommonRequestFields):
     prompt: Union[List[int], List[List[int]], str, List[str]]
     echo: Optional[bool] = False
+
+    def request_problem(self):
+        if not self.prompt:
+            return "prompt must not be empty"
+        if self.stream and not isinstance(self.prompt, str):
+            logger.error("Currently streaming a batch of prompts is unsupported")
+            return "Currently streaming is only supported for a single text prompt"
+        return super().request_problem()
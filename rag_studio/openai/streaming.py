@@ -0,0 +1,135 @@
+"""OpenAI-format response pieces shared by the inference endpoints - kept apart
+from the server module, which loads models and downloads the index on import."""
+
+from contextlib import asynccontextmanager
+from datetime import datetime
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Reported when we can't count tokens
+UNKNOWN_USAGE = {
+    "prompt_tokens": -1,
+    "completion_tokens": -1,
+    "total_tokens": -1,
+}
+
+
+def add_contexts_if_needed(response_obj, include_contexts, choice_obj):
+    if include_contexts:
+        choice_obj["contexts"] = [
+            {
+                "context": sn.text,
+                "score": sn.score,
+                "filename": sn.metadata.get("file_name"),
+            }
+            for sn in response_obj.source_nodes
+        ]
+
+
+def openai_stream_chunk(req_id, chat, model_name, choice_fields, include_usage):
+    """One chunk of a streamed response - chat chunks carry a "delta" message,
+    completion chunks carry "text"."""
+    chunk = {
+        "id": f"chatcmpl-{req_id}" if chat else f"cmpl-{req_id}",
+        "object": "chat.completion.chunk" if chat else "text_completion",
+        "created": int(datetime.now().timestamp()),
+        "model": model_name,
+        "system_fingerprint": req_id,
+        "choices": [
+            {"index": 0, **choice_fields, "logprobs": None, "finish_reason": None}
+        ],
+    }
+    if include_usage:
+        # As with OpenAI, usage is only filled in on the last chunk
+        chunk["usage"] = None
+    return chunk
+
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+@asynccontextmanager
+async def no_slot():
+    yield
+
+
+async def openai_event_stream(
+    req_id,
+    chat,
+    start,
+    model_name,
+    include_contexts=False,
+    include_usage=False,
+    on_finished=None,
+    usage=None,
+    slot=no_slot,
+):
+    """Server-sent events for a streamed answer, in the OpenAI format: a chunk
+    per piece of text, a last chunk with the finish reason (and contexts if
+    asked for), a usage chunk if asked for, then [DONE]. usage is awaited with
+    the response object for the token usage once the answer is complete.
+
+    start is awaited once the client is reading, holding slot() (say, a
+    request slot) until the stream ends, and returns (text deltas - a plain
+    or async iterable, the response object). on_finished is called with the
+    whole answer and the response object once the stream has completed - not
+    if the client goes away first. If answering fails part way, an error
+    event is sent before [DONE], as the response has already started."""
+    try:
+        async with slot():
+            deltas, response_obj = await start()
+            if not hasattr(deltas, "__aiter__"):
+                from starlette.concurrency import iterate_in_threadpool
+
+                deltas = iterate_in_threadpool(iter(deltas))
+            if chat:
+                yield sse_event(
+                    openai_stream_chunk(
+                        req_id,
+                        chat,
+                        model_name,
+                        {"delta": {"role": "assistant", "content": ""}},
+                        include_usage,
+                    )
+                )
+            text = ""
+            async for delta in deltas:
+                if not delta:
+                    continue
+                text += delta
+                choice_fields = (
+                    {"delta": {"content": delta}} if chat else {"text": delta}
+                )
+                yield sse_event(
+                    openai_stream_chunk(
+                        req_id, chat, model_name, choice_fields, include_usage
+                    )
+                )
+        last_chunk = openai_stream_chunk(
+            req_id,
+            chat,
+            model_name,
+            {"delta": {}} if chat else {"text": ""},
+            include_usage,
+        )
+        last_choice = last_chunk["choices"][0]
+        last_choice["finish_reason"] = "stop" if chat else "length"
+        add_contexts_if_needed(response_obj, include_contexts, last_choice)
+        yield sse_event(last_chunk)
+        usage_obj = await usage(response_obj) if usage else UNKNOWN_USAGE
+        if include_usage:
+            usage_chunk = openai_stream_chunk(req_id, chat, model_name, {}, False)
+            usage_chunk["choices"] = []
+            usage_chunk["usage"] = usage_obj
+            yield sse_event(usage_chunk)
+    except Exception as e:  # pylint: disable=broad-except
+        logger.exception("Request %s failed while streaming", req_id)
+        yield sse_event({"error": {"message": str(e), "type": type(e).__name__}})
+        yield "data: [DONE]\n\n"
+        return
+    yield "data: [DONE]\n\n"
+    if on_finished:
+        on_finished(text, response_obj)
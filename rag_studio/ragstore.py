@@ -1,5 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
 import logging
+import multiprocessing
 import os
+import shutil
+import threading
+import time
 from llama_index.core import (
     VectorStoreIndex,
     SimpleDirectoryReader,
@@ -8,71 +14,685 @@ from llama_index.core import (
     PromptTemplate,
     load_index_from_storage,
 )
+from llama_index.core.chat_engine import CondensePlusContextChatEngine
+from llama_index.core.indices.prompt_helper import PromptHelper
+from llama_index.core.indices.utils import embed_nodes
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.core.ingestion import run_transformations
 from llama_index.core.settings import transformations_from_settings_or_context
-from llama_index.core.storage.docstore.types import RefDocInfo
+from llama_index.core.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT
 from llama_index.core.prompts.prompt_type import PromptType
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.simple import SimpleVectorStore
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from rag_studio.bm25 import BM25Index
+from rag_studio.file_manifest import FileManifest, chunk_hash, hash_file
+from rag_studio.hybrid_retriever import HybridRetriever
+from rag_studio.metadata_index import MetadataIndex
+from rag_studio.model_settings import DEFAULT_INDEX_SETTINGS
+from rag_studio.reranker import CrossEncoderReranker, StagedRetriever
+from rag_studio.segment_log import SegmentLog, write_json_atomically
+from rag_studio.snapshot import (
+    SnapshotDocumentStore,
+    has_array_vector_store,
+    has_snapshot,
+    load_snapshot,
+    read_array_vector_store,
+    remove_array_vector_store,
+    snapshot_dir,
+    write_snapshot,
+)
+from rag_studio.stage_timings import timed_stage
+from rag_studio.streaming_ingest import is_streamable, iter_node_batches
+from rag_studio.vector_stores.ivf_store import IvfFlatVectorStore
+from rag_studio.vector_stores.numpy_store import DEFAULT_PERSIST_NAME, NumpyVectorStore
+from rag_studio.vector_stores.sharded_store import (
+    ShardedVectorStore,
+    existing_shard_dirs,
+)
 
 logger = logging.getLogger(__name__)
 
+# The index's sub-directory of the storage root
+INDEX_DIR_NAME = "index"
+# Records the format of the last base written - a snapshot dir may outlive a
+# switch back to json, say in a repo pushed before it was deleted there
+BASE_MANIFEST_NAME = "base.json"
+
+
+def load_and_chunk_file(file_path):
+    """Read a single file and run the configured transformations over it.
+    Kept at module level so it can be run in worker processes."""
+    reader = SimpleDirectoryReader(input_files=[file_path])
+    docs = reader.load_data()
+    transformations = transformations_from_settings_or_context(Settings, None)
+    return run_transformations(docs, transformations)
+
+
+def load_and_chunk_files(file_paths, max_workers=None):
+    """Parse and chunk the files, spreading the work across processes when there
+    is more than one file. Returns a list with the nodes of each file - or,
+    for a file that couldn't be read, the exception raised reading it."""
+    max_workers = min(len(file_paths), max_workers or os.cpu_count() or 1)
+    if max_workers <= 1:
+        return [
+            outcome(load_and_chunk_file, file_path) for file_path in file_paths
+        ]
+    # Use spawn rather than fork - the parent process may hold GPU state and
+    # threads (web server, vLLM) that are not safe to fork
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(load_and_chunk_file, file_path) for file_path in file_paths
+        ]
+        return [outcome(future.result) for future in futures]
+
 
-def safe_extract_filename(doc_info: RefDocInfo):
-    mdata = doc_info.metadata
-    return mdata.get("file_name")
+def outcome(function, *args):
+    """function(*args), or the exception it raised."""
+    try:
+        return function(*args)
+    except Exception as e:  # pylint: disable=broad-except
+        return e
+
+
+def load_vector_store(index_settings, persist_dir):
+    """Construct the configured vector store, loading any persisted data.
+    Returns None for the default store, which StorageContext handles itself -
+    unless the vectors were persisted by one of our own stores, when they're
+    moved back into it."""
+    vector_store_type = index_settings["vector_store"]
+    shard_count = index_settings["shard_count"]
+    quantization = index_settings["quantization"]
+    if vector_store_type == "simple" and shard_count == 1 and quantization == "none":
+        if not os.path.exists(
+            f"{persist_dir}/{DEFAULT_PERSIST_NAME}.json"
+        ) and has_array_vector_store(persist_dir):
+            logger.info("Migrating array vector store at %s", persist_dir)
+            return read_array_vector_store(persist_dir)
+        return None
+    kwargs = {
+        "quantization": quantization,
+        "rescore": index_settings["quantization_rescore"],
+        "rescore_factor": index_settings["quantization_rescore_factor"],
+    }
+    if vector_store_type in ("simple", "numpy"):
+        # Sharding and quantization need the numpy store, so are taken as
+        # asking for it
+        store_class = NumpyVectorStore
+    elif vector_store_type == "ivf":
+        store_class = IvfFlatVectorStore
+        kwargs.update(
+            nlist=index_settings["ivf_nlist"],
+            nprobe=index_settings["ivf_nprobe"],
+            min_train_size=index_settings["ivf_min_train_size"],
+        )
+    else:
+        raise ValueError(f"Unknown vector store type: {vector_store_type}")
+    if shard_count > 1 or existing_shard_dirs(persist_dir):
+        # Shards persisted before the count was lowered to one are still read
+        # - and kept as a single shard
+        return ShardedVectorStore.from_persist_dir(
+            persist_dir, shard_count, shard_class=store_class, **kwargs
+        )
+    return store_class.from_persist_dir(persist_dir, **kwargs)
 
 
 class RagStore:
-    def __init__(self, storage_root, embed_model=None):
+    def __init__(self, storage_root, embed_model=None, index_settings=None):
         if not storage_root:
             raise ValueError("Storage root cannot be empty")
-        self.storage_path = f"{storage_root}/index"
+        self.storage_path = f"{storage_root}/{INDEX_DIR_NAME}"
+        self.index_settings = index_settings or DEFAULT_INDEX_SETTINGS
+        # Guards the index against concurrent updates, persistence & compaction
+        self.lock = threading.RLock()
+        # Notified when a streaming ingest finishes - the whole index isn't
+        # written while one is part way through a file
+        self._streaming_ingests = 0
+        self._ingest_idle = threading.Condition(self.lock)
+        self._compaction_thread = None
+        # Bumped whenever the contents of the index change
+        self._index_version = 0
+        self._engine_cache = {}
+        # Re-entrant, as cached engines are built around cached retrievers
+        self._engine_cache_lock = threading.RLock()
         self._reinitialize_index(embed_model)
 
+    @property
+    def index_version(self):
+        """Changes whenever the contents of the index change."""
+        return self._index_version
+
+    def _has_base_index(self):
+        return os.path.exists(f"{self.storage_path}/docstore.json")
+
+    def _base_manifest_path(self):
+        return f"{self.storage_path}/{BASE_MANIFEST_NAME}"
+
+    def _loads_snapshot(self):
+        """Whether the snapshot is the current base, whatever the configured
+        storage format. Without a manifest, it's the most recent base when
+        present - and is still used if the json base it records is missing."""
+        if not has_snapshot(self.storage_path):
+            return False
+        if not os.path.exists(self._base_manifest_path()):
+            return True
+        with open(self._base_manifest_path(), encoding="UTF-8") as f:
+            storage_format = json.load(f)["storage_format"]
+        return storage_format == "snapshot" or not self._has_base_index()
+
     def _reinitialize_index(self, embed_model):
-        if os.path.exists(self.storage_path):
+        if self._loads_snapshot():
+            vector_store = load_vector_store(
+                self.index_settings, snapshot_dir(self.storage_path)
+            )
+            self.index = load_snapshot(self.storage_path, vector_store, embed_model)
+        elif self._has_base_index():
+            vector_store = load_vector_store(self.index_settings, self.storage_path)
             logger.info("Loading existing index from storage at %s", self.storage_path)
             # load the existing index
             storage_context = StorageContext.from_defaults(
-                persist_dir=self.storage_path
+                persist_dir=self.storage_path, vector_store=vector_store
             )
             self.index = load_index_from_storage(
                 storage_context, embed_model=embed_model
             )
         else:
             logger.info("Beginning fresh index")
-            self.index = VectorStoreIndex(nodes=[], embed_model=embed_model)
+            vector_store = load_vector_store(self.index_settings, self.storage_path)
+            storage_context = StorageContext.from_defaults(vector_store=vector_store)
+            self.index = VectorStoreIndex(
+                nodes=[], storage_context=storage_context, embed_model=embed_model
+            )
+        self.embed_model = embed_model or Settings.embed_model
+        self.clear_engine_cache()
+        self._segment_log = SegmentLog(self.storage_path)
+        self._segment_log.replay(self.index)
+        # Changes made since the last write_to_storage
+        self._unpersisted_nodes = []
+        self._unpersisted_deletes = []
+        # Segments written by finished streaming ingests, listed at the next
+        # checkpoint
+        self._pending_segments = []
+        # Whether the index holds deletes not yet folded into the base (the
+        # replayed segments may have some)
+        self._deleted_since_base = bool(self._segment_log.segment_names)
+        self._file_manifest = FileManifest(f"{self.storage_path}/file_manifest.json")
+        if not self._file_manifest.exists():
+            self._file_manifest.rebuild_from_docstore(self.index.docstore)
+        self._metadata_index = MetadataIndex(f"{self.storage_path}/metadata_index.json")
+        self._bm25 = None
+        if self.index_settings["retriever"] == "hybrid":
+            self._bm25 = BM25Index(f"{self.storage_path}/bm25.json")
+        # Indexes over node content maintained alongside the vector store
+        self._node_indexes = [
+            node_index
+            for node_index in (self._metadata_index, self._bm25)
+            if node_index is not None
+        ]
+        live_node_ids = set(self.index.index_struct.nodes_dict.values())
+        for node_index in self._node_indexes:
+            # Picks up segments replayed since the node index was last saved
+            node_index.sync(self.index.docstore, live_node_ids)
 
     def change_embedding_model(self, embed_model):
-        if self.index.docstore.docs:
+        if self._file_manifest.files:
             raise ValueError(
                 "Cannot change embedding model after documents have been added"
             )
         self._reinitialize_index(embed_model)
 
+    def _embed_nodes(self, nodes):
+        id_to_embed_map = embed_nodes(nodes, self.embed_model, show_progress=False)
+        for node in nodes:
+            node.embedding = id_to_embed_map[node.node_id]
+
+    def _insert_nodes(self, nodes, track_unpersisted=True):
+        """Insert embedded nodes, tracking them for the next segment write
+        unless they've been written already."""
+        with self.lock:
+            self.index.insert_nodes(nodes)
+            for node_index in self._node_indexes:
+                node_index.add(nodes)
+            if track_unpersisted:
+                self._unpersisted_nodes.extend(nodes)
+            self._index_version += 1
+
+    def _delete_ref_docs(self, ref_doc_ids):
+        with self.lock:
+            for ref_doc_id in ref_doc_ids:
+                ref_doc_info = self.index.docstore.get_ref_doc_info(ref_doc_id)
+                if ref_doc_info is not None:
+                    for node_index in self._node_indexes:
+                        node_index.remove(ref_doc_info.node_ids)
+                self.index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+            deleted = set(ref_doc_ids)
+            self._unpersisted_nodes = [
+                node
+                for node in self._unpersisted_nodes
+                if node.ref_doc_id not in deleted
+            ]
+            self._unpersisted_deletes.extend(ref_doc_ids)
+            self._deleted_since_base = self._deleted_since_base or bool(ref_doc_ids)
+            self._index_version += 1
+
+    def _reuse_embeddings(self, file_name, nodes):
+        """Copy across the embeddings of chunks that are unchanged from the copy
+        of the file already in the index. Returns the number reused."""
+        embeddings_by_hash = {}
+        docstore = self.index.docstore
+        for ref_doc_id in self._file_manifest.ref_doc_ids(file_name):
+            ref_doc_info = docstore.get_ref_doc_info(ref_doc_id)
+            if ref_doc_info is None:
+                continue
+            for old_node in docstore.get_nodes(ref_doc_info.node_ids):
+                embeddings_by_hash[chunk_hash(old_node)] = self.index.vector_store.get(
+                    old_node.node_id
+                )
+        reused = 0
+        for node in nodes:
+            node.embedding = embeddings_by_hash.get(chunk_hash(node))
+            reused += node.embedding is not None
+        return reused
+
+    def _replace_file_nodes(self, file_name, file_path, file_hash, nodes):
+        with self.lock:
+            self._delete_ref_docs(self._file_manifest.ref_doc_ids(file_name))
+            self._insert_nodes(nodes)
+            self._file_manifest.record(
+                file_name,
+                file_hash,
+                ref_doc_ids=sorted({node.ref_doc_id for node in nodes}),
+                node_count=len(nodes),
+                size_bytes=os.path.getsize(file_path),
+            )
+
     def add_document(self, file_path):
-        reader = SimpleDirectoryReader(input_files=[file_path])
-        docs = reader.load_data()
-        transformations = transformations_from_settings_or_context(Settings, None)
-        nodes = run_transformations(docs, transformations)
-        self.index.insert_nodes(nodes)
-        logger.info("Added document %s of %d nodes to the index", file_path, len(nodes))
+        """Add a file to the index, replacing any earlier copy of it. Returns
+        False if the file is unchanged since it was last added."""
+        timings, errors = self._add_documents([file_path])
+        for error in errors.values():
+            raise error
+        return timings["skipped_file_count"] == 0
 
-    def list_files(self):
-        doc_info_by_id = self.index.docstore.get_all_ref_doc_info()
-        node_counts_by_file = {}
-        for doc_info in doc_info_by_id.values():
-            file_name = safe_extract_filename(doc_info)
-            node_counts_by_file[file_name] = node_counts_by_file.get(file_name, 0) + 1
-        return [
-            {"file_name": file_name, "node_count": count}
-            for file_name, count in node_counts_by_file.items()
+    def add_documents(self, file_paths, max_workers=None):
+        """Add many documents in one go. Files are parsed in parallel worker
+        processes, the nodes from all files are embedded together in batches and
+        then inserted into the index in one pass. Returns per-stage timings.
+
+        Files whose content is unchanged since they were last added are skipped,
+        and for changed files only the chunks that differ are re-embedded. A
+        file that can't be read is left out - failed_files in the timings maps
+        its name to the error - and the rest are still added."""
+        timings, _ = self._add_documents(file_paths, max_workers)
+        return timings
+
+    def _add_documents(self, file_paths, max_workers=None):
+        """add_documents, also returning the exception for each failed file."""
+        timings = {"file_count": len(file_paths)}
+        errors = {}
+        start = time.perf_counter()
+        changed_files = {}
+        for file_path in file_paths:
+            file_name = os.path.basename(file_path)
+            file_hash = outcome(hash_file, file_path)
+            if isinstance(file_hash, Exception):
+                errors[file_name] = file_hash
+            elif self._file_manifest.is_unchanged(file_name, file_hash):
+                logger.info("Skipping %s - unchanged since last added", file_path)
+            else:
+                changed_files[file_name] = (file_path, file_hash)
+        timings["skipped_file_count"] = (
+            len(file_paths) - len(changed_files) - len(errors)
+        )
+        timings["hash_seconds"] = time.perf_counter() - start
+
+        # Large files are streamed through on their own, rather than being
+        # read into memory whole alongside the others
+        large_files = {
+            file_name: paths
+            for file_name, paths in changed_files.items()
+            if self._should_stream(paths[0])
+        }
+        timings["streamed_file_count"] = len(large_files)
+        timings["streamed_node_count"] = 0
+        for file_name, (file_path, file_hash) in large_files.items():
+            del changed_files[file_name]
+            node_count = outcome(
+                self._add_document_streaming, file_name, file_path, file_hash
+            )
+            if isinstance(node_count, Exception):
+                errors[file_name] = node_count
+            else:
+                timings["streamed_node_count"] += node_count
+
+        start = time.perf_counter()
+        outcomes = load_and_chunk_files(
+            [file_path for file_path, _ in changed_files.values()],
+            max_workers=max_workers,
+        )
+        for file_name, file_outcome in zip(list(changed_files), outcomes):
+            if isinstance(file_outcome, Exception):
+                errors[file_name] = file_outcome
+                del changed_files[file_name]
+        nodes_by_file = [
+            file_outcome
+            for file_outcome in outcomes
+            if not isinstance(file_outcome, Exception)
         ]
+        nodes = [node for file_nodes in nodes_by_file for node in file_nodes]
+        timings["node_count"] = len(nodes)
+        timings["parse_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        timings["reused_embedding_count"] = sum(
+            self._reuse_embeddings(file_name, file_nodes)
+            for file_name, file_nodes in zip(changed_files, nodes_by_file)
+        )
+        self._embed_nodes(nodes)
+        timings["embed_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for (file_name, (file_path, file_hash)), file_nodes in zip(
+            changed_files.items(), nodes_by_file
+        ):
+            self._replace_file_nodes(file_name, file_path, file_hash, file_nodes)
+        timings["insert_seconds"] = time.perf_counter() - start
+        timings["failed_files"] = {
+            file_name: f"{type(error).__name__}: {error}"
+            for file_name, error in errors.items()
+        }
+        for file_name, error in errors.items():
+            logger.error("Could not add %s to the index: %s", file_name, error)
+        logger.info("Added %d documents to the index: %s", len(file_paths), timings)
+        return timings, errors
+
+    def _should_stream(self, file_path):
+        return is_streamable(file_path) and os.path.getsize(file_path) >= (
+            self.index_settings["streaming_ingest_min_bytes"]
+        )
+
+    def _add_document_streaming(self, file_name, file_path, file_hash):
+        """Read, chunk, embed and insert the file a batch at a time. The earlier
+        copy of the file stays searchable until the new one is fully inserted.
+        Unchanged chunks aren't re-embedded thanks to the embedding cache.
+        Returns the number of nodes added.
+
+        In "segments" persistence mode each batch is written to an unlisted
+        segment as it's inserted, rather than held until the next checkpoint.
+        If anything fails part way through, the batches inserted so far are
+        removed again."""
+        old_ref_doc_ids = self._file_manifest.ref_doc_ids(file_name)
+        write_segments = self.index_settings["persistence"] == "segments"
+        ref_doc_ids = set()
+        segment_names = []
+        node_count = 0
+        start = time.perf_counter()
+        with self.lock:
+            self._streaming_ingests += 1
+        try:
+            for batch_number, (nodes, progress) in enumerate(
+                iter_node_batches(
+                    file_path, self.index_settings["streaming_ingest_batch_size"]
+                )
+            ):
+                self._embed_nodes(nodes)
+                ref_doc_ids.update(node.ref_doc_id for node in nodes)
+                if write_segments:
+                    segment_names.append(self._segment_log.write_pending(nodes))
+                self._insert_nodes(nodes, track_unpersisted=not write_segments)
+                node_count += len(nodes)
+                logger.info(
+                    "Streaming %s: batch %d, %d nodes so far, %.0f%% read, "
+                    "%.1fs elapsed",
+                    file_name,
+                    batch_number + 1,
+                    node_count,
+                    100 * progress,
+                    time.perf_counter() - start,
+                )
+            with self.lock:
+                self._delete_ref_docs(old_ref_doc_ids)
+                self._file_manifest.record(
+                    file_name,
+                    file_hash,
+                    ref_doc_ids=sorted(ref_doc_ids),
+                    node_count=node_count,
+                    size_bytes=os.path.getsize(file_path),
+                )
+                self._pending_segments.extend(segment_names)
+        except Exception:
+            logger.exception("Streaming %s failed - removing its nodes", file_name)
+            with self.lock:
+                self._delete_ref_docs(sorted(ref_doc_ids))
+                self._segment_log.discard(segment_names)
+            raise
+        finally:
+            with self.lock:
+                self._streaming_ingests -= 1
+                self._ingest_idle.notify_all()
+        return node_count
+
+    def delete_file(self, file_name):
+        """Remove a file's nodes from the index. Returns False if the file isn't
+        in the index. The nodes are tombstoned in the vector store straight away
+        and physically removed at the next compaction."""
+        with self.lock:
+            ref_doc_ids = self._file_manifest.ref_doc_ids(file_name)
+            if not self._file_manifest.remove(file_name):
+                return False
+            self._delete_ref_docs(ref_doc_ids)
+        logger.info("Deleted %s from the index", file_name)
+        return True
+
+    def list_files(self):
+        return self._file_manifest.list_files()
 
     def write_to_storage(self):
-        logger.info("Persisting index to storage at %s", self.storage_path)
-        self.index.storage_context.persist(persist_dir=self.storage_path)
+        """Checkpoint the index. In "segments" persistence mode only the nodes
+        added since the last checkpoint are written, otherwise the whole index
+        is rewritten."""
+        with self.lock:
+            if self.index_settings["persistence"] == "segments":
+                logger.info("Appending index segment at %s", self.storage_path)
+                # Before the new segment, which may delete their nodes
+                self._segment_log.publish(self._pending_segments)
+                self._pending_segments = []
+                self._segment_log.append(
+                    self._unpersisted_nodes, self._unpersisted_deletes
+                )
+                self._unpersisted_nodes = []
+                self._unpersisted_deletes = []
+                self._file_manifest.save()
+            else:
+                self.compact()
+
+    def compact(self):
+        """Rewrite the whole index to storage, folding in any segments. Waits
+        for streaming ingests in progress, so a part-ingested file isn't
+        written."""
+        with self.lock:
+            # Releases the lock while waiting, so the ingests can go on
+            self._ingest_idle.wait_for(lambda: not self._streaming_ingests)
+            self._write_base()
+            for node_index in self._node_indexes:
+                node_index.save()
+            self._file_manifest.save()
+            self._segment_log.clear()
+            self._segment_log.discard(self._pending_segments)
+            self._pending_segments = []
+            self._unpersisted_nodes = []
+            self._unpersisted_deletes = []
+            if (
+                self.index_settings["storage_format"] == "snapshot"
+                and self._deleted_since_base
+            ):
+                self._reload_snapshot()
+            self._deleted_since_base = False
+
+    def _reload_snapshot(self):
+        """Swap in the index just written as a snapshot, so the lazy docstore
+        and vector store no longer hold deleted records. The new index is
+        loaded in full before it replaces the old one, and requests already
+        using the old one carry on - its files stay readable."""
+        vector_store = load_vector_store(
+            self.index_settings, snapshot_dir(self.storage_path)
+        )
+        index = load_snapshot(self.storage_path, vector_store, self.embed_model)
+        with self.lock:
+            self.index = index
+            self._index_version += 1
+            self.clear_engine_cache()
+
+    def _write_base(self):
+        storage_format = self.index_settings["storage_format"]
+        if storage_format == "snapshot":
+            logger.info("Writing index snapshot at %s", self.storage_path)
+            write_snapshot(self.index, self.storage_path)
+        else:
+            logger.info("Persisting index to storage at %s", self.storage_path)
+            self.index.storage_context.persist(persist_dir=self.storage_path)
+            if isinstance(self.index.vector_store, SimpleVectorStore):
+                # Arrays left by one of our own stores we migrated from are
+                # now stale
+                remove_array_vector_store(self.storage_path)
+            docstore = self.index.storage_context.docstore
+            if isinstance(docstore, SnapshotDocumentStore):
+                # Loaded from a snapshot, which StorageContext.persist doesn't
+                # write out
+                docstore.to_simple_document_store().persist(
+                    f"{self.storage_path}/docstore.json"
+                )
+        write_json_atomically(
+            self._base_manifest_path(), {"storage_format": storage_format}
+        )
+        if storage_format != "snapshot":
+            # A snapshot left from before is now stale
+            shutil.rmtree(snapshot_dir(self.storage_path), ignore_errors=True)
+
+    def tombstone_ratio(self):
+        """The fraction of vector store rows that are deleted but still held in
+        memory and scanned at query time."""
+        tombstones = getattr(self.index.vector_store, "tombstone_count", 0)
+        total = len(self.index.index_struct.nodes_dict) + tombstones
+        return tombstones / total if total else 0.0
+
+    def needs_compaction(self):
+        return (
+            len(self._segment_log.segment_names)
+            >= self.index_settings["segment_compaction_threshold"]
+            or self.tombstone_ratio()
+            >= self.index_settings["tombstone_compaction_ratio"]
+        )
+
+    def compact_in_background(self, on_complete=None):
+        """Start compacting on a background thread if enough segments or
+        tombstones have built up. on_complete is called once it's done, after
+        the lock is released - so it can take its time (say, uploading the
+        index) without holding up other updates."""
+        with self.lock:
+            if not self.needs_compaction():
+                return None
+            if self._compaction_thread and self._compaction_thread.is_alive():
+                return None
+
+            def run():
+                self.compact()
+                if on_complete:
+                    on_complete()
+
+            self._compaction_thread = threading.Thread(
+                target=run, name="index-compaction", daemon=True
+            )
+            self._compaction_thread.start()
+            return self._compaction_thread
+
+    def clear_engine_cache(self):
+        """Drop all cached engines - which also releases their references to
+        the LLM, so must be called before an LLM is replaced."""
+        with self._engine_cache_lock:
+            self._engine_cache = {}
+
+    def _cached_engine_part(self, kind, llm, prompts, build):
+        """Engines (and parts of them) are cached by the LLM they use, the
+        prompts they were built with and the version of the index."""
+        key = (kind, tuple(sorted(prompts.items())) if prompts else None)
+        with self._engine_cache_lock:
+            entry = self._engine_cache.get(key)
+            if entry:
+                cached_llm, index_version, part = entry
+                if cached_llm is llm and index_version == self._index_version:
+                    return part
+            part = build()
+            self._engine_cache[key] = (llm, self._index_version, part)
+            return part
+
+    def _vector_retriever(self, top_k, node_ids=None):
+        """Built directly rather than with as_retriever, which restricts the
+        query to every node id in the index - making the vector store score
+        them one by one instead of searching its own index."""
+        return VectorIndexRetriever(
+            self.index,
+            similarity_top_k=top_k,
+            node_ids=node_ids,
+            callback_manager=Settings.callback_manager,
+        )
 
-    def make_query_engine(self, llm, query_prompts):
+    def _build_base_retriever(self, top_k, node_ids=None):
+        settings = self.index_settings
+        if settings["retriever"] == "vector":
+            return self._vector_retriever(top_k, node_ids)
+        if settings["retriever"] == "hybrid":
+            return HybridRetriever(
+                self._vector_retriever(
+                    max(top_k, settings["hybrid_candidate_k"]), node_ids
+                ),
+                self._bm25,
+                self.index.docstore,
+                similarity_top_k=top_k,
+                candidate_k=max(top_k, settings["hybrid_candidate_k"]),
+                rrf_k=settings["hybrid_rrf_k"],
+                node_ids=node_ids,
+            )
+        raise ValueError(f"Unknown retriever type: {settings['retriever']}")
+
+    def _build_retriever(self, node_ids=None):
+        """node_ids restricts retrieval to those nodes - only their vectors are
+        scored."""
+        settings = self.index_settings
+        if not settings["rerank_model"]:
+            return StagedRetriever(
+                self._build_base_retriever(settings["similarity_top_k"], node_ids),
+                None,
+                embed_model=self.embed_model,
+            )
+        reranker = CrossEncoderReranker(
+            settings["rerank_model"],
+            top_n=settings["similarity_top_k"],
+            score_threshold=settings["rerank_score_threshold"],
+        )
+        return StagedRetriever(
+            self._build_base_retriever(settings["rerank_candidate_k"], node_ids),
+            reranker,
+            embed_model=self.embed_model,
+        )
+
+    def _cached_retriever(self):
+        return self._cached_engine_part("retriever", None, None, self._build_retriever)
+
+    def _retriever_for(self, filters):
+        """Filtered retrievers are built per call - they're cheap to build and
+        there are too many possible filters to cache."""
+        if not filters:
+            return self._cached_retriever()
+        node_ids = self._metadata_index.match(filters)
+        logger.debug("Filters %s match %d nodes", filters, len(node_ids))
+        return self._build_retriever(node_ids=sorted(node_ids))
+
+    def _build_query_engine(self, llm, query_prompts, retriever, streaming=False):
         kwargs = {}
         if query_prompts:
             kwargs["text_qa_template"] = PromptTemplate(
@@ -82,15 +702,103 @@ class RagStore:
             kwargs["refine_template"] = PromptTemplate(
                 query_prompts["refine_template"], prompt_type=PromptType.REFINE
             )
-        return self.index.as_query_engine(llm=llm, **kwargs)
+        return RetrieverQueryEngine.from_args(
+            retriever, llm=llm, streaming=streaming, **kwargs
+        )
+
+    def make_query_engine(self, llm, query_prompts, filters=None, streaming=False):
+        """filters maps metadata keys (e.g. file_name) to a value or list of
+        accepted values, restricting retrieval to the matching chunks.
+        Streaming engines return a response whose response_gen yields the
+        answer as it's generated."""
+        if filters:
+            return self._build_query_engine(
+                llm, query_prompts, self._retriever_for(filters), streaming
+            )
+        return self._cached_engine_part(
+            "streaming_query_engine" if streaming else "query_engine",
+            llm,
+            query_prompts,
+            lambda: self._build_query_engine(
+                llm, query_prompts, self._cached_retriever(), streaming
+            ),
+        )
+
+    def retrieve_batch(self, query_strs, embeddings, filters=None):
+        """Retrieves for several queries (whose embeddings are already made) at
+        once. Plain vector retrieval runs as one batched vector store query;
+        with hybrid retrieval or a reranker, each query goes through the usual
+        retriever in turn."""
+        settings = self.index_settings
+        vector_store = self.index.vector_store
+        if (
+            settings["retriever"] != "vector"
+            or settings["rerank_model"]
+            or not hasattr(vector_store, "query_batch")
+        ):
+            retriever = self._retriever_for(filters)
+            return [
+                retriever.retrieve(
+                    QueryBundle(query_str=query_str, embedding=embedding)
+                )
+                for query_str, embedding in zip(query_strs, embeddings)
+            ]
+        node_ids = sorted(self._metadata_index.match(filters)) if filters else None
+        with timed_stage("retrieve"):
+            results = vector_store.query_batch(
+                [
+                    VectorStoreQuery(
+                        query_embedding=embedding,
+                        similarity_top_k=settings["similarity_top_k"],
+                        node_ids=node_ids,
+                    )
+                    for embedding in embeddings
+                ]
+            )
+            docstore = self.index.docstore
+            return [
+                [
+                    NodeWithScore(node=docstore.get_node(node_id), score=similarity)
+                    for node_id, similarity in zip(result.ids, result.similarities)
+                ]
+                for result in results
+            ]
+
+    def qa_prompt(self, llm, query_prompts, query_str, nodes):
+        """The prompt a query engine would send the LLM to answer query_str
+        from the retrieved nodes. Rather than refining over several prompts
+        when the nodes don't fit in the LLM's context window, each is truncated
+        so that they all fit in one."""
+        template = (
+            PromptTemplate(
+                query_prompts["text_qa_template"],
+                prompt_type=PromptType.QUESTION_ANSWER,
+            )
+            if query_prompts
+            else DEFAULT_TEXT_QA_PROMPT
+        )
+        template = template.partial_format(query_str=query_str)
+        # Count tokens as the LLM will, where we can
+        tokenizer = getattr(llm, "tokenizer", None)
+        prompt_helper = PromptHelper.from_llm_metadata(
+            llm.metadata, tokenizer=tokenizer.encode if tokenizer else None
+        )
+        text_chunks = [
+            node.node.get_content(metadata_mode=MetadataMode.LLM) for node in nodes
+        ]
+        if text_chunks:
+            text_chunks = prompt_helper.truncate(template, text_chunks)
+        return template.format(context_str="\n\n".join(text_chunks))
 
-    def make_chat_engine(self, llm, chat_prompts):
+    def make_chat_engine(self, llm, chat_prompts, filters=None):
+        """Chat engines hold the conversation memory, so a new one is made per
+        call, but it's built around a cached retriever (unless filtered)."""
         kwargs = {}
         if chat_prompts:
             kwargs["context_prompt"] = chat_prompts["context_prompt"]
             kwargs["condense_prompt"] = chat_prompts["condense_prompt"]
-        return self.index.as_chat_engine(
-            chat_mode="condense_plus_context", llm=llm, **kwargs
+        return CondensePlusContextChatEngine.from_defaults(
+            retriever=self._retriever_for(filters), llm=llm, **kwargs
         )
 
     def get_nodes(self):
@@ -0,0 +1,95 @@
+"""Cross-encoder reranking of retrieved candidates.
+
+The retriever over-fetches, and a small cross-encoder scores every
+(query, chunk) pair in a single batched forward pass on the CPU. Only the best
+few chunks, above a score threshold, go on to the LLM - so prompts are shorter
+and the refine synthesizer makes fewer calls."""
+
+import asyncio
+from functools import lru_cache
+import logging
+from typing import List, Optional
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+
+from rag_studio.stage_timings import timed_stage
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def load_cross_encoder(model_name):
+    """Loaded once per process - every engine that reranks shares it."""
+    from sentence_transformers import CrossEncoder
+
+    logger.info("Loading cross-encoder %s", model_name)
+    return CrossEncoder(model_name, device="cpu")
+
+
+class CrossEncoderReranker:
+    def __init__(self, model_name, top_n, score_threshold=None):
+        self.model = load_cross_encoder(model_name)
+        self.top_n = top_n
+        self.score_threshold = score_threshold
+
+    def rerank(self, query_str, candidates: List[NodeWithScore]) -> List[NodeWithScore]:
+        if not candidates:
+            return []
+        pairs = [
+            (query_str, candidate.node.get_content(metadata_mode=MetadataMode.EMBED))
+            for candidate in candidates
+        ]
+        scores = self.model.predict(
+            pairs, batch_size=len(pairs), show_progress_bar=False
+        )
+        ranked = sorted(
+            zip(candidates, scores), key=lambda item: item[1], reverse=True
+        )[: self.top_n]
+        return [
+            NodeWithScore(node=candidate.node, score=float(score))
+            for candidate, score in ranked
+            if self.score_threshold is None or score >= self.score_threshold
+        ]
+
+
+class StagedRetriever(BaseRetriever):
+    """Wraps a retriever with an optional rerank stage (in which case the
+    retriever should be set up to over-fetch), timing each stage. If given the
+    embed_model, async retrieval embeds the query with its async API first."""
+
+    def __init__(
+        self,
+        retriever,
+        reranker: Optional[CrossEncoderReranker],
+        embed_model=None,
+        **kwargs,
+    ):
+        self._retriever = retriever
+        self._reranker = reranker
+        self._embed_model = embed_model
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with timed_stage("retrieve"):
+            candidates = self._retriever.retrieve(query_bundle)
+        if self._reranker is None:
+            return candidates
+        with timed_stage("rerank"):
+            results = self._reranker.rerank(query_bundle.query_str, candidates)
+        logger.debug(
+            "Reranking kept %d of %d candidates", len(results), len(candidates)
+        )
+        return results
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self._embed_model is not None and query_bundle.embedding is None:
+            # Lets concurrent requests' queries be embedded as a batch
+            with timed_stage("embed_query"):
+                query_bundle.embedding = await self._embed_model.aget_query_embedding(
+                    query_bundle.query_str
+                )
+        # Scoring and reranking (and embedding the query, if not done above)
+        # are blocking, so run them off the event loop (stage timings still
+        # reach the caller, as the context is copied to the thread)
+        return await asyncio.to_thread(self._retrieve, query_bundle)
@@ -0,0 +1,131 @@
+"""Append-only persistence of index updates.
+
+Rather than rewriting the whole docstore and vector store after every upload,
+the nodes added since the last checkpoint (with their embeddings) are written
+to a new segment file. A manifest lists the live segments, in order. Loading
+replays the segments on top of the last full (base) persist of the index, and
+compaction folds them back into the base."""
+
+import json
+import logging
+import os
+
+import numpy as np
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+
+logger = logging.getLogger(__name__)
+
+
+def write_json_atomically(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class SegmentLog:
+    def __init__(self, storage_path):
+        self.segments_path = f"{storage_path}/segments"
+        self.manifest_path = f"{self.segments_path}/manifest.json"
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {"segments": [], "next_segment": 0}
+        with open(self.manifest_path, "r", encoding="UTF-8") as f:
+            return json.load(f)
+
+    @property
+    def segment_names(self):
+        return list(self.manifest["segments"])
+
+    def _segment_paths(self, name):
+        base = f"{self.segments_path}/{name}"
+        return f"{base}.json", f"{base}.npy"
+
+    def append(self, nodes, deleted_ref_doc_ids=()):
+        """Write the nodes (which must already have embeddings) and the ids of
+        any ref docs deleted since the last segment as a new segment. Deletes are
+        applied before the nodes are inserted on replay, so the nodes must not
+        include any belonging to the deleted ref docs."""
+        if not nodes and not deleted_ref_doc_ids:
+            return None
+        name = self.write_pending(nodes, deleted_ref_doc_ids)
+        self.publish([name])
+        return name
+
+    def write_pending(self, nodes, deleted_ref_doc_ids=()):
+        """Write a segment without listing it, so it isn't replayed until it's
+        published - or is thrown away with discard."""
+        os.makedirs(self.segments_path, exist_ok=True)
+        name = f"segment-{self.manifest['next_segment']:08d}"
+        json_path, embeddings_path = self._segment_paths(name)
+        embeddings = np.asarray([node.embedding for node in nodes], dtype=np.float32)
+        records = [doc_to_json(node.copy(update={"embedding": None})) for node in nodes]
+        np.save(embeddings_path, embeddings)
+        write_json_atomically(
+            json_path,
+            {"nodes": records, "deleted_ref_doc_ids": list(deleted_ref_doc_ids)},
+        )
+        # Numbers aren't reused, even if the segment is never published
+        self.manifest = {
+            "segments": self.manifest["segments"],
+            "next_segment": self.manifest["next_segment"] + 1,
+        }
+        write_json_atomically(self.manifest_path, self.manifest)
+        logger.info("Wrote index segment %s with %d nodes", name, len(nodes))
+        return name
+
+    def publish(self, names):
+        """List written segments, in order, after those already listed."""
+        if not names:
+            return
+        # Only list segments once their files are fully written
+        self.manifest = {
+            "segments": self.manifest["segments"] + list(names),
+            "next_segment": self.manifest["next_segment"],
+        }
+        write_json_atomically(self.manifest_path, self.manifest)
+
+    def discard(self, names):
+        """Delete the files of unlisted segments."""
+        for name in names:
+            for path in self._segment_paths(name):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def read(self, name):
+        """Returns the nodes and deleted ref doc ids recorded in a segment."""
+        json_path, embeddings_path = self._segment_paths(name)
+        with open(json_path, "r", encoding="UTF-8") as f:
+            segment = json.load(f)
+        embeddings = np.load(embeddings_path)
+        nodes = [json_to_doc(record) for record in segment["nodes"]]
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding.tolist()
+        return nodes, segment.get("deleted_ref_doc_ids", [])
+
+    def replay(self, index):
+        """Apply the live segments to an index loaded from the base persist.
+        Nodes the index already holds are skipped, so replaying segments that
+        were already folded into the base (say after a crash mid-compaction)
+        does no harm."""
+        for name in self.segment_names:
+            nodes, deleted_ref_doc_ids = self.read(name)
+            for ref_doc_id in deleted_ref_doc_ids:
+                index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+            nodes = [
+                node
+                for node in nodes
+                if not index.docstore.document_exists(node.node_id)
+            ]
+            logger.info("Replaying %d nodes from index segment %s", len(nodes), name)
+            index.insert_nodes(nodes)
+
+    def clear(self):
+        """Drop all segments - called once they have been folded into the base."""
+        names = self.segment_names
+        self.manifest = {"segments": [], "next_segment": self.manifest["next_segment"]}
+        if os.path.exists(self.segments_path):
+            write_json_atomically(self.manifest_path, self.manifest)
+        self.discard(names)
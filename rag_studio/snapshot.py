@@ -0,0 +1,369 @@
+"""Binary snapshot format for a persisted index.
+
+The JSON persist format has to be parsed in full, and every node rebuilt as a
+Python object, before the index can be used. A snapshot instead stores:
+
+* nodes.bin - every docstore node record, back to back
+* nodes.offsets.npy - where each record starts and ends in nodes.bin
+* nodes.index.json - node ids, with their ref doc ids and hashes
+* ref_doc_info.json - the docstore's ref doc -> node ids mapping
+* index_store.json - the (small) index struct
+* the vector store - as raw float32 arrays
+
+Loading only reads the ids and offsets and memory-maps the rest. A node record
+is parsed when something asks the docstore for it - which for retrieval is only
+the top-k nodes of each query. Our own vector stores memory-map their arrays
+too, but the default SimpleVectorStore only holds Python lists, so its vectors
+are still converted on load (though without parsing any JSON)."""
+
+import json
+import logging
+import os
+import shutil
+from typing import Dict, List, Optional
+
+import numpy as np
+from llama_index.core import StorageContext, load_index_from_storage
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.core.storage.docstore.utils import doc_to_json
+from llama_index.core.storage.index_store import SimpleIndexStore
+from llama_index.core.storage.kvstore import SimpleKVStore
+from llama_index.core.storage.kvstore.types import DEFAULT_COLLECTION, BaseKVStore
+from llama_index.core.vector_stores.simple import (
+    SimpleVectorStore,
+    SimpleVectorStoreData,
+)
+
+from rag_studio.segment_log import write_json_atomically
+from rag_studio.vector_stores.numpy_store import (
+    DEFAULT_PERSIST_NAME,
+    NumpyVectorStore,
+    save_array,
+)
+from rag_studio.vector_stores.sharded_store import (
+    SHARD_MANIFEST_NAME,
+    existing_shard_dirs,
+)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR_NAME = "snapshot"
+# Written last, so a snapshot dir without it is incomplete
+SNAPSHOT_MARKER_NAME = "snapshot.json"
+# How the default vector store is written - our own stores persist themselves
+SIMPLE_EMBEDDINGS_NAME = "embeddings"
+
+# The collections that KVDocumentStore keeps in its kvstore (default namespace)
+NODE_COLLECTION = "docstore/data"
+REF_DOC_COLLECTION = "docstore/ref_doc_info"
+METADATA_COLLECTION = "docstore/metadata"
+
+# Files written by StorageContext.persist, superseded once a snapshot exists
+JSON_BASE_FILE_NAMES = [
+    "docstore.json",
+    "index_store.json",
+    "graph_store.json",
+    "property_graph_store.json",
+    "image__vector_store.json",
+]
+
+
+def snapshot_dir(storage_path):
+    return f"{storage_path}/{SNAPSHOT_DIR_NAME}"
+
+
+def has_snapshot(storage_path):
+    return os.path.exists(f"{snapshot_dir(storage_path)}/{SNAPSHOT_MARKER_NAME}")
+
+
+def open_bytes(path):
+    # np.memmap refuses to map an empty file
+    if os.path.getsize(path) == 0:
+        return b""
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+
+class SnapshotKVStore(BaseKVStore):
+    """Read-through kvstore over a snapshot. Node records are parsed from the
+    memory-mapped snapshot on demand, while writes and deletes made after
+    loading are kept in memory on top of it."""
+
+    def __init__(self, path):
+        with open(f"{path}/nodes.index.json", "r", encoding="UTF-8") as f:
+            node_index = json.load(f)
+        with open(f"{path}/ref_doc_info.json", "r", encoding="UTF-8") as f:
+            ref_doc_info = json.load(f)
+        self._ids = node_index["ids"]
+        self._ref_doc_ids = node_index["ref_doc_ids"]
+        self._doc_hashes = node_index["doc_hashes"]
+        self._row_by_id = {node_id: row for row, node_id in enumerate(self._ids)}
+        self._offsets = np.load(f"{path}/nodes.offsets.npy", mmap_mode="r")
+        self._blob = open_bytes(f"{path}/nodes.bin")
+        self._overlay: Dict[str, Dict[str, dict]] = {REF_DOC_COLLECTION: ref_doc_info}
+        # Snapshot rows deleted since loading
+        self._deleted = set()
+
+    def _snapshot_row(self, key, collection):
+        if collection not in (NODE_COLLECTION, METADATA_COLLECTION):
+            return None
+        if key in self._deleted:
+            return None
+        return self._row_by_id.get(key)
+
+    def _read_snapshot(self, row, collection):
+        if collection == METADATA_COLLECTION:
+            metadata = {"doc_hash": self._doc_hashes[row]}
+            if self._ref_doc_ids[row] is not None:
+                metadata["ref_doc_id"] = self._ref_doc_ids[row]
+            return metadata
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return json.loads(bytes(self._blob[start:end]))
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self._overlay.setdefault(collection, {})[key] = val
+
+    async def aput(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put(key, val, collection)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        overlay = self._overlay.get(collection, {})
+        if key in overlay:
+            return overlay[key]
+        row = self._snapshot_row(key, collection)
+        return None if row is None else self._read_snapshot(row, collection)
+
+    async def aget(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return self.get(key, collection)
+
+    def contains(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        """Whether get would find key - without parsing its record."""
+        if key in self._overlay.get(collection, {}):
+            return True
+        return self._snapshot_row(key, collection) is not None
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        """Materialises the whole collection - avoid on the query path."""
+        result = {}
+        if collection in (NODE_COLLECTION, METADATA_COLLECTION):
+            for row, key in enumerate(self._ids):
+                if key not in self._deleted:
+                    result[key] = self._read_snapshot(row, collection)
+        result.update(self._overlay.get(collection, {}))
+        return result
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return self.get_all(collection)
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        deleted = self._overlay.get(collection, {}).pop(key, None) is not None
+        if self._snapshot_row(key, collection) is not None:
+            # The node record and its metadata are deleted together
+            self._deleted.add(key)
+            deleted = True
+        return deleted
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.delete(key, collection)
+
+
+class SnapshotDocumentStore(KVDocumentStore):
+    """Answers document_exists from the snapshot's ids, where KVDocumentStore
+    would fetch (and so parse) the whole node record."""
+
+    def document_exists(self, doc_id: str) -> bool:
+        return self._kvstore.contains(doc_id, self._node_collection)
+
+    async def adocument_exists(self, doc_id: str) -> bool:
+        return self.document_exists(doc_id)
+
+    def to_simple_document_store(self):
+        """The same records in a SimpleDocumentStore, which can be persisted as
+        JSON - parses every node."""
+        kvstore = self._kvstore
+        collections = {NODE_COLLECTION, METADATA_COLLECTION, *kvstore._overlay}
+        return SimpleDocumentStore(
+            SimpleKVStore(
+                {collection: kvstore.get_all(collection) for collection in collections}
+            )
+        )
+
+
+def write_vector_store(vector_store, path):
+    """Our own vector stores already persist as raw arrays - the default JSON
+    store is converted."""
+    if not isinstance(vector_store, SimpleVectorStore):
+        vector_store.persist(f"{path}/default__vector_store.json")
+        return
+    data = vector_store.data
+    ids = list(data.embedding_dict.keys())
+    embeddings = np.asarray([data.embedding_dict[i] for i in ids], dtype=np.float32)
+    save_array(f"{path}/{SIMPLE_EMBEDDINGS_NAME}.npy", embeddings)
+    with open(f"{path}/{SIMPLE_EMBEDDINGS_NAME}.ids.json", "w", encoding="UTF-8") as f:
+        json.dump(
+            {
+                "ids": ids,
+                "ref_doc_ids": [data.text_id_to_ref_doc_id.get(i) for i in ids],
+            },
+            f,
+        )
+
+
+def has_simple_vector_store(path):
+    return os.path.exists(f"{path}/{SIMPLE_EMBEDDINGS_NAME}.npy")
+
+
+def read_simple_vector_store(path):
+    embeddings = np.load(f"{path}/{SIMPLE_EMBEDDINGS_NAME}.npy")
+    with open(f"{path}/{SIMPLE_EMBEDDINGS_NAME}.ids.json", "r", encoding="UTF-8") as f:
+        id_data = json.load(f)
+    return SimpleVectorStore(
+        data=SimpleVectorStoreData(
+            # One tolist of the whole matrix, rather than one per vector
+            embedding_dict=dict(zip(id_data["ids"], embeddings.tolist())),
+            text_id_to_ref_doc_id={
+                node_id: ref_doc_id
+                for node_id, ref_doc_id in zip(id_data["ids"], id_data["ref_doc_ids"])
+                if ref_doc_id is not None
+            },
+        )
+    )
+
+
+def read_array_vector_store(path):
+    """A SimpleVectorStore of the vectors one of our own stores (sharded or
+    not) persisted in path. Their embeddings come back normalised, which
+    doesn't change any cosine similarity."""
+    data = SimpleVectorStoreData()
+    for store_dir in existing_shard_dirs(path) or [path]:
+        store = NumpyVectorStore.from_persist_dir(store_dir)
+        store_data = store.to_simple_vector_store().data
+        data.embedding_dict.update(store_data.embedding_dict)
+        data.text_id_to_ref_doc_id.update(store_data.text_id_to_ref_doc_id)
+    return SimpleVectorStore(data=data)
+
+
+def has_array_vector_store(path):
+    """Whether one of our own stores persisted its vectors in path."""
+    return os.path.exists(f"{path}/{DEFAULT_PERSIST_NAME}.npy") or bool(
+        existing_shard_dirs(path)
+    )
+
+
+def remove_array_vector_store(path):
+    """Remove what one of our own stores persisted in path, once the default
+    store's JSON has been written in its place."""
+    for file_name in os.listdir(path):
+        file_path = os.path.join(path, file_name)
+        if file_name == SHARD_MANIFEST_NAME or (
+            file_name.startswith(f"{DEFAULT_PERSIST_NAME}.")
+            and file_name != f"{DEFAULT_PERSIST_NAME}.json"
+        ):
+            os.remove(file_path)
+        elif file_name.startswith("shard-") and os.path.isdir(file_path):
+            shutil.rmtree(file_path)
+
+
+def snapshot_vector_store(path, vector_store):
+    """The vector store to load the snapshot with. vector_store is the
+    configured store loaded from the snapshot dir, or None for the default
+    store. If vector_store was switched between the default store and one of
+    ours since the snapshot was written, the vectors are moved across."""
+    if not has_simple_vector_store(path):
+        return read_array_vector_store(path) if vector_store is None else vector_store
+    simple_store = read_simple_vector_store(path)
+    if vector_store is None:
+        return simple_store
+    # Found no files of its own, so is empty
+    data = simple_store.data
+    nodes = []
+    for node_id, embedding in data.embedding_dict.items():
+        node = TextNode(id_=node_id, embedding=embedding)
+        ref_doc_id = data.text_id_to_ref_doc_id.get(node_id)
+        if ref_doc_id is not None:
+            node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(
+                node_id=ref_doc_id
+            )
+        nodes.append(node)
+    vector_store.add(nodes)
+    return vector_store
+
+
+def write_snapshot(index, storage_path):
+    """Write the index as a snapshot, replacing any previous snapshot and any
+    JSON persisted copy of the index."""
+    final_path = snapshot_dir(storage_path)
+    tmp_path = f"{final_path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    docstore = index.docstore
+    ids: List[str] = list(index.index_struct.nodes_dict.values())
+    ref_doc_ids: List[Optional[str]] = []
+    doc_hashes: List[str] = []
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    with open(f"{tmp_path}/nodes.bin", "wb") as f:
+        # One node at a time, so a lazily loaded docstore isn't materialised
+        for row, node_id in enumerate(ids):
+            node = docstore.get_node(node_id)
+            record = json.dumps(doc_to_json(node)).encode("UTF-8")
+            f.write(record)
+            offsets[row + 1] = offsets[row] + len(record)
+            ref_doc_ids.append(node.ref_doc_id)
+            doc_hashes.append(node.hash)
+    np.save(f"{tmp_path}/nodes.offsets.npy", offsets)
+    with open(f"{tmp_path}/nodes.index.json", "w", encoding="UTF-8") as f:
+        json.dump(
+            {"ids": ids, "ref_doc_ids": ref_doc_ids, "doc_hashes": doc_hashes}, f
+        )
+    with open(f"{tmp_path}/ref_doc_info.json", "w", encoding="UTF-8") as f:
+        json.dump(
+            {
+                ref_doc_id: {"node_ids": info.node_ids, "metadata": info.metadata}
+                for ref_doc_id, info in docstore.get_all_ref_doc_info().items()
+            },
+            f,
+        )
+    index.storage_context.index_store.persist(f"{tmp_path}/index_store.json")
+    write_vector_store(index.vector_store, tmp_path)
+    write_json_atomically(
+        f"{tmp_path}/{SNAPSHOT_MARKER_NAME}", {"format_version": 1, "node_count": len(ids)}
+    )
+
+    # Swap the new snapshot in - anything still memory-mapped from the old one
+    # stays readable until it is closed
+    old_path = f"{final_path}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(final_path):
+        os.rename(final_path, old_path)
+    os.rename(tmp_path, final_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    remove_json_base(storage_path)
+    logger.info("Wrote index snapshot of %d nodes to %s", len(ids), final_path)
+
+
+def remove_json_base(storage_path):
+    for file_name in os.listdir(storage_path):
+        path = os.path.join(storage_path, file_name)
+        if (
+            file_name in JSON_BASE_FILE_NAMES
+            or file_name == SHARD_MANIFEST_NAME
+            or file_name.startswith("default__vector_store")
+        ):
+            os.remove(path)
+        elif file_name.startswith("shard-") and os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+def load_snapshot(storage_path, vector_store, embed_model):
+    """Load an index from its snapshot. vector_store should have been loaded
+    from the snapshot dir - or be None for the default (JSON) store."""
+    path = snapshot_dir(storage_path)
+    logger.info("Loading index snapshot from %s", path)
+    storage_context = StorageContext.from_defaults(
+        docstore=SnapshotDocumentStore(SnapshotKVStore(path)),
+        index_store=SimpleIndexStore.from_persist_path(f"{path}/index_store.json"),
+        vector_store=snapshot_vector_store(path, vector_store),
+    )
+    return load_index_from_storage(storage_context, embed_model=embed_model)
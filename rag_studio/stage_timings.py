@@ -0,0 +1,42 @@
+"""Per-request latency breakdown by pipeline stage.
+
+A request handler wraps its work in collect_stage_timings(), and the pipeline
+stages (retrieval, rerank, ...) record into whatever collection is active for
+the current context. Outside of a collection, timings are only logged."""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_current_timings: ContextVar = ContextVar("stage_timings", default=None)
+
+
+@contextmanager
+def collect_stage_timings():
+    """Yields a dict that fills with {stage name: seconds} as stages run, plus
+    the overall total once the block exits."""
+    timings = {}
+    token = _current_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        timings["total_seconds"] = time.perf_counter() - start
+        _current_timings.reset(token)
+
+
+@contextmanager
+def timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        logger.debug("Stage %s took %.3fs", name, seconds)
+        timings = _current_timings.get()
+        if timings is not None:
+            key = f"{name}_seconds"
+            timings[key] = timings.get(key, 0.0) + seconds
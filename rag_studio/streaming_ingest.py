@@ -0,0 +1,95 @@
+"""Incremental reading and chunking of very large files.
+
+SimpleDirectoryReader reads a whole file into memory, and the chunks for all
+of it are built before any are embedded. Here a file is read a block (or PDF
+page) at a time, each block is run through the transformations as its own
+document, and the nodes come out in bounded batches - so memory use depends on
+the block and batch sizes, not on the size of the file."""
+
+import logging
+import os
+
+from llama_index.core import Document, Settings
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.readers.file.base import default_file_metadata_func
+from llama_index.core.settings import transformations_from_settings_or_context
+
+logger = logging.getLogger(__name__)
+
+TEXT_EXTENSIONS = {".txt", ".log", ".md", ".csv", ".tsv", ".json", ".jsonl", ".xml"}
+STREAMABLE_EXTENSIONS = TEXT_EXTENSIONS | {".pdf"}
+# Characters of text per document block
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Matches what SimpleDirectoryReader keeps out of the embedded and LLM text
+EXCLUDED_FILE_METADATA_KEYS = [
+    "file_name",
+    "file_type",
+    "file_size",
+    "creation_date",
+    "last_modified_date",
+    "last_accessed_date",
+]
+
+
+def is_streamable(file_path):
+    return os.path.splitext(file_path)[1].lower() in STREAMABLE_EXTENSIONS
+
+
+def make_document(text, metadata):
+    return Document(
+        text=text,
+        metadata=dict(metadata),
+        excluded_embed_metadata_keys=list(EXCLUDED_FILE_METADATA_KEYS),
+        excluded_llm_metadata_keys=list(EXCLUDED_FILE_METADATA_KEYS),
+    )
+
+
+def iter_text_documents(file_path, metadata, block_size):
+    file_size = max(os.path.getsize(file_path), 1)
+    bytes_read = 0
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return
+            # Finish the current line, so a block boundary doesn't split one
+            block += f.readline(block_size)
+            bytes_read += len(block.encode("utf-8"))
+            yield make_document(block, metadata), min(bytes_read / file_size, 1.0)
+
+
+def iter_pdf_documents(file_path, metadata):
+    from pypdf import PdfReader
+
+    # Pages are parsed as they are accessed
+    reader = PdfReader(file_path)
+    page_count = len(reader.pages)
+    for page_number, page in enumerate(reader.pages):
+        page_metadata = {**metadata, "page_label": reader.page_labels[page_number]}
+        yield make_document(page.extract_text(), page_metadata), (
+            (page_number + 1) / page_count
+        )
+
+
+def iter_documents(file_path, block_size=DEFAULT_BLOCK_SIZE):
+    """Yields (document, fraction of the file read so far)."""
+    metadata = default_file_metadata_func(file_path)
+    if file_path.lower().endswith(".pdf"):
+        return iter_pdf_documents(file_path, metadata)
+    return iter_text_documents(file_path, metadata, block_size)
+
+
+def iter_node_batches(file_path, batch_size, block_size=DEFAULT_BLOCK_SIZE):
+    """Yields (nodes, fraction of the file read so far), with at most
+    batch_size nodes per batch."""
+    transformations = transformations_from_settings_or_context(Settings, None)
+    pending = []
+    progress = 0.0
+    for document, progress in iter_documents(file_path, block_size):
+        pending.extend(run_transformations([document], transformations))
+        while len(pending) >= batch_size:
+            yield pending[:batch_size], progress
+            pending = pending[batch_size:]
+    if pending:
+        yield pending, progress
@@ -3,6 +3,8 @@ import json
 import os
 import shutil
 import sys
+import threading
+import time
 from dotenv import dotenv_values
 from flask import Blueprint, Flask, request, redirect
 from flask_cors import CORS
@@ -12,6 +14,7 @@ import traceback
 from llama_index.core.base.llms.types import ChatMessage
 
 from rag_studio import LOG_FILE_FOLDER
+from rag_studio.embedding_cache import CachedEmbedding
 from rag_studio.evaluation.retrieval import evaluate_on_auto_dataset
 from rag_studio.inference.repo_handling import infer_prefs_repo_id
 from rag_studio.log_files import tail_logs
@@ -21,10 +24,12 @@ from rag_studio.model_settings import (
     app_name_from_settings,
     chat_prompts_from_settings,
     embedding_model_from_settings,
+    index_settings_from_settings,
     query_prompts_from_settings,
     read_settings,
 )
-from rag_studio.ragstore import RagStore
+from rag_studio.ragstore import INDEX_DIR_NAME, RagStore
+from rag_studio.stage_timings import collect_stage_timings
 from rag_studio.hf_repo_storage import (
     create_repo,
     download_file,
@@ -101,7 +106,14 @@ def mark_repo_as_active(config):
 
 
 def push_to_repo(config):
-    upload_folder(config["repo_name"], config["rag_storage_path"])
+    # The remote index mirrors the local one - files the index no longer has,
+    # like shards beyond a lowered shard count, would otherwise be downloaded
+    # by the inference server and loaded with the rest
+    upload_folder(
+        config["repo_name"],
+        config["rag_storage_path"],
+        delete_patterns=[f"{INDEX_DIR_NAME}/**"],
+    )
     mark_repo_as_active(config)
 
 
@@ -136,9 +148,10 @@ def init_settings(config, repo_name):
     return fetch_full_repo(config, repo_name)
 
 
-def response_to_transport(response):
+def response_to_transport(response, timings=None):
     return {
         "completion": response.response,
+        "timings": timings,
         "contexts": [
             {
                 "context": sn.text,
@@ -226,7 +239,11 @@ def create_api_blueprint(config=None, model_builder=None):
     # from config object
     rag_storage_path = config["rag_storage_path"]
     logger.info("RAG storage path: %s", rag_storage_path)
-    rag_storage = RagStore(rag_storage_path, embed_model=_engine["embed_model"])
+    rag_storage = RagStore(
+        rag_storage_path,
+        embed_model=_engine["embed_model"],
+        index_settings=index_settings_from_settings(settings),
+    )
     doc_storage_path = config["doc_storage_path"]
     logger.info("Document storage path: %s", doc_storage_path)
     if not os.path.exists(doc_storage_path):
@@ -250,9 +267,20 @@ def create_api_blueprint(config=None, model_builder=None):
     def get_repo_name():
         return {"repo_name": config["repo_name"]}
 
+    # Pushes run one at a time, but not under the index lock - so ingests,
+    # deletes and queries aren't held up for the length of an upload
+    push_lock = threading.Lock()
+
+    def push_checkpoint():
+        with push_lock:
+            push_to_repo(config)
+
     def checkpoint_docs():
         rag_storage.write_to_storage()
-        push_to_repo(config)
+        push_checkpoint()
+        # Folding segments back into the full index happens off the request path,
+        # and pushes again once it is done
+        rag_storage.compact_in_background(on_complete=push_checkpoint)
 
     def handle_file_upload():
         if "file" not in request.files:
@@ -264,8 +292,9 @@ def create_api_blueprint(config=None, model_builder=None):
             write_path = f"{doc_storage_path}/{file.filename}"
             logger.info("Uploading file %s to %s", file.filename, write_path)
             file.save(write_path)
-            rag_storage.add_document(write_path)
-            checkpoint_docs()
+            # Re-uploading an unchanged file doesn't alter the index
+            if rag_storage.add_document(write_path):
+                checkpoint_docs()
 
     @bp.route("/upload", methods=["POST"])
     def upload_file_api():
@@ -274,6 +303,35 @@ def create_api_blueprint(config=None, model_builder=None):
             return {"message": err_msg}, 400
         return {"message": "File uploaded successfully"}
 
+    @bp.route("/upload-batch", methods=["POST"])
+    def upload_files_api():
+        """Multi-file variant of /upload - ingests all of the files in the request
+        together and checkpoints once at the end, rather than once per file."""
+        files = [f for f in request.files.getlist("file") if f.filename != ""]
+        if not files:
+            return {"message": "No files selected for uploading"}, 400
+        write_paths = []
+        for file in files:
+            write_path = f"{doc_storage_path}/{file.filename}"
+            logger.info("Uploading file %s to %s", file.filename, write_path)
+            file.save(write_path)
+            write_paths.append(write_path)
+        # Files that can't be read are reported, and the rest still added
+        timings = rag_storage.add_documents(write_paths)
+        failed_files = timings["failed_files"]
+        start = time.perf_counter()
+        if timings["skipped_file_count"] + len(failed_files) < timings["file_count"]:
+            checkpoint_docs()
+        timings["checkpoint_seconds"] = time.perf_counter() - start
+        message = f"{len(files) - len(failed_files)} files uploaded successfully"
+        if failed_files:
+            message += f", {len(failed_files)} could not be read"
+        return {
+            "message": message,
+            "failed_files": failed_files,
+            "timings": timings,
+        }
+
     @bp.route("/upload-view", methods=["POST"])
     def upload_file_view():
         err_msg = handle_file_upload()
@@ -286,21 +344,34 @@ def create_api_blueprint(config=None, model_builder=None):
     def list_files_api():
         return {"files": rag_storage.list_files()}
 
-    def complete_prompt(prompt):
-        response = build_query_engine().query(prompt)
+    @bp.route("/files/<file_name>", methods=["DELETE"])
+    def delete_file_api(file_name):
+        if not rag_storage.delete_file(file_name):
+            return {"message": f"File {file_name} not found"}, 404
+        upload_path = f"{doc_storage_path}/{os.path.basename(file_name)}"
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+        checkpoint_docs()
+        return {"message": f"File {file_name} deleted"}
+
+    def complete_prompt(prompt, filters=None):
+        response = build_query_engine(filters).query(prompt)
         logger.debug("Response from query engine: %s", response)
         return response
 
-    def build_query_engine():
+    def build_query_engine(filters=None):
         return rag_storage.make_query_engine(
-            llm=_engine["llm"], query_prompts=query_prompts_from_settings(settings)
+            llm=_engine["llm"],
+            query_prompts=query_prompts_from_settings(settings),
+            filters=filters,
         )
 
     @bp.post("/try-completion")
     def try_completion_api():
         prompt = request.json["prompt"]
-        response = complete_prompt(prompt)
-        return response_to_transport(response)
+        with collect_stage_timings() as timings:
+            response = complete_prompt(prompt, filters=request.json.get("filters"))
+        return response_to_transport(response, timings)
 
     def complete_chat(messages):
         new_message = messages[-1]
@@ -314,8 +385,9 @@ def create_api_blueprint(config=None, model_builder=None):
     @bp.route("/try-chat", methods=["POST"])
     def try_chat_api():
         prompt = request.json["messages"]
-        response = complete_chat(prompt)
-        return response_to_transport(response)
+        with collect_stage_timings() as timings:
+            response = complete_chat(prompt)
+        return response_to_transport(response, timings)
 
     @bp.route("/inference-container-details", methods=["POST"])
     def inference_container_details_api():
@@ -332,6 +404,8 @@ def create_api_blueprint(config=None, model_builder=None):
 
     @bp.post("/update-model")
     def update_model():
+        # Cached engines hold a reference to the LLM, stopping it being freed
+        rag_storage.clear_engine_cache()
         del _engine["llm"]
         free_gpu_memory()
         if request.json.get("clear_space") == True:
@@ -364,6 +438,16 @@ def create_api_blueprint(config=None, model_builder=None):
         rag_storage.change_embedding_model(_engine["embed_model"])
         return {"message": "Embedding model updated"}
 
+    @bp.route("/embedding-cache-stats")
+    def embedding_cache_stats():
+        embed_model = _engine["embed_model"]
+        if not isinstance(embed_model, CachedEmbedding):
+            return {
+                "enabled": False,
+                "message": "The embedding cache isn't in use for this embedding model",
+            }
+        return {"enabled": True, **embed_model.cache_stats()}
+
     @bp.route("/model-name")
     def get_model_name():
         return {"model_name": settings["model"]}
@@ -377,6 +461,7 @@ def create_api_blueprint(config=None, model_builder=None):
         chat_prompts = request.json
         settings["chat_prompts"] = chat_prompts
         push_settings_update(config, settings)
+        rag_storage.clear_engine_cache()
         return {"message": "Chat prompts updated"}
 
     @bp.route("/query-prompts")
@@ -399,6 +484,7 @@ def create_api_blueprint(config=None, model_builder=None):
         query_prompts = request.json
         settings["query_prompts"] = query_prompts
         push_settings_update(config, settings)
+        rag_storage.clear_engine_cache()
         return {"message": "Query prompts updated"}
 
     @bp.route("/logs")
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from rag_studio.inference.async_vllm import (
+    CHAT_STAGE,
+    COMPLETE_STAGE,
+    current_sampling_settings,
+    sampling_scope,
+)
+
+DEFAULTS = {"temperature": 1.0, "top_p": 1.0, "max_new_tokens": 512}
+
+
+def test_scope_overrides_apply_only_within_the_block():
+    with sampling_scope(temperature=0.0, max_new_tokens=16):
+        assert current_sampling_settings(DEFAULTS) == {
+            "temperature": 0.0,
+            "top_p": 1.0,
+            "max_new_tokens": 16,
+        }
+    assert current_sampling_settings(DEFAULTS) == DEFAULTS
+
+
+def test_concurrent_requests_see_their_own_settings():
+    async def request(temperature):
+        with sampling_scope(temperature=temperature):
+            await asyncio.sleep(0.01)
+            return await asyncio.to_thread(current_sampling_settings, DEFAULTS)
+
+    async def run():
+        return await asyncio.gather(request(0.1), request(0.9))
+
+    first, second = asyncio.run(run())
+    assert first["temperature"] == 0.1
+    assert second["temperature"] == 0.9
+
+
+def test_unknown_settings_are_rejected():
+    with pytest.raises(ValueError):
+        with sampling_scope(temprature=0.1):
+            pass
+
+
+def test_samples_only_apply_to_the_sampled_stage():
+    defaults = {**DEFAULTS, "n": 1, "best_of": None}
+    with sampling_scope(samples_stage=CHAT_STAGE, n=3, best_of=5):
+        assert current_sampling_settings(defaults, CHAT_STAGE)["n"] == 3
+        condense = current_sampling_settings(defaults, COMPLETE_STAGE)
+        assert (condense["n"], condense["best_of"]) == (1, None)
+    with sampling_scope(n=3):
+        assert current_sampling_settings(defaults, COMPLETE_STAGE)["n"] == 3
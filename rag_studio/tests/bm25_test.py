@@ -0,0 +1,66 @@
+from llama_index.core import VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import TextNode
+
+from rag_studio.bm25 import BM25Index, tokenize
+from rag_studio.hybrid_retriever import HybridRetriever, reciprocal_rank_fusion
+from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
+
+TEXTS = {
+    "a": "The pump reports error ERR-1042 when the inlet is blocked",
+    "b": "Regular maintenance keeps the pump running smoothly",
+    "c": "Replace the filter every six months",
+}
+
+
+def make_nodes():
+    return [TextNode(id_=i, text=text) for i, text in TEXTS.items()]
+
+
+def test_tokenize_keeps_identifiers_whole_and_split():
+    assert tokenize("Error ERR-1042!") == ["error", "err-1042", "err", "1042"]
+
+
+def test_search_ranks_exact_identifier_match_first():
+    temp_folder = make_temp_folder()
+    index = BM25Index(f"{temp_folder}/bm25.json")
+    index.add(make_nodes())
+    results = index.search("what does err-1042 mean", top_k=3)
+    assert results[0][0] == "a"
+    assert len(results) == 1
+    cleanup_temp_folder(temp_folder)
+
+
+def test_removed_nodes_are_not_returned_and_state_survives_reload():
+    temp_folder = make_temp_folder()
+    index = BM25Index(f"{temp_folder}/bm25.json")
+    index.add(make_nodes())
+    index.remove(["a"])
+    index.save()
+
+    reloaded = BM25Index(f"{temp_folder}/bm25.json")
+    assert len(reloaded) == 2
+    assert [node_id for node_id, _ in reloaded.search("pump", top_k=3)] == ["b"]
+    cleanup_temp_folder(temp_folder)
+
+
+def test_reciprocal_rank_fusion_prefers_nodes_ranked_by_both():
+    fused = reciprocal_rank_fusion([["x", "y"], ["y", "z"]])
+    assert [node_id for node_id, _ in fused] == ["y", "x", "z"]
+
+
+def test_hybrid_retriever_finds_keyword_match():
+    temp_folder = make_temp_folder()
+    index = VectorStoreIndex(make_nodes(), embed_model=MockEmbedding(embed_dim=2))
+    bm25 = BM25Index(f"{temp_folder}/bm25.json")
+    bm25.sync(index.docstore, set(index.index_struct.nodes_dict.values()))
+    retriever = HybridRetriever(
+        index.as_retriever(similarity_top_k=3),
+        bm25,
+        index.docstore,
+        similarity_top_k=1,
+        candidate_k=3,
+    )
+    results = retriever.retrieve("ERR-1042")
+    assert [result.node.node_id for result in results] == ["a"]
+    cleanup_temp_folder(temp_folder)
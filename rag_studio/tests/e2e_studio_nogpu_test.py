@@ -1,6 +1,8 @@
+import io
 import json
 import os
 import pytest
+from llama_index.core.embeddings import MockEmbedding
 
 from rag_studio.hf_repo_storage import (
     download_from_repo,
@@ -15,6 +17,7 @@ from rag_studio.tests.conftest import (
     TEST_REPO_NAME,
     push_initial_repo_prefs,
 )
+from rag_studio import ragstore
 from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
 from rag_studio.studio_webserver import apply_defaults
 
@@ -143,3 +146,38 @@ def test_after_app_name_changed_repo_has_new_name(
         assert model_data["app_name"] == "Willy Wonka's fabulous RAG app"
     reset_model_settings(client)
     cleanup_temp_folder(temp_folder)
+
+
+def test_embedding_cache_stats_without_cache_reports_disabled(
+    nogpu_client_factory, config_with_repo
+):
+    client = nogpu_client_factory(config_with_repo)
+    stats_result = client.get("/embedding-cache-stats")
+    assert stats_result.status_code == 200
+    assert stats_result.json["enabled"] is False
+
+
+def test_upload_batch_adds_readable_files_and_reports_the_rest(
+    nogpu_client_factory, config_with_repo, mock_models, monkeypatch
+):
+    mock_models.make_embedding_model.return_value = MockEmbedding(embed_dim=8)
+    hash_file = ragstore.hash_file
+
+    def failing_hash_file(file_path):
+        if file_path.endswith("unreadable.txt"):
+            raise PermissionError(f"Permission denied: {file_path}")
+        return hash_file(file_path)
+
+    monkeypatch.setattr(ragstore, "hash_file", failing_hash_file)
+    client = nogpu_client_factory(config_with_repo)
+    data = {
+        "file": [
+            (io.BytesIO(b"Some text about apples."), "apples.txt"),
+            (io.BytesIO(b"Some text about bananas."), "unreadable.txt"),
+        ]
+    }
+    upload_result = client.post("/upload-batch", data=data)
+    assert upload_result.status_code == 200
+    assert list(upload_result.json["failed_files"]) == ["unreadable.txt"]
+    files_result = client.get("/files")
+    assert [f["file_name"] for f in files_result.json["files"]] == ["apples.txt"]
@@ -0,0 +1,98 @@
+from typing import List
+
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.embeddings import MockEmbedding
+
+from rag_studio.embedding_cache import CachedEmbedding, EmbeddingCache
+from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
+
+
+def test_repeated_text_is_served_from_cache():
+    temp_folder = make_temp_folder()
+    cache = EmbeddingCache(f"{temp_folder}/cache.sqlite", max_entries=10)
+    embed_model = CachedEmbedding(MockEmbedding(embed_dim=4), cache)
+
+    first = embed_model.get_text_embedding_batch(["some text", "other text"])
+    # Whitespace differences don't change the cache key
+    second = embed_model.get_text_embedding_batch(["some  text\n"])
+    assert second[0] == first[0]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+    cleanup_temp_folder(temp_folder)
+
+
+class UnroundedEmbedding(MockEmbedding):
+    """Values that float16 can't hold exactly."""
+
+    def _get_vector(self):
+        return [0.1, 0.2, 0.3, 0.4]
+
+
+def test_cache_hits_and_misses_return_the_same_precision():
+    temp_folder = make_temp_folder()
+    cache = EmbeddingCache(f"{temp_folder}/cache.sqlite", max_entries=10)
+    embed_model = CachedEmbedding(UnroundedEmbedding(embed_dim=4), cache)
+
+    miss = embed_model.get_text_embedding("some text")
+    hit = embed_model.get_text_embedding("some text")
+    assert cache.stats()["hits"] == 1
+    assert hit == miss
+    cleanup_temp_folder(temp_folder)
+
+
+def test_cache_is_keyed_by_model_name():
+    assert EmbeddingCache.key("model-a", "text") != EmbeddingCache.key("model-b", "text")
+
+
+def test_least_recently_used_entries_are_evicted():
+    temp_folder = make_temp_folder()
+    cache = EmbeddingCache(f"{temp_folder}/cache.sqlite", max_entries=2)
+    cache.put_many({"a": [1.0], "b": [2.0]})
+    cache.get_many(["a"])
+    cache.put_many({"c": [3.0]})
+    assert sorted(cache.get_many(["a", "b", "c"]).keys()) == ["a", "c"]
+    assert cache.stats()["entries"] == 2
+    cleanup_temp_folder(temp_folder)
+
+
+def test_batched_query_embeddings_match_single_ones():
+    temp_folder = make_temp_folder()
+    cache = EmbeddingCache(f"{temp_folder}/cache.sqlite", max_entries=10)
+    embed_model = CachedEmbedding(MockEmbedding(embed_dim=4), cache)
+
+    batch = embed_model.get_query_embedding_batch(["first", "second"])
+    assert batch == [
+        embed_model.get_query_embedding("first"),
+        embed_model.get_query_embedding("second"),
+    ]
+    cleanup_temp_folder(temp_folder)
+
+
+class SentenceEmbedding(MockEmbedding):
+    """Embeds like HuggingFaceEmbedding - everything goes through _embed."""
+
+    embed_calls: List[tuple] = Field(default_factory=list)
+
+    def _embed(self, sentences, prompt_name=None):
+        self.embed_calls.append((sentences, prompt_name))
+        if isinstance(sentences, str):
+            return [float(len(sentences)), 1.0]
+        return [[float(len(s)), 1.0] for s in sentences]
+
+    def _get_query_embedding(self, query):
+        return self._embed(query, prompt_name="query")
+
+
+def test_batched_query_embeddings_use_one_embed_call():
+    temp_folder = make_temp_folder()
+    cache = EmbeddingCache(f"{temp_folder}/cache.sqlite", max_entries=10)
+    inner = SentenceEmbedding(embed_dim=2)
+    embed_model = CachedEmbedding(inner, cache)
+
+    batch = embed_model.get_query_embedding_batch(["first", "second!"])
+    assert inner.embed_calls == [(["first", "second!"], "query")]
+    assert batch == [
+        embed_model.get_query_embedding("first"),
+        embed_model.get_query_embedding("second!"),
+    ]
+    cleanup_temp_folder(temp_folder)
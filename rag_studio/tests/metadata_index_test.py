@@ -0,0 +1,36 @@
+from llama_index.core.schema import TextNode
+
+from rag_studio.metadata_index import MetadataIndex
+from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
+
+
+def make_nodes():
+    return [
+        TextNode(id_="a1", text="", metadata={"file_name": "a.pdf", "product": "pump"}),
+        TextNode(id_="a2", text="", metadata={"file_name": "a.pdf", "product": "pump"}),
+        TextNode(id_="b1", text="", metadata={"file_name": "b.pdf", "product": "valve"}),
+        TextNode(id_="c1", text="", metadata={"file_name": "c.pdf", "product": "pump"}),
+    ]
+
+
+def test_match_combines_filters():
+    temp_folder = make_temp_folder()
+    index = MetadataIndex(f"{temp_folder}/metadata_index.json")
+    index.add(make_nodes())
+    assert index.match({"file_name": "a.pdf"}) == {"a1", "a2"}
+    assert index.match({"file_name": ["a.pdf", "b.pdf"]}) == {"a1", "a2", "b1"}
+    assert index.match({"file_name": ["b.pdf", "c.pdf"], "product": "pump"}) == {"c1"}
+    assert index.match({"unknown": "x"}) == set()
+    cleanup_temp_folder(temp_folder)
+
+
+def test_removed_nodes_stop_matching_and_state_survives_reload():
+    temp_folder = make_temp_folder()
+    index = MetadataIndex(f"{temp_folder}/metadata_index.json")
+    index.add(make_nodes())
+    index.remove(["a1"])
+    index.save()
+
+    reloaded = MetadataIndex(f"{temp_folder}/metadata_index.json")
+    assert reloaded.match({"file_name": "a.pdf"}) == {"a2"}
+    cleanup_temp_folder(temp_folder)
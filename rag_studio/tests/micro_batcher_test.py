@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+from rag_studio.inference.micro_batcher import MicroBatcher
+
+
+def test_concurrent_items_are_batched_and_answered_in_order():
+    batches = []
+
+    def double_all(items):
+        batches.append(list(items))
+        return [2 * item for item in items]
+
+    batcher = MicroBatcher(double_all, window_seconds=0.05, max_batch_size=2)
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit(n) for n in range(5)))
+
+    assert asyncio.run(run()) == [0, 2, 4, 6, 8]
+    assert batches == [[0, 1], [2, 3], [4]]
+    stats = batcher.stats()
+    assert stats["batches"] == 3
+    assert stats["max_batch_size"] == 2
+    assert stats["max_wait_ms"] >= 0.0
+
+
+def test_batch_failures_reach_every_caller():
+    def fail(items):
+        raise RuntimeError("model fell over")
+
+    batcher = MicroBatcher(fail, window_seconds=0.01, max_batch_size=8)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.submit("a"), batcher.submit("b"), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    with pytest.raises(RuntimeError):
+        asyncio.run(batcher.submit("c"))
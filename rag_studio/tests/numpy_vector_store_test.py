@@ -0,0 +1,221 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from llama_index.core import StorageContext
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
+from rag_studio.vector_stores.ivf_store import IvfFlatVectorStore
+from rag_studio.vector_stores.numpy_store import (
+    DEFAULT_PERSIST_NAME,
+    NumpyVectorStore,
+)
+
+
+def make_node(node_id, embedding, ref_doc_id="doc-1"):
+    return TextNode(
+        id_=node_id,
+        text=node_id,
+        embedding=embedding,
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=ref_doc_id)},
+    )
+
+
+def test_query_returns_top_k_by_cosine_similarity():
+    store = NumpyVectorStore()
+    store.add(
+        [
+            make_node("a", [1.0, 0.0]),
+            make_node("b", [0.0, 1.0]),
+            make_node("c", [1.0, 1.0]),
+        ]
+    )
+    result = store.query(
+        VectorStoreQuery(query_embedding=[1.0, 0.1], similarity_top_k=2)
+    )
+    assert result.ids == ["a", "c"]
+    assert np.isclose(result.similarities[0], 1.0 / np.sqrt(1.01))
+
+
+def test_deleted_documents_are_not_returned():
+    store = NumpyVectorStore()
+    store.add([make_node("a", [1.0, 0.0], "doc-1"), make_node("b", [0.9, 0.1], "doc-2")])
+    store.delete("doc-1")
+    result = store.query(
+        VectorStoreQuery(query_embedding=[1.0, 0.0], similarity_top_k=2)
+    )
+    assert result.ids == ["b"]
+    assert store.tombstone_count == 1
+
+
+def test_persist_drops_tombstoned_rows():
+    temp_folder = make_temp_folder()
+    store = NumpyVectorStore()
+    store.add([make_node("a", [1.0, 0.0], "doc-1"), make_node("b", [0.0, 1.0], "doc-2")])
+    store.delete("doc-1")
+    store.persist(f"{temp_folder}/{DEFAULT_PERSIST_NAME}.json")
+    assert store.tombstone_count == 0
+    assert store._matrix.shape == (1, 2)
+    cleanup_temp_folder(temp_folder)
+
+
+def test_query_can_be_restricted_to_node_ids():
+    store = NumpyVectorStore()
+    store.add([make_node("a", [1.0, 0.0]), make_node("b", [0.5, 0.5])])
+    result = store.query(
+        VectorStoreQuery(query_embedding=[1.0, 0.0], similarity_top_k=2, node_ids=["b"])
+    )
+    assert result.ids == ["b"]
+
+
+def test_restriction_to_every_live_node_scores_the_whole_matrix():
+    store = NumpyVectorStore()
+    store.add(
+        [
+            make_node("a", [1.0, 0.0], "doc-1"),
+            make_node("b", [0.5, 0.5], "doc-2"),
+            make_node("c", [0.0, 1.0], "doc-3"),
+        ]
+    )
+    store.delete("doc-3")
+    query = VectorStoreQuery(
+        query_embedding=[1.0, 0.0], similarity_top_k=3, node_ids=["a", "b", "c"]
+    )
+    assert store._candidate_rows(query) is None
+    assert store.query(query).ids == ["a", "b"]
+
+
+def test_persisted_store_reloads_memory_mapped():
+    temp_folder = make_temp_folder()
+    store = NumpyVectorStore()
+    store.add([make_node("a", [1.0, 0.0]), make_node("b", [0.0, 1.0])])
+    store.persist(f"{temp_folder}/{DEFAULT_PERSIST_NAME}.json")
+
+    reloaded = NumpyVectorStore.from_persist_dir(temp_folder)
+    assert isinstance(reloaded._matrix, np.memmap)
+    result = reloaded.query(
+        VectorStoreQuery(query_embedding=[0.0, 1.0], similarity_top_k=1)
+    )
+    assert result.ids == ["b"]
+    cleanup_temp_folder(temp_folder)
+
+
+def test_ivf_store_finds_exact_neighbours_when_probing_all_lists():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((200, 8))
+    store = IvfFlatVectorStore(nlist=8, nprobe=8, min_train_size=100)
+    store.add([make_node(str(row), vectors[row].tolist()) for row in range(200)])
+    assert store.is_trained
+    result = store.query(
+        VectorStoreQuery(query_embedding=vectors[42].tolist(), similarity_top_k=3)
+    )
+    assert result.ids[0] == "42"
+    assert len(result.ids) == 3
+
+
+def test_quantized_stores_with_rescoring_match_exact_search():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((300, 32))
+    # Rows 1-4 are near neighbours of row 0. Sign bits alone can't separate
+    # vectors that are all about equally dissimilar, so binary codes are only
+    # expected to find real neighbours.
+    vectors[1:5] = vectors[0] + 0.3 * rng.standard_normal((4, 32))
+    nodes = [make_node(str(row), vectors[row].tolist()) for row in range(300)]
+    exact = NumpyVectorStore()
+    exact.add(nodes)
+    for mode in ("float16", "int8", "binary"):
+        store = NumpyVectorStore(quantization=mode, rescore_factor=20)
+        store.add(nodes)
+        for query_row in (0,) if mode == "binary" else (0, 7):
+            query = VectorStoreQuery(
+                query_embedding=vectors[query_row].tolist(), similarity_top_k=5
+            )
+            expected = exact.query(query)
+            result = store.query(query)
+            assert result.ids == expected.ids
+            assert np.allclose(result.similarities, expected.similarities)
+
+
+def test_quantized_codes_are_persisted_and_follow_deletes():
+    temp_folder = make_temp_folder()
+    store = NumpyVectorStore(quantization="int8")
+    store.add([make_node("a", [1.0, 0.0], "doc-1"), make_node("b", [0.0, 1.0], "doc-2")])
+    store.delete("doc-1")
+    store.persist(f"{temp_folder}/{DEFAULT_PERSIST_NAME}.json")
+
+    reloaded = NumpyVectorStore.from_persist_dir(temp_folder, quantization="int8")
+    assert reloaded._codes.dtype == np.int8
+    assert reloaded._codes.shape == (1, 2)
+    result = reloaded.query(
+        VectorStoreQuery(query_embedding=[0.0, 1.0], similarity_top_k=2)
+    )
+    assert result.ids == ["b"]
+    cleanup_temp_folder(temp_folder)
+
+
+def test_concurrent_queries_quantize_new_rows_once():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((2000, 16))
+    store = NumpyVectorStore(quantization="int8")
+    for start in range(0, 2000, 100):
+        store.add(
+            [make_node(str(row), vectors[row].tolist()) for row in range(start, start + 100)]
+        )
+    query = VectorStoreQuery(query_embedding=vectors[7].tolist(), similarity_top_k=1)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: store.query(query), range(32)))
+    assert len(store._codes) == 2000
+    assert all(result.ids == ["7"] for result in results)
+
+
+def test_query_batch_matches_single_queries():
+    store = NumpyVectorStore()
+    store.add(
+        [
+            make_node("a", [1.0, 0.0], "doc-1"),
+            make_node("b", [0.0, 1.0], "doc-2"),
+            make_node("c", [1.0, 1.0], "doc-3"),
+        ]
+    )
+    store.delete("doc-3")
+    queries = [
+        VectorStoreQuery(query_embedding=[1.0, 0.1], similarity_top_k=2),
+        VectorStoreQuery(query_embedding=[0.1, 1.0], similarity_top_k=1),
+        # Restricted queries fall back to query()
+        VectorStoreQuery(query_embedding=[1.0, 0.0], similarity_top_k=2, node_ids=["b"]),
+    ]
+    batch = store.query_batch(queries)
+    for query, result in zip(queries, batch):
+        single = store.query(query)
+        assert result.ids == single.ids
+        assert np.allclose(result.similarities, single.similarities)
+    assert batch[0].ids == ["a", "b"]
+
+
+def test_empty_store_is_kept_by_storage_context():
+    store = NumpyVectorStore()
+    assert StorageContext.from_defaults(vector_store=store).vector_store is store
+
+
+def test_ref_doc_rows_follow_adds_deletes_and_compaction():
+    temp_folder = make_temp_folder()
+    store = NumpyVectorStore()
+    store.add([make_node("a", [1.0, 0.0], "doc-1"), make_node("b", [0.9, 0.1], "doc-2")])
+    store.add([make_node("c", [0.8, 0.2], "doc-1"), make_node("d", [0.0, 1.0], "doc-3")])
+    store.delete("doc-2")
+    store.persist(f"{temp_folder}/{DEFAULT_PERSIST_NAME}.json")
+    assert store.tombstone_count == 0
+
+    query = VectorStoreQuery(
+        query_embedding=[1.0, 0.0], similarity_top_k=4, doc_ids=["doc-1", "doc-2"]
+    )
+    assert store.query(query).ids == ["a", "c"]
+    store.delete("doc-1")
+    store.delete("doc-1")
+    assert store.query(query).ids == []
+    assert len(store) == 1
+    assert store.query(
+        VectorStoreQuery(query_embedding=[1.0, 0.0], similarity_top_k=4)
+    ).ids == ["d"]
+    cleanup_temp_folder(temp_folder)
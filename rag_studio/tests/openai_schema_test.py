@@ -0,0 +1,43 @@
+from rag_studio.openai.schema import ChatCompletionRequest, CompletionRequest
+
+
+def test_sampling_params_keep_zero_temperature():
+    req = CompletionRequest(model="rag_model", prompt="hi", temperature=0.0, stop="\n")
+    params = req.sampling_params()
+    assert params["temperature"] == 0.0
+    assert params["stop"] == "\n"
+    assert params["max_new_tokens"] == 512
+
+
+def test_sampling_params_defaults():
+    req = ChatCompletionRequest(
+        model="rag_model", messages=[{"role": "user", "content": "hi"}]
+    )
+    assert req.request_problem() is None
+    assert req.sampling_params() == {
+        "temperature": 0.7,
+        "presence_penalty": 0.0,
+        "frequency_penalty": 0.0,
+        "top_p": 1.0,
+        "stop": [],
+        "max_new_tokens": 512,
+        "n": 1,
+        "best_of": None,
+    }
+
+
+def test_request_problems():
+    assert CompletionRequest(model="other", prompt="hi").request_problem()
+    assert CompletionRequest(
+        model="rag_model", prompt="hi", stream_options={"include_usage": True}
+    ).request_problem()
+    assert CompletionRequest(
+        model="rag_model", prompt="hi", n=3, best_of=2
+    ).request_problem()
+    assert CompletionRequest(
+        model="rag_model", prompt="hi", n=2, stream=True
+    ).request_problem()
+    assert (
+        CompletionRequest(model="rag_model", prompt="hi", n=3).request_problem()
+        is None
+    )
@@ -0,0 +1,120 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from rag_studio.openai.streaming import openai_event_stream
+
+RESPONSE = SimpleNamespace(source_nodes=[])
+
+
+def make_start(deltas):
+    async def delta_gen():
+        for delta in deltas:
+            if isinstance(delta, Exception):
+                raise delta
+            yield delta
+
+    async def start():
+        return delta_gen(), RESPONSE
+
+    return start
+
+
+def collect(stream, limit=None):
+    async def run():
+        events = []
+        async for event in stream:
+            events.append(event)
+            if limit is not None and len(events) == limit:
+                # As when the client goes away
+                await stream.aclose()
+                break
+        return events
+
+    return asyncio.run(run())
+
+
+def payloads(events):
+    assert all(event.startswith("data: ") and event.endswith("\n\n") for event in events)
+    return [event[len("data: ") : -2] for event in events]
+
+
+def test_chat_stream_framing():
+    finished = []
+
+    async def usage(response_obj):
+        return {"total_tokens": 3}
+
+    events = collect(
+        openai_event_stream(
+            "id",
+            True,
+            make_start(["Hel", "", "lo"]),
+            "rag-model",
+            include_usage=True,
+            on_finished=lambda text, response_obj: finished.append(text),
+            usage=usage,
+        )
+    )
+    data = payloads(events)
+    assert data[-1] == "[DONE]"
+    chunks = [json.loads(payload) for payload in data[:-1]]
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant", "content": ""}
+    assert [chunk["choices"][0]["delta"] for chunk in chunks[1:3]] == [
+        {"content": "Hel"},
+        {"content": "lo"},
+    ]
+    assert chunks[3]["choices"][0]["finish_reason"] == "stop"
+    assert all(chunk["usage"] is None for chunk in chunks[:4])
+    assert chunks[4]["choices"] == []
+    assert chunks[4]["usage"] == {"total_tokens": 3}
+    assert all(chunk["object"] == "chat.completion.chunk" for chunk in chunks)
+    assert finished == ["Hello"]
+
+
+def test_completion_stream_framing():
+    events = collect(
+        openai_event_stream("id", False, make_start(["a", "b"]), "rag-model")
+    )
+    data = payloads(events)
+    chunks = [json.loads(payload) for payload in data[:-1]]
+    assert [chunk["choices"][0]["text"] for chunk in chunks] == ["a", "b", ""]
+    assert chunks[-1]["choices"][0]["finish_reason"] == "length"
+    assert "usage" not in chunks[0]
+    assert data[-1] == "[DONE]"
+
+
+def test_on_finished_not_called_when_client_goes_away():
+    finished = []
+    events = collect(
+        openai_event_stream(
+            "id",
+            True,
+            make_start(["a", "b", "c"]),
+            "rag-model",
+            on_finished=lambda text, response_obj: finished.append(text),
+        ),
+        limit=2,
+    )
+    assert len(events) == 2
+    assert finished == []
+
+
+def test_error_after_first_chunk_is_sent_as_an_event():
+    finished = []
+    events = collect(
+        openai_event_stream(
+            "id",
+            False,
+            make_start(["a", RuntimeError("engine died")]),
+            "rag-model",
+            on_finished=lambda text, response_obj: finished.append(text),
+        )
+    )
+    data = payloads(events)
+    assert json.loads(data[0])["choices"][0]["text"] == "a"
+    assert json.loads(data[1]) == {
+        "error": {"message": "engine died", "type": "RuntimeError"}
+    }
+    assert data[2:] == ["[DONE]"]
+    assert finished == []
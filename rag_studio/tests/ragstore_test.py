@@ -0,0 +1,369 @@
+import os
+import shutil
+
+from typing import List
+
+import pytest
+from llama_index.core.base.llms.types import LLMMetadata
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from rag_studio.model_settings import DEFAULT_INDEX_SETTINGS
+from rag_studio.ragstore import RagStore
+from rag_studio.snapshot import snapshot_dir
+from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
+from rag_studio.vector_stores.ivf_store import IvfFlatVectorStore
+from rag_studio.vector_stores.numpy_store import NumpyVectorStore
+
+
+def make_store(storage_root, embed_model=None, **index_settings):
+    return RagStore(
+        storage_root,
+        embed_model=embed_model or MockEmbedding(embed_dim=8),
+        index_settings={**DEFAULT_INDEX_SETTINGS, **index_settings},
+    )
+
+
+def write_file(folder, file_name, lines):
+    path = f"{folder}/{file_name}"
+    with open(path, "w", encoding="UTF-8") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+def test_failed_streaming_ingest_leaves_no_nodes():
+    temp_folder = make_temp_folder()
+    path = write_file(
+        temp_folder,
+        "big.log",
+        [f"line {n} of a file streamed in batches. " * 20 for n in range(200)],
+    )
+    store = make_store(
+        temp_folder,
+        persistence="segments",
+        streaming_ingest_min_bytes=0,
+        streaming_ingest_batch_size=4,
+    )
+    embed_nodes = store._embed_nodes
+    calls = []
+
+    def failing_embed_nodes(nodes):
+        calls.append(len(nodes))
+        if len(calls) == 3:
+            raise RuntimeError("embedding failed")
+        embed_nodes(nodes)
+
+    store._embed_nodes = failing_embed_nodes
+    with pytest.raises(RuntimeError):
+        store.add_document(path)
+    assert store.index.docstore.docs == {}
+    assert store.list_files() == []
+
+    store.write_to_storage()
+    # The batches written before the failure were thrown away
+    listed_files = {"manifest.json"} | {
+        f"{name}{extension}"
+        for name in store._segment_log.segment_names
+        for extension in (".json", ".npy")
+    }
+    assert set(os.listdir(f"{temp_folder}/index/segments")) <= listed_files
+    reloaded = make_store(temp_folder, persistence="segments")
+    assert reloaded.index.docstore.docs == {}
+    cleanup_temp_folder(temp_folder)
+
+
+class SmallContextLLM:
+    metadata = LLMMetadata(context_window=256, num_output=32)
+
+
+def test_qa_prompt_truncates_context_to_fit():
+    temp_folder = make_temp_folder()
+    store = make_store(temp_folder)
+    nodes = [
+        NodeWithScore(node=TextNode(text=f"chunk {n} " + "word " * 1000), score=1.0)
+        for n in range(3)
+    ]
+    prompt = store.qa_prompt(SmallContextLLM(), None, "What is Arc?", nodes)
+    assert "What is Arc?" in prompt
+    assert all(f"chunk {n}" in prompt for n in range(3))
+    assert len(prompt.split()) < 256
+    cleanup_temp_folder(temp_folder)
+
+
+def retrieved_file_names(store, query="text"):
+    retriever = store.index.as_retriever(similarity_top_k=100)
+    return {node.metadata["file_name"] for node in retriever.retrieve(query)}
+
+
+@pytest.mark.parametrize("storage_format", ["json", "snapshot"])
+def test_deleted_file_is_not_retrieved_and_stays_deleted(storage_format):
+    temp_folder = make_temp_folder()
+    store = make_store(temp_folder, storage_format=storage_format)
+    store.add_documents(
+        [
+            write_file(temp_folder, "a.txt", ["text about apples"]),
+            write_file(temp_folder, "b.txt", ["text about bananas"]),
+        ]
+    )
+    store.write_to_storage()
+    assert retrieved_file_names(store) == {"a.txt", "b.txt"}
+
+    assert store.delete_file("a.txt")
+    assert not store.delete_file("a.txt")
+    assert retrieved_file_names(store) == {"b.txt"}
+    store.write_to_storage()
+    assert retrieved_file_names(store) == {"b.txt"}
+
+    reloaded = make_store(temp_folder, storage_format=storage_format)
+    assert retrieved_file_names(reloaded) == {"b.txt"}
+    assert [f["file_name"] for f in reloaded.list_files()] == ["b.txt"]
+    cleanup_temp_folder(temp_folder)
+
+
+def test_snapshot_left_after_switching_back_to_json_is_not_loaded():
+    temp_folder = make_temp_folder()
+    store = make_store(temp_folder, storage_format="snapshot")
+    store.add_documents([write_file(temp_folder, "a.txt", ["text about apples"])])
+    store.compact()
+    shutil.copytree(snapshot_dir(store.storage_path), f"{temp_folder}/stale")
+
+    store = make_store(temp_folder, storage_format="json")
+    store.add_documents([write_file(temp_folder, "b.txt", ["text about bananas"])])
+    store.compact()
+    # As a repo pushed before the snapshot was deleted there would still have it
+    os.rename(f"{temp_folder}/stale", snapshot_dir(store.storage_path))
+
+    reloaded = make_store(temp_folder, storage_format="json")
+    assert retrieved_file_names(reloaded) == {"a.txt", "b.txt"}
+    cleanup_temp_folder(temp_folder)
+
+
+@pytest.mark.parametrize("shard_count", [1, 3])
+def test_switching_back_to_the_simple_vector_store_keeps_the_vectors(shard_count):
+    temp_folder = make_temp_folder()
+    store = make_store(temp_folder, vector_store="numpy", shard_count=shard_count)
+    store.add_documents(
+        [
+            write_file(temp_folder, "a.txt", ["text about apples"]),
+            write_file(temp_folder, "b.txt", ["text about bananas"]),
+        ]
+    )
+    store.compact()
+
+    store = make_store(temp_folder, vector_store="simple")
+    assert retrieved_file_names(store) == {"a.txt", "b.txt"}
+    assert store.delete_file("a.txt")
+    store.compact()
+    assert not any(
+        file_name.endswith(".npy") or file_name.startswith("shard")
+        for file_name in os.listdir(store.storage_path)
+    )
+
+    reloaded = make_store(temp_folder, vector_store="simple")
+    assert retrieved_file_names(reloaded) == {"b.txt"}
+    reloaded = make_store(temp_folder, vector_store="numpy")
+    assert retrieved_file_names(reloaded) == {"b.txt"}
+    cleanup_temp_folder(temp_folder)
+
+
+def test_unreadable_file_is_reported_and_the_rest_added():
+    temp_folder = make_temp_folder()
+    store = make_store(temp_folder)
+    timings = store.add_documents(
+        [
+            write_file(temp_folder, "a.txt", ["text about apples"]),
+            f"{temp_folder}/missing.txt",
+        ]
+    )
+    assert list(timings["failed_files"]) == ["missing.txt"]
+    assert [f["file_name"] for f in store.list_files()] == ["a.txt"]
+    with pytest.raises(FileNotFoundError):
+        store.add_document(f"{temp_folder}/missing.txt")
+    cleanup_temp_folder(temp_folder)
+
+
+class CountingEmbedding(MockEmbedding):
+    embedded_texts: List[str] = Field(default_factory=list)
+
+    def _get_text_embeddings(self, texts):
+        self.embedded_texts.extend(texts)
+        return super()._get_text_embeddings(texts)
+
+
+def essay_lines(last_line):
+    # Long enough to be split into several chunks
+    return [
+        f"Paragraph {n} says something about topic {n} at some length. " * 30
+        for n in range(20)
+    ] + [last_line]
+
+
+def test_unchanged_file_is_skipped():
+    temp_folder = make_temp_folder()
+    embed_model = CountingEmbedding(embed_dim=8)
+    store = make_store(temp_folder, embed_model=embed_model)
+    path = write_file(temp_folder, "essay.txt", essay_lines("The end."))
+    assert store.add_document(path)
+    embedded_count = len(embed_model.embedded_texts)
+
+    assert not store.add_document(path)
+    timings = store.add_documents([path])
+    assert timings["skipped_file_count"] == 1
+    assert len(embed_model.embedded_texts) == embedded_count
+    cleanup_temp_folder(temp_folder)
+
+
+def test_changed_file_only_reembeds_changed_chunks():
+    temp_folder = make_temp_folder()
+    embed_model = CountingEmbedding(embed_dim=8)
+    store = make_store(temp_folder, embed_model=embed_model)
+    path = write_file(temp_folder, "essay.txt", essay_lines("The end."))
+    store.add_document(path)
+    node_count = len(store.index.docstore.docs)
+    assert node_count > 1
+
+    embed_model.embedded_texts.clear()
+    write_file(temp_folder, "essay.txt", essay_lines("A different ending."))
+    timings = store.add_documents([path])
+    assert timings["reused_embedding_count"] > 0
+    assert 0 < len(embed_model.embedded_texts) < node_count
+    assert any("A different ending." in text for text in embed_model.embedded_texts)
+    assert store.list_files()[0]["version"] == 2
+    cleanup_temp_folder(temp_folder)
+
+
+def source_file_names(response):
+    return {node.metadata["file_name"] for node in response.source_nodes}
+
+
+@pytest.mark.parametrize("retriever", ["vector", "hybrid"])
+def test_filters_restrict_engines_to_matching_files(retriever):
+    temp_folder = make_temp_folder()
+    store = make_store(temp_folder, retriever=retriever, similarity_top_k=10)
+    store.add_documents(
+        [
+            write_file(temp_folder, "a.txt", ["text about apples"]),
+            write_file(temp_folder, "b.txt", ["text about bananas"]),
+        ]
+    )
+    llm = MockLLM()
+
+    unfiltered = store.make_query_engine(llm, None).query("text about bananas")
+    assert source_file_names(unfiltered) == {"a.txt", "b.txt"}
+    # Even the keyword match on "bananas" is filtered out
+    filtered = store.make_query_engine(llm, None, filters={"file_name": "a.txt"})
+    assert source_file_names(filtered.query("text about bananas")) == {"a.txt"}
+    chat_engine = store.make_chat_engine(llm, None, filters={"file_name": ["b.txt"]})
+    assert source_file_names(chat_engine.chat("text about apples")) == {"b.txt"}
+    no_match = store.make_query_engine(llm, None, filters={"file_name": "c.txt"})
+    assert no_match.query("text").source_nodes == []
+    cleanup_temp_folder(temp_folder)
+
+
+class TopicEmbedding(MockEmbedding):
+    """Texts ending in "topic <n>" (n below embed_dim - 1) point along axis n,
+    so they cluster, with the last axis telling "number <m>" texts apart."""
+
+    def _topic_vector(self, text):
+        words = text.split()
+        vector = [-0.2] * self.embed_dim
+        vector[int(words[-1])] = 1.0
+        if "number" in words:
+            vector[-1] = int(words[words.index("number") + 1]) / 100
+        return vector
+
+    def _get_query_embedding(self, query):
+        return self._topic_vector(query)
+
+    def _get_text_embedding(self, text):
+        return self._topic_vector(text)
+
+    def _get_text_embeddings(self, texts):
+        return [self._topic_vector(text) for text in texts]
+
+
+def add_numbered_files(store, folder, count):
+    store.add_documents(
+        [
+            write_file(folder, f"{n}.txt", [f"text number {n} about topic {n % 7}"])
+            for n in range(count)
+        ]
+    )
+
+
+def test_trained_ivf_store_answers_from_probed_lists(monkeypatch):
+    temp_folder = make_temp_folder()
+    store = make_store(
+        temp_folder,
+        embed_model=TopicEmbedding(embed_dim=8),
+        vector_store="ivf",
+        ivf_nlist=4,
+        ivf_nprobe=1,
+        ivf_min_train_size=20,
+    )
+    add_numbered_files(store, temp_folder, 60)
+    vector_store = store.index.vector_store
+    assert isinstance(vector_store, IvfFlatVectorStore)
+    assert vector_store.is_trained
+
+    queries = []
+    scored_row_counts = []
+    query = IvfFlatVectorStore.query
+    top_rows = IvfFlatVectorStore._top_rows
+
+    def record_query(self, vector_query, **kwargs):
+        queries.append(vector_query)
+        return query(self, vector_query, **kwargs)
+
+    def record_top_rows(self, rows, query_vector, top_k):
+        scored_row_counts.append(len(self) if rows is None else len(rows))
+        return top_rows(self, rows, query_vector, top_k)
+
+    monkeypatch.setattr(IvfFlatVectorStore, "query", record_query)
+    monkeypatch.setattr(IvfFlatVectorStore, "_top_rows", record_top_rows)
+    response = store.make_query_engine(MockLLM(), None).query("about topic 3")
+    assert response.source_nodes
+    assert [vector_query.node_ids for vector_query in queries] == [None]
+    # Only the probed list is scored
+    assert len(scored_row_counts) == 1
+    assert 0 < scored_row_counts[0] < 60
+    cleanup_temp_folder(temp_folder)
+
+
+@pytest.mark.parametrize("quantization", ["float16", "int8", "binary"])
+def test_quantized_store_answers_like_exact_search(quantization, monkeypatch):
+    temp_folder = make_temp_folder()
+    stores = {
+        mode: make_store(
+            f"{temp_folder}/{mode}",
+            embed_model=TopicEmbedding(embed_dim=8),
+            quantization=mode,
+        )
+        for mode in ("none", quantization)
+    }
+    for mode, store in stores.items():
+        os.makedirs(f"{temp_folder}/{mode}/files")
+        add_numbered_files(store, f"{temp_folder}/{mode}/files", 30)
+
+    scored_rows = []
+    top_rows = NumpyVectorStore._top_rows
+
+    def record_top_rows(self, rows, query_vector, top_k):
+        scored_rows.append(rows)
+        return top_rows(self, rows, query_vector, top_k)
+
+    monkeypatch.setattr(NumpyVectorStore, "_top_rows", record_top_rows)
+    exact, quantized = (
+        store.make_query_engine(MockLLM(), None).query("about topic 3")
+        for store in stores.values()
+    )
+    assert source_file_names(quantized) == source_file_names(exact)
+    assert [node.score for node in quantized.source_nodes] == pytest.approx(
+        [node.score for node in exact.source_nodes]
+    )
+    # Exact search is the default store here. The quantized query is
+    # unrestricted, so no copy of the codes is gathered.
+    assert scored_rows == [None]
+    cleanup_temp_folder(temp_folder)
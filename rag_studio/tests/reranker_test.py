@@ -0,0 +1,52 @@
+import asyncio
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from rag_studio.reranker import StagedRetriever
+from rag_studio.stage_timings import collect_stage_timings
+
+
+class KeepLongestReranker:
+    def rerank(self, query_str, candidates):
+        best = max(candidates, key=lambda c: len(c.node.get_content()))
+        return [NodeWithScore(node=best.node, score=1.0)]
+
+
+def make_index():
+    nodes = [TextNode(id_=str(n), text="x" * (n + 1)) for n in range(4)]
+    return VectorStoreIndex(nodes, embed_model=MockEmbedding(embed_dim=2))
+
+
+def test_rerank_stage_narrows_over_fetched_candidates():
+    retriever = StagedRetriever(
+        make_index().as_retriever(similarity_top_k=4), KeepLongestReranker()
+    )
+    with collect_stage_timings() as timings:
+        results = retriever.retrieve("query")
+    assert [r.node.node_id for r in results] == ["3"]
+    assert set(timings) == {"retrieve_seconds", "rerank_seconds", "total_seconds"}
+
+
+def test_without_reranker_only_retrieval_is_timed():
+    retriever = StagedRetriever(make_index().as_retriever(similarity_top_k=2), None)
+    with collect_stage_timings() as timings:
+        results = retriever.retrieve("query")
+    assert len(results) == 2
+    assert "rerank_seconds" not in timings
+
+
+def test_async_retrieval_runs_the_same_stages():
+    retriever = StagedRetriever(
+        make_index().as_retriever(similarity_top_k=4), KeepLongestReranker()
+    )
+
+    async def retrieve():
+        with collect_stage_timings() as timings:
+            results = await retriever.aretrieve("query")
+        return results, timings
+
+    results, timings = asyncio.run(retrieve())
+    assert [r.node.node_id for r in results] == ["3"]
+    assert "rerank_seconds" in timings
@@ -0,0 +1,43 @@
+import time
+
+from rag_studio.inference.response_cache import ResponseCache, normalize_text
+
+
+def test_identical_key_hits():
+    cache = ResponseCache()
+    cache.store(("completion", "q"), "answer", generation=1)
+    assert cache.lookup(("completion", "q"), generation=1) == "answer"
+    assert cache.lookup(("completion", "other"), generation=1) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    assert stats["hit_rate"] == 0.5
+
+
+def test_whitespace_is_normalized():
+    assert normalize_text("  What is\n Arc? ") == normalize_text("What is Arc?")
+
+
+def test_generation_change_invalidates():
+    cache = ResponseCache()
+    cache.store("key", "answer", generation=1)
+    assert cache.lookup("key", generation=2) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.store("a", "a", generation=1)
+    cache.store("b", "b", generation=1)
+    cache.lookup("a", generation=1)
+    cache.store("c", "c", generation=1)
+    assert cache.lookup("a", generation=1) == "a"
+    assert cache.lookup("b", generation=1) is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_expire_after_ttl():
+    cache = ResponseCache(ttl_seconds=0.01)
+    cache.store("key", "answer", generation=1)
+    time.sleep(0.02)
+    assert cache.lookup("key", generation=1) is None
+    assert cache.stats()["expirations"] == 1
@@ -0,0 +1,44 @@
+from llama_index.core import VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import TextNode
+
+from rag_studio.segment_log import SegmentLog
+from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
+
+
+def make_nodes(*node_ids):
+    return [TextNode(id_=i, text=f"text {i}", embedding=[1.0, 0.0]) for i in node_ids]
+
+
+def test_appended_segments_survive_reload():
+    temp_folder = make_temp_folder()
+    log = SegmentLog(temp_folder)
+    log.append(make_nodes("a", "b"))
+    log.append(make_nodes("c"))
+
+    reloaded = SegmentLog(temp_folder)
+    assert len(reloaded.segment_names) == 2
+    nodes, _ = reloaded.read(reloaded.segment_names[0])
+    assert [n.node_id for n in nodes] == ["a", "b"]
+    assert nodes[0].embedding == [1.0, 0.0]
+    cleanup_temp_folder(temp_folder)
+
+
+def test_replay_skips_nodes_already_in_index():
+    temp_folder = make_temp_folder()
+    log = SegmentLog(temp_folder)
+    log.append(make_nodes("a", "b"))
+    index = VectorStoreIndex(nodes=make_nodes("a"), embed_model=MockEmbedding(embed_dim=2))
+    log.replay(index)
+    assert sorted(index.docstore.docs.keys()) == ["a", "b"]
+    cleanup_temp_folder(temp_folder)
+
+
+def test_clear_drops_segments_but_keeps_numbering():
+    temp_folder = make_temp_folder()
+    log = SegmentLog(temp_folder)
+    log.append(make_nodes("a"))
+    log.clear()
+    assert SegmentLog(temp_folder).segment_names == []
+    assert log.append(make_nodes("b")) == "segment-00000001"
+    cleanup_temp_folder(temp_folder)
@@ -0,0 +1,39 @@
+import time
+
+from rag_studio.inference.semantic_cache import SemanticCache
+
+
+def test_similar_question_in_same_scope_hits():
+    cache = SemanticCache(similarity_threshold=0.9)
+    cache.store("scope", [1.0, 0.0], "answer", generation=1)
+    assert cache.lookup("scope", [0.99, 0.05], generation=1) == "answer"
+    assert cache.lookup("other-scope", [1.0, 0.0], generation=1) is None
+    assert cache.lookup("scope", [0.0, 1.0], generation=1) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+    assert stats["hit_rate"] == 1 / 3
+
+
+def test_generation_change_invalidates():
+    cache = SemanticCache()
+    cache.store("scope", [1.0, 0.0], "answer", generation=1)
+    assert cache.lookup("scope", [1.0, 0.0], generation=2) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticCache(max_entries=2)
+    cache.store("scope", [1.0, 0.0, 0.0], "a", generation=1)
+    cache.store("scope", [0.0, 1.0, 0.0], "b", generation=1)
+    cache.lookup("scope", [1.0, 0.0, 0.0], generation=1)
+    cache.store("scope", [0.0, 0.0, 1.0], "c", generation=1)
+    assert cache.lookup("scope", [1.0, 0.0, 0.0], generation=1) == "a"
+    assert cache.lookup("scope", [0.0, 1.0, 0.0], generation=1) is None
+
+
+def test_entries_expire_after_ttl():
+    cache = SemanticCache(ttl_seconds=0.01)
+    cache.store("scope", [1.0, 0.0], "answer", generation=1)
+    time.sleep(0.02)
+    assert cache.lookup("scope", [1.0, 0.0], generation=1) is None
+    assert cache.stats()["expirations"] == 1
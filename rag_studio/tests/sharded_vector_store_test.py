@@ -0,0 +1,117 @@
+import os
+import shutil
+
+from llama_index.core import StorageContext
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from rag_studio.model_settings import DEFAULT_INDEX_SETTINGS
+from rag_studio.ragstore import load_vector_store
+from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
+from rag_studio.vector_stores.numpy_store import DEFAULT_PERSIST_NAME, NumpyVectorStore
+from rag_studio.vector_stores.sharded_store import ShardedVectorStore, shard_for
+
+
+def make_node(node_id, embedding, ref_doc_id):
+    return TextNode(
+        id_=node_id,
+        text=node_id,
+        embedding=embedding,
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=ref_doc_id)},
+    )
+
+
+def make_nodes():
+    return [
+        make_node(f"node-{n}", [1.0, n / 10], f"doc-{n % 5}") for n in range(10)
+    ]
+
+
+def test_query_merges_top_k_across_shards():
+    sharded = ShardedVectorStore([NumpyVectorStore() for _ in range(3)])
+    unsharded = NumpyVectorStore()
+    sharded.add(make_nodes())
+    unsharded.add(make_nodes())
+    query = VectorStoreQuery(query_embedding=[1.0, 0.45], similarity_top_k=4)
+    assert sharded.query(query).ids == unsharded.query(query).ids
+
+
+def test_query_batch_merges_each_query_across_shards():
+    sharded = ShardedVectorStore([NumpyVectorStore() for _ in range(3)])
+    unsharded = NumpyVectorStore()
+    sharded.add(make_nodes())
+    unsharded.add(make_nodes())
+    queries = [
+        VectorStoreQuery(query_embedding=[1.0, 0.45], similarity_top_k=4),
+        VectorStoreQuery(query_embedding=[0.2, 1.0], similarity_top_k=2),
+    ]
+    assert [result.ids for result in sharded.query_batch(queries)] == [
+        unsharded.query(query).ids for query in queries
+    ]
+
+
+def test_documents_are_kept_in_one_shard_and_deleted_from_it():
+    sharded = ShardedVectorStore([NumpyVectorStore() for _ in range(3)])
+    sharded.add(make_nodes())
+    doc_shard = sharded.shards[shard_for("doc-1", 3)]
+    assert {"node-1", "node-6"} <= set(doc_shard._row_by_id)
+    sharded.delete("doc-1")
+    assert sharded.tombstone_count == 2
+    result = sharded.query(VectorStoreQuery(query_embedding=[1.0, 0.1], similarity_top_k=10))
+    assert "node-1" not in result.ids
+    assert len(result.ids) == 8
+
+
+def test_unsharded_store_is_partitioned_on_load():
+    temp_folder = make_temp_folder()
+    unsharded = NumpyVectorStore()
+    unsharded.add(make_nodes())
+    unsharded.persist(f"{temp_folder}/{DEFAULT_PERSIST_NAME}.json")
+
+    sharded = ShardedVectorStore.from_persist_dir(temp_folder, shard_count=2)
+    assert len(sharded) == 10
+    sharded.persist(f"{temp_folder}/{DEFAULT_PERSIST_NAME}.json")
+    assert sorted(os.listdir(temp_folder)) == ["shard-0", "shard-1", "shards.json"]
+
+    reloaded = ShardedVectorStore.from_persist_dir(temp_folder, shard_count=2)
+    assert reloaded.get("node-3") == sharded.get("node-3")
+    cleanup_temp_folder(temp_folder)
+
+
+def test_shard_dirs_left_from_a_higher_shard_count_are_ignored():
+    temp_folder = make_temp_folder()
+    persist_path = f"{temp_folder}/{DEFAULT_PERSIST_NAME}.json"
+    sharded = ShardedVectorStore([NumpyVectorStore() for _ in range(3)])
+    sharded.add(make_nodes())
+    sharded.persist(persist_path)
+    shutil.copytree(f"{temp_folder}/shard-2", f"{temp_folder}/stale")
+
+    lowered = ShardedVectorStore.from_persist_dir(temp_folder, shard_count=2)
+    lowered.delete("doc-1")
+    lowered.persist(persist_path)
+    # As a repo pushed before the shard count was lowered would still have it
+    os.rename(f"{temp_folder}/stale", f"{temp_folder}/shard-2")
+
+    reloaded = ShardedVectorStore.from_persist_dir(temp_folder, shard_count=2)
+    assert len(reloaded.shards) == 2
+    assert len(reloaded) == 8
+    cleanup_temp_folder(temp_folder)
+
+
+def test_lowering_the_shard_count_to_one_keeps_every_vector():
+    temp_folder = make_temp_folder()
+    sharded = ShardedVectorStore([NumpyVectorStore() for _ in range(3)])
+    sharded.add(make_nodes())
+    sharded.persist(f"{temp_folder}/{DEFAULT_PERSIST_NAME}.json")
+
+    store = load_vector_store(
+        {**DEFAULT_INDEX_SETTINGS, "vector_store": "numpy", "shard_count": 1},
+        temp_folder,
+    )
+    assert len(store) == 10
+    cleanup_temp_folder(temp_folder)
+
+
+def test_empty_store_is_kept_by_storage_context():
+    sharded = ShardedVectorStore([NumpyVectorStore() for _ in range(3)])
+    assert StorageContext.from_defaults(vector_store=sharded).vector_store is sharded
@@ -0,0 +1,139 @@
+import os
+
+from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.simple import SimpleVectorStore
+
+from rag_studio.snapshot import (
+    NODE_COLLECTION,
+    SnapshotKVStore,
+    has_snapshot,
+    load_snapshot,
+    snapshot_dir,
+    write_snapshot,
+)
+from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
+from rag_studio.vector_stores.numpy_store import NumpyVectorStore
+
+EMBED_MODEL = MockEmbedding(embed_dim=2)
+
+
+def make_nodes(*node_ids):
+    return [
+        TextNode(
+            id_=i,
+            text=f"text {i}",
+            embedding=[1.0, float(n)],
+            relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=f"doc-{i}")},
+        )
+        for n, i in enumerate(node_ids)
+    ]
+
+
+def test_snapshot_round_trip():
+    temp_folder = make_temp_folder()
+    index = VectorStoreIndex(nodes=make_nodes("a", "b", "c"), embed_model=EMBED_MODEL)
+    write_snapshot(index, temp_folder)
+    assert has_snapshot(temp_folder)
+
+    loaded = load_snapshot(temp_folder, None, EMBED_MODEL)
+    assert loaded.docstore.get_node("b").get_content() == "text b"
+    assert sorted(loaded.index_struct.nodes_dict.values()) == ["a", "b", "c"]
+    assert loaded.vector_store.get("c") == [1.0, 2.0]
+    cleanup_temp_folder(temp_folder)
+
+
+def test_snapshot_tracks_changes_after_load():
+    temp_folder = make_temp_folder()
+    index = VectorStoreIndex(nodes=make_nodes("a", "b"), embed_model=EMBED_MODEL)
+    write_snapshot(index, temp_folder)
+    loaded = load_snapshot(temp_folder, None, EMBED_MODEL)
+    loaded.insert_nodes(make_nodes("c"))
+    loaded.delete_ref_doc("doc-a", delete_from_docstore=True)
+    assert sorted(loaded.docstore.docs.keys()) == ["b", "c"]
+
+    # Rewriting the snapshot from a lazily loaded index keeps every node
+    write_snapshot(loaded, temp_folder)
+    reloaded = load_snapshot(temp_folder, None, EMBED_MODEL)
+    assert reloaded.docstore.get_node("c").get_content() == "text c"
+    cleanup_temp_folder(temp_folder)
+
+
+def test_empty_snapshot_replaces_json_base():
+    temp_folder = make_temp_folder()
+    index = VectorStoreIndex(nodes=[], embed_model=EMBED_MODEL)
+    index.storage_context.persist(persist_dir=temp_folder)
+    write_snapshot(index, temp_folder)
+    assert os.listdir(temp_folder) == ["snapshot"]
+
+    loaded = load_snapshot(temp_folder, None, EMBED_MODEL)
+    assert loaded.docstore.docs == {}
+    cleanup_temp_folder(temp_folder)
+
+
+def test_snapshot_with_numpy_store():
+    temp_folder = make_temp_folder()
+    write_snapshot(numpy_index(make_nodes("a", "b")), temp_folder)
+    loaded = load_snapshot(
+        temp_folder,
+        NumpyVectorStore.from_persist_dir(snapshot_dir(temp_folder)),
+        EMBED_MODEL,
+    )
+    result = loaded.as_retriever(similarity_top_k=1).retrieve("text a")
+    assert len(result) == 1
+    cleanup_temp_folder(temp_folder)
+
+
+def numpy_index(nodes):
+    return VectorStoreIndex(
+        nodes=nodes,
+        embed_model=EMBED_MODEL,
+        storage_context=StorageContext.from_defaults(vector_store=NumpyVectorStore()),
+    )
+
+
+def test_snapshot_loads_after_switching_vector_store():
+    temp_folder = make_temp_folder()
+    write_snapshot(
+        VectorStoreIndex(nodes=make_nodes("a", "b"), embed_model=EMBED_MODEL),
+        temp_folder,
+    )
+    loaded = load_snapshot(
+        temp_folder,
+        NumpyVectorStore.from_persist_dir(snapshot_dir(temp_folder)),
+        EMBED_MODEL,
+    )
+    assert isinstance(loaded.vector_store, NumpyVectorStore)
+    assert len(loaded.vector_store) == 2
+    loaded.delete_ref_doc("doc-a", delete_from_docstore=True)
+    assert len(loaded.vector_store) == 1
+
+    write_snapshot(numpy_index(make_nodes("a", "b")), temp_folder)
+    loaded = load_snapshot(temp_folder, None, EMBED_MODEL)
+    assert isinstance(loaded.vector_store, SimpleVectorStore)
+    result = loaded.as_retriever(similarity_top_k=2).retrieve("text a")
+    assert sorted(n.node.node_id for n in result) == ["a", "b"]
+    cleanup_temp_folder(temp_folder)
+
+
+def test_document_exists_does_not_parse_records(monkeypatch):
+    temp_folder = make_temp_folder()
+    write_snapshot(
+        VectorStoreIndex(nodes=make_nodes("a", "b"), embed_model=EMBED_MODEL),
+        temp_folder,
+    )
+    loaded = load_snapshot(temp_folder, None, EMBED_MODEL)
+
+    read_snapshot = SnapshotKVStore._read_snapshot
+
+    def read_metadata_only(self, row, collection):
+        assert collection != NODE_COLLECTION, "node record parsed"
+        return read_snapshot(self, row, collection)
+
+    monkeypatch.setattr(SnapshotKVStore, "_read_snapshot", read_metadata_only)
+    assert loaded.docstore.document_exists("a")
+    assert not loaded.docstore.document_exists("c")
+    loaded.docstore.delete_document("a")
+    assert not loaded.docstore.document_exists("a")
+    cleanup_temp_folder(temp_folder)
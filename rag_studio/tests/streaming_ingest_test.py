@@ -0,0 +1,34 @@
+from rag_studio.streaming_ingest import iter_documents, iter_node_batches
+from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
+
+
+def write_log_file(folder, line_count):
+    path = f"{folder}/big.log"
+    with open(path, "w", encoding="UTF-8") as f:
+        for n in range(line_count):
+            f.write(f"2024-06-01 12:00:{n % 60:02d} ERROR request {n} failed\n")
+    return path
+
+
+def test_documents_are_read_in_blocks_of_whole_lines():
+    temp_folder = make_temp_folder()
+    path = write_log_file(temp_folder, 1000)
+    blocks = list(iter_documents(path, block_size=4096))
+    assert len(blocks) > 1
+    assert all(document.text.endswith("\n") for document, _ in blocks)
+    with open(path, "r", encoding="UTF-8") as f:
+        assert "".join(document.text for document, _ in blocks) == f.read()
+    assert blocks[-1][1] == 1.0
+    assert blocks[0][0].metadata["file_name"] == "big.log"
+    cleanup_temp_folder(temp_folder)
+
+
+def test_node_batches_are_bounded():
+    temp_folder = make_temp_folder()
+    path = write_log_file(temp_folder, 5000)
+    batches = list(iter_node_batches(path, batch_size=16, block_size=8192))
+    assert len(batches) > 1
+    assert all(len(nodes) <= 16 for nodes, _ in batches)
+    progress = [fraction for _, fraction in batches]
+    assert progress == sorted(progress)
+    cleanup_temp_folder(temp_folder)
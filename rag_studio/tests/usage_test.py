@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from rag_studio.inference.async_vllm import CHAT_STAGE, COMPLETE_STAGE
+from rag_studio.inference.usage import context_tokens, generation_usage
+
+
+def make_output(prompt_tokens, *sample_tokens):
+    return SimpleNamespace(
+        prompt_token_ids=list(range(prompt_tokens)),
+        outputs=[SimpleNamespace(token_ids=list(range(n))) for n in sample_tokens],
+    )
+
+
+def test_usage_sums_every_call_and_sample():
+    usage = generation_usage(
+        [(COMPLETE_STAGE, make_output(10, 4)), (COMPLETE_STAGE, make_output(20, 3, 5))]
+    )
+    assert usage == {"prompt_tokens": 30, "completion_tokens": 12, "total_tokens": 42}
+
+
+def test_chat_usage_is_split_into_condense_and_answer():
+    usage = generation_usage(
+        [(COMPLETE_STAGE, make_output(15, 6)), (CHAT_STAGE, make_output(40, 7, 8, 9))],
+        chat=True,
+        retrieved_context_tokens=25,
+    )
+    assert usage["total_tokens"] == 15 + 6 + 40 + 24
+    assert usage["stages"] == {
+        "condense": {"prompt_tokens": 15, "completion_tokens": 6},
+        "answer": {"prompt_tokens": 40, "completion_tokens": 24},
+        "retrieved_context": {"prompt_tokens": 25},
+    }
+
+
+def test_completion_calls_are_the_answer_outside_chat():
+    usage = generation_usage(
+        [(COMPLETE_STAGE, make_output(15, 6))], retrieved_context_tokens=0
+    )
+    assert set(usage["stages"]) == {"answer", "retrieved_context"}
+
+
+def test_cached_answer_uses_no_tokens():
+    assert generation_usage([]) == {
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+    }
+
+
+class WordTokenizer:
+    def encode(self, text, add_special_tokens=True):
+        return text.split()
+
+
+def test_context_tokens_counts_each_retrieved_chunk():
+    nodes = [
+        NodeWithScore(node=TextNode(text="three word chunk"), score=1.0),
+        NodeWithScore(node=TextNode(text="two words"), score=0.5),
+    ]
+    assert context_tokens(WordTokenizer(), nodes) == 5
@@ -0,0 +1,204 @@
+"""Approximate nearest neighbour search using an IVF-flat index.
+
+The normalised vectors are clustered with spherical k-means, and each vector
+is filed under its nearest centroid (its inverted list). A query only scores
+the vectors in the `nprobe` lists whose centroids are closest to it, so search
+cost grows with nprobe * N / nlist rather than with N. Raising nprobe trades
+speed for recall."""
+
+import logging
+import math
+import os
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+from rag_studio.vector_stores.numpy_store import (
+    NumpyVectorStore,
+    normalize_rows,
+    save_array,
+    top_k_indices,
+)
+
+logger = logging.getLogger(__name__)
+
+ASSIGN_CHUNK_SIZE = 65536
+TRAINING_SAMPLES_PER_LIST = 64
+
+
+def train_centroids(vectors, nlist, iterations=10, seed=0):
+    """Spherical k-means over a sample of the (normalised) vectors."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * TRAINING_SAMPLES_PER_LIST)
+    sample_rows = np.sort(rng.choice(len(vectors), size=sample_size, replace=False))
+    sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        counts = np.bincount(assignments, minlength=nlist)
+        order = np.argsort(assignments, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        non_empty = np.flatnonzero(counts)
+        sums = np.zeros_like(centroids)
+        sums[non_empty] = np.add.reduceat(sample[order], starts[non_empty], axis=0)
+        # Re-seed any list that lost all of its members
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = sample[rng.choice(len(sample), size=len(empty))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def assign_to_centroids(vectors, centroids):
+    """Nearest centroid for every vector, computed in chunks to bound memory."""
+    if len(vectors) == 0:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate(
+        [
+            np.argmax(vectors[start : start + ASSIGN_CHUNK_SIZE] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), ASSIGN_CHUNK_SIZE)
+        ]
+    ).astype(np.int32)
+
+
+class IvfFlatVectorStore(NumpyVectorStore):
+    """NumpyVectorStore with an IVF-flat index over the matrix.
+
+    Until the store holds `min_train_size` vectors, queries use exact search.
+    After training, new vectors are filed under their nearest existing centroid
+    as they are added, and the centroids are retrained once the store has grown
+    by `retrain_growth` times since they were last trained."""
+
+    nlist: Optional[int] = None
+    nprobe: int = 16
+    min_train_size: int = 10000
+    retrain_growth: float = 4.0
+
+    _centroids: Any = PrivateAttr(default=None)
+    _assignments: Any = PrivateAttr(default=None)
+    _trained_size: int = PrivateAttr(default=0)
+    _lists: Any = PrivateAttr(default=None)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "IvfFlatVectorStore"
+
+    @property
+    def is_trained(self):
+        return self._centroids is not None
+
+    def _centroid_paths(self, base_path):
+        return f"{base_path}.ivf_centroids.npy", f"{base_path}.ivf_assignments.npy"
+
+    def _load_extras(self, base_path):
+        super()._load_extras(base_path)
+        centroids_path, assignments_path = self._centroid_paths(base_path)
+        if os.path.exists(centroids_path):
+            self._centroids = np.load(centroids_path)
+            self._assignments = np.load(assignments_path)
+            self._trained_size = len(self._assignments)
+        else:
+            self._maybe_train()
+
+    def _persist_extras(self, base_path):
+        super()._persist_extras(base_path)
+        centroids_path, assignments_path = self._centroid_paths(base_path)
+        if self.is_trained:
+            save_array(centroids_path, self._centroids)
+            save_array(assignments_path, self._assignments)
+        else:
+            for path in (centroids_path, assignments_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _drop_rows(self, live):
+        super()._drop_rows(live)
+        if self.is_trained:
+            self._assignments = self._assignments[live]
+            self._lists = None
+
+    def _maybe_train(self):
+        with self._lock:
+            live_count = len(self)
+            if live_count == 0 or live_count < self.min_train_size:
+                return
+            if (
+                self.is_trained
+                and live_count < self._trained_size * self.retrain_growth
+            ):
+                return
+            matrix = self._consolidate()
+            nlist = min(
+                self.nlist or max(1, int(4 * math.sqrt(live_count))), live_count
+            )
+            logger.info(
+                "Training IVF index with %d lists over %d vectors", nlist, live_count
+            )
+            self._centroids = train_centroids(matrix, nlist)
+            self._assignments = assign_to_centroids(matrix, self._centroids)
+            self._trained_size = live_count
+            self._lists = None
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        with self._lock:
+            ids = super().add(nodes, **add_kwargs)
+            if ids and self.is_trained:
+                new_assignments = assign_to_centroids(
+                    self._pending[-1], self._centroids
+                )
+                self._assignments = np.concatenate(
+                    [self._assignments, new_assignments]
+                )
+                self._lists = None
+            self._maybe_train()
+        return ids
+
+    def _inverted_lists(self):
+        """Row numbers grouped by list - list c is order[offsets[c]:offsets[c + 1]].
+        Returned with the centroids they were built for."""
+        with self._lock:
+            if self._lists is None:
+                order = np.argsort(self._assignments, kind="stable")
+                offsets = np.searchsorted(
+                    self._assignments[order], np.arange(len(self._centroids) + 1)
+                )
+                self._lists = (order, offsets)
+            return self._centroids, self._lists
+
+    def _scores_batches(self):
+        # Once trained, each query only scores its probed lists instead
+        self._maybe_train()
+        return not self.is_trained and super()._scores_batches()
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        # A store migrated from JSON may not have been trained yet
+        self._maybe_train()
+        # Restricted queries only score their own candidates anyway
+        if not self.is_trained or query.node_ids is not None or query.doc_ids is not None:
+            return super().query(query, **kwargs)
+        if query.filters is not None:
+            raise ValueError("Metadata filters are not supported by IvfFlatVectorStore")
+        query_vector = normalize_rows(query.query_embedding)
+        centroids, (order, offsets) = self._inverted_lists()
+        nprobe = min(self.nprobe, len(centroids))
+        probe_lists = top_k_indices(centroids @ query_vector, nprobe)
+        rows = np.sort(
+            np.concatenate([order[offsets[c] : offsets[c + 1]] for c in probe_lists])
+        )
+        rows = rows[~self._deleted[rows]]
+        if len(rows) == 0:
+            return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+        top_rows, top_scores = self._top_rows(
+            rows, query_vector, query.similarity_top_k
+        )
+        return VectorStoreQueryResult(
+            nodes=None,
+            similarities=top_scores.tolist(),
+            ids=[self._ids[row] for row in top_rows],
+        )
@@ -0,0 +1,441 @@
+"""A vector store that keeps all embeddings in one contiguous float32 matrix.
+
+The matrix is persisted as a plain .npy file and memory-mapped on load, so
+opening a large index doesn't parse JSON or build a Python list per vector,
+and a query is a single matrix-vector product followed by argpartition."""
+
+import json
+import logging
+import os
+import threading
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.simple import (
+    SimpleVectorStore,
+    SimpleVectorStoreData,
+)
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+from rag_studio.vector_stores.quantization import (
+    QUANTIZATION_MODES,
+    quantize_in_blocks,
+    score,
+)
+
+logger = logging.getLogger(__name__)
+
+# Most query scores (rows x queries) held at once when scoring a batch -
+# 256MB of float32
+BATCH_SCORE_BUDGET = 1 << 26
+
+# Matches the name that StorageContext uses for the default vector store,
+# so the files sit alongside the docstore and index store in the persist dir
+DEFAULT_PERSIST_NAME = "default__vector_store"
+
+
+def persist_paths(persist_path):
+    """Derive the matrix and ids file paths from the path StorageContext asks
+    us to persist to (which will end in .json)."""
+    base, _ = os.path.splitext(persist_path)
+    return f"{base}.npy", f"{base}.ids.json"
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k_indices(scores, k):
+    """Indices of the k highest scores, best first."""
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def save_array(path, array):
+    """Write via a temporary file and rename, so that a memmap of the previous
+    version of the file stays valid while we write the new one."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """Embeddings are stored L2-normalised, so the dot product is the cosine
+    similarity - the same score that SimpleVectorStore reports.
+
+    With quantization set, queries score against quantized codes held in
+    memory, and (if rescore is set) the best rescore_factor * top_k of those
+    are rescored against the full precision matrix."""
+
+    stores_text: bool = False
+    quantization: str = "none"
+    rescore: bool = True
+    rescore_factor: int = 4
+
+    _matrix: Any = PrivateAttr()
+    _pending: List[Any] = PrivateAttr()
+    _ids: List[str] = PrivateAttr()
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr()
+    _row_by_id: dict = PrivateAttr()
+    # Ref doc id -> its live rows
+    _rows_by_ref_doc: dict = PrivateAttr()
+    _deleted: Any = PrivateAttr()
+    _dirty: bool = PrivateAttr()
+    # Quantized copy of the rows of _matrix (lagging it until _sync_codes)
+    _codes: Any = PrivateAttr(default=None)
+    _scales: Any = PrivateAttr(default=None)
+    # Guards the arrays against concurrent queries (which fold in pending rows
+    # and quantize them lazily) and updates
+    _lock: Any = PrivateAttr()
+
+    def __init__(self, matrix=None, ids=None, ref_doc_ids=None, **kwargs):
+        super().__init__(**kwargs)
+        if self.quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode: {self.quantization}")
+        self._matrix = matrix if matrix is not None else np.zeros((0, 0), np.float32)
+        self._pending = []
+        self._ids = list(ids or [])
+        self._ref_doc_ids = list(ref_doc_ids or [])
+        self._index_rows()
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def _index_rows(self):
+        """Rebuild the lookups from node and ref doc ids to rows, with every
+        row live."""
+        self._row_by_id = {node_id: row for row, node_id in enumerate(self._ids)}
+        self._rows_by_ref_doc = {}
+        for row, ref_doc_id in enumerate(self._ref_doc_ids):
+            self._rows_by_ref_doc.setdefault(ref_doc_id, []).append(row)
+        self._deleted = np.zeros(len(self._ids), dtype=bool)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NumpyVectorStore"
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir, **kwargs):
+        """Load the store from a persist dir, migrating from a SimpleVectorStore
+        JSON file if that's all that is there. Extra kwargs are passed through to
+        the constructor."""
+        json_path = os.path.join(persist_dir, f"{DEFAULT_PERSIST_NAME}.json")
+        matrix_path, ids_path = persist_paths(json_path)
+        if os.path.exists(matrix_path):
+            logger.info("Memory-mapping vector matrix at %s", matrix_path)
+            with open(ids_path, "r", encoding="UTF-8") as f:
+                id_data = json.load(f)
+            store = cls(
+                matrix=np.load(matrix_path, mmap_mode="r"),
+                ids=id_data["ids"],
+                ref_doc_ids=id_data["ref_doc_ids"],
+                **kwargs,
+            )
+            store._load_extras(os.path.splitext(json_path)[0])
+            return store
+        if os.path.exists(json_path):
+            logger.info("Migrating JSON vector store at %s", json_path)
+            return cls.from_simple_vector_store(
+                SimpleVectorStore.from_persist_path(json_path), **kwargs
+            )
+        return cls(**kwargs)
+
+    @classmethod
+    def from_simple_vector_store(cls, simple_store: SimpleVectorStore, **kwargs):
+        data = simple_store.data
+        ids = list(data.embedding_dict.keys())
+        if not ids:
+            return cls(**kwargs)
+        store = cls(
+            matrix=normalize_rows([data.embedding_dict[i] for i in ids]),
+            ids=ids,
+            ref_doc_ids=[data.text_id_to_ref_doc_id.get(i) for i in ids],
+            **kwargs,
+        )
+        store._dirty = True
+        return store
+
+    def to_simple_vector_store(self) -> SimpleVectorStore:
+        """The live rows, with their embeddings as stored (normalised)."""
+        with self._lock:
+            matrix = self._consolidate()
+            rows = sorted(self._row_by_id.values())
+            ids = [self._ids[row] for row in rows]
+            return SimpleVectorStore(
+                data=SimpleVectorStoreData(
+                    embedding_dict=dict(zip(ids, matrix[rows].tolist())),
+                    text_id_to_ref_doc_id={
+                        self._ids[row]: self._ref_doc_ids[row]
+                        for row in rows
+                        if self._ref_doc_ids[row] is not None
+                    },
+                )
+            )
+
+    def _codes_paths(self, base_path, mode):
+        return f"{base_path}.{mode}_codes.npy", f"{base_path}.{mode}_scales.npy"
+
+    def _load_extras(self, base_path):
+        """Load any files persisted next to the matrix - subclasses extend this."""
+        if self.quantization == "none":
+            return
+        codes_path, scales_path = self._codes_paths(base_path, self.quantization)
+        if os.path.exists(codes_path):
+            self._codes = np.load(codes_path)
+            if os.path.exists(scales_path):
+                self._scales = np.load(scales_path)
+
+    def _persist_extras(self, base_path):
+        """Persist extra files next to the matrix - subclasses extend this."""
+        for mode in QUANTIZATION_MODES[1:]:
+            for path in self._codes_paths(base_path, mode):
+                if mode != self.quantization and os.path.exists(path):
+                    os.remove(path)
+        if self.quantization == "none":
+            return
+        self._sync_codes()
+        codes_path, scales_path = self._codes_paths(base_path, self.quantization)
+        save_array(codes_path, self._codes)
+        if self._scales is not None:
+            save_array(scales_path, self._scales)
+
+    def _sync_codes(self):
+        """Quantize any rows of the matrix that don't have codes yet."""
+        with self._lock:
+            matrix = self._consolidate()
+            coded = 0 if self._codes is None else len(self._codes)
+            if self.quantization == "none" or coded == len(matrix):
+                return
+            codes, scales = quantize_in_blocks(matrix[coded:], self.quantization)
+            if self._codes is None:
+                self._codes, self._scales = codes, scales
+            else:
+                self._codes = np.concatenate([self._codes, codes])
+                if scales is not None:
+                    self._scales = np.concatenate([self._scales, scales])
+
+    def _scoring_arrays(self):
+        """The matrix, codes, scales and deleted flags as of now - all with the
+        same rows, however many are added while a query uses them."""
+        with self._lock:
+            self._sync_codes()
+            return self._matrix, self._codes, self._scales, self._deleted
+
+    def _drop_rows(self, live):
+        """Physically remove the rows that aren't marked live."""
+        with self._lock:
+            if self.quantization != "none":
+                self._sync_codes()
+                self._codes = self._codes[live]
+                if self._scales is not None:
+                    self._scales = self._scales[live]
+            self._matrix = self._consolidate()[live]
+            self._ids = [i for i, keep in zip(self._ids, live) if keep]
+            self._ref_doc_ids = [
+                r for r, keep in zip(self._ref_doc_ids, live) if keep
+            ]
+            self._index_rows()
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def __len__(self):
+        return len(self._row_by_id)
+
+    def __bool__(self):
+        # StorageContext.from_defaults tests `if vector_store`, and would
+        # swap an empty store for a SimpleVectorStore
+        return True
+
+    @property
+    def tombstone_count(self):
+        """Rows marked deleted but not yet dropped from the matrix."""
+        return len(self._ids) - len(self._row_by_id)
+
+    def _consolidate(self):
+        """Fold vectors added since the last persist into the main matrix."""
+        with self._lock:
+            if self._pending:
+                pending = np.vstack(self._pending)
+                if len(self._matrix) == 0:
+                    self._matrix = pending
+                else:
+                    self._matrix = np.vstack([self._matrix, pending])
+                self._pending = []
+            return self._matrix
+
+    def get(self, text_id: str) -> List[float]:
+        row = self._row_by_id[text_id]
+        return self._consolidate()[row].tolist()
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        vectors = normalize_rows([node.get_embedding() for node in nodes])
+        with self._lock:
+            self._pending.append(vectors)
+            for node in nodes:
+                self._row_by_id[node.node_id] = len(self._ids)
+                self._rows_by_ref_doc.setdefault(node.ref_doc_id, []).append(
+                    len(self._ids)
+                )
+                self._ids.append(node.node_id)
+                self._ref_doc_ids.append(node.ref_doc_id)
+            self._deleted = np.concatenate(
+                [self._deleted, np.zeros(len(nodes), dtype=bool)]
+            )
+            self._dirty = True
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Rows are only marked as deleted here - they are physically dropped
+        the next time the store is persisted."""
+        with self._lock:
+            for row in self._rows_by_ref_doc.pop(ref_doc_id, []):
+                self._deleted[row] = True
+                del self._row_by_id[self._ids[row]]
+                self._dirty = True
+
+    def _candidate_rows(self, query: VectorStoreQuery):
+        if query.filters is not None:
+            raise ValueError("Metadata filters are not supported by NumpyVectorStore")
+        rows = None
+        if query.node_ids is not None:
+            rows = {self._row_by_id[i] for i in query.node_ids if i in self._row_by_id}
+            if len(rows) == len(self._row_by_id) and query.doc_ids is None:
+                # Every live row - scored straight from the matrix, without
+                # gathering a copy of it
+                return None
+            rows = sorted(rows)
+        if query.doc_ids is not None:
+            doc_rows = sorted(
+                row
+                for ref_doc_id in set(query.doc_ids)
+                for row in self._rows_by_ref_doc.get(ref_doc_id, [])
+            )
+            rows = doc_rows if rows is None else sorted(set(rows) & set(doc_rows))
+        return None if rows is None else np.asarray(rows, dtype=np.int64)
+
+    def _top_rows(self, rows, query_vector, top_k):
+        """The best top_k of the given rows (all live rows if None) and their
+        scores, best first."""
+        matrix, codes, scales, deleted = self._scoring_arrays()
+        if self.quantization == "none":
+            scores = (matrix if rows is None else matrix[rows]) @ query_vector
+        else:
+            if rows is not None:
+                codes = codes[rows]
+                scales = None if scales is None else scales[rows]
+            scores = score(codes, scales, query_vector, self.quantization, matrix.shape[1])
+        if rows is None:
+            scores[deleted] = -np.inf
+            rows = np.arange(len(scores))
+        if self.quantization != "none" and self.rescore:
+            candidates = top_k_indices(scores, top_k * self.rescore_factor)
+            # Sorted, so rescoring reads the memory-mapped matrix in order
+            rows = np.sort(rows[candidates[np.isfinite(scores[candidates])]])
+            scores = matrix[rows] @ query_vector
+        top = top_k_indices(scores, top_k)
+        top = top[np.isfinite(scores[top])]
+        return rows[top], scores[top]
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if len(self._row_by_id) == 0 or query.query_embedding is None:
+            return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+        top_rows, top_scores = self._top_rows(
+            self._candidate_rows(query),
+            normalize_rows(query.query_embedding),
+            query.similarity_top_k,
+        )
+        return VectorStoreQueryResult(
+            nodes=None,
+            similarities=top_scores.tolist(),
+            ids=[self._ids[row] for row in top_rows],
+        )
+
+    def _scores_batches(self):
+        """Whether unrestricted queries can be scored together, as one
+        matrix-matrix product against the full precision matrix."""
+        return self.quantization == "none"
+
+    def query_batch(
+        self, queries: List[VectorStoreQuery]
+    ) -> List[VectorStoreQueryResult]:
+        """Answers several queries at once - unrestricted queries are scored in
+        groups with one matrix-matrix product each, anything else falls back
+        to query()."""
+        results = [None] * len(queries)
+        batchable = []
+        for position, query in enumerate(queries):
+            if (
+                self._scores_batches()
+                and len(self._row_by_id) > 0
+                and query.query_embedding is not None
+                and query.node_ids is None
+                and query.doc_ids is None
+                and query.filters is None
+            ):
+                batchable.append(position)
+            else:
+                results[position] = self.query(query)
+        if not batchable:
+            return results
+
+        matrix, _, _, deleted = self._scoring_arrays()
+        group_size = max(1, BATCH_SCORE_BUDGET // len(matrix))
+        for start in range(0, len(batchable), group_size):
+            group = batchable[start : start + group_size]
+            query_vectors = normalize_rows(
+                [queries[position].query_embedding for position in group]
+            )
+            scores = matrix @ query_vectors.T
+            scores[deleted] = -np.inf
+            for column, position in enumerate(group):
+                column_scores = scores[:, column]
+                top = top_k_indices(column_scores, queries[position].similarity_top_k)
+                top = top[np.isfinite(column_scores[top])]
+                results[position] = VectorStoreQueryResult(
+                    nodes=None,
+                    similarities=column_scores[top].tolist(),
+                    ids=[self._ids[row] for row in top],
+                )
+        return results
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        if fs is not None:
+            raise ValueError("NumpyVectorStore only supports the local filesystem")
+        matrix_path, ids_path = persist_paths(persist_path)
+        base_path = os.path.splitext(persist_path)[0]
+        codes_missing = self.quantization != "none" and not os.path.exists(
+            self._codes_paths(base_path, self.quantization)[0]
+        )
+        if not self._dirty and not codes_missing and os.path.exists(matrix_path):
+            return
+        live = ~self._deleted
+        if not live.all():
+            self._drop_rows(live)
+        matrix = self._consolidate()
+        os.makedirs(os.path.dirname(persist_path), exist_ok=True)
+        save_array(matrix_path, np.ascontiguousarray(matrix, dtype=np.float32))
+        with open(ids_path, "w", encoding="UTF-8") as f:
+            json.dump({"ids": self._ids, "ref_doc_ids": self._ref_doc_ids}, f)
+        self._persist_extras(base_path)
+        # Any JSON store we migrated from is now stale
+        if os.path.exists(persist_path):
+            os.remove(persist_path)
+        # Re-open from disk so the matrix is paged in on demand again
+        self._matrix = np.load(matrix_path, mmap_mode="r")
+        self._dirty = False
@@ -0,0 +1,82 @@
+"""Compact in-memory codes for the embedding matrix.
+
+With quantization enabled, queries score against the codes rather than the
+float32 matrix, which stays memory-mapped on disk and is only read for the
+rows being rescored:
+
+* "float16" - half precision, 2 bytes per dimension
+* "int8" - each vector scaled by its own max magnitude into [-127, 127],
+  1 byte per dimension plus one float32 scale
+* "binary" - the sign bit of each dimension, 1 bit per dimension, scored by
+  Hamming distance - only good enough as a pre-filter for rescoring"""
+
+import numpy as np
+
+QUANTIZATION_MODES = ("none", "float16", "int8", "binary")
+
+# Rows scored per block, bounding the float32 temporaries
+SCORE_BLOCK_SIZE = 16384
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def quantize(vectors, mode):
+    """Returns (codes, scales) - scales is None except for int8."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if mode == "float16":
+        return vectors.astype(np.float16), None
+    if mode == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    if mode == "binary":
+        return np.packbits(vectors > 0, axis=1), None
+    raise ValueError(f"Unknown quantization mode: {mode}")
+
+
+def quantize_in_blocks(matrix, mode):
+    """Quantize a (possibly memory-mapped) matrix without reading it all into
+    memory as float32 at once."""
+    blocks = [
+        quantize(matrix[start : start + SCORE_BLOCK_SIZE], mode)
+        for start in range(0, len(matrix), SCORE_BLOCK_SIZE)
+    ]
+    if not blocks:
+        return quantize(np.zeros((0, matrix.shape[1]), np.float32), mode)
+    codes = np.concatenate([codes for codes, _ in blocks])
+    scales = None if blocks[0][1] is None else np.concatenate([s for _, s in blocks])
+    return codes, scales
+
+
+def blockwise(row_count, score_block):
+    """Concatenate score_block(start, stop) over blocks of rows."""
+    if row_count == 0:
+        return np.zeros(0, np.float32)
+    return np.concatenate(
+        [
+            score_block(start, start + SCORE_BLOCK_SIZE)
+            for start in range(0, row_count, SCORE_BLOCK_SIZE)
+        ]
+    )
+
+
+def score(codes, scales, query_vector, mode, dim):
+    """Approximate cosine similarities of the query against every code row."""
+    if mode == "binary":
+        query_bits = np.packbits(query_vector > 0)
+        hamming = blockwise(
+            len(codes),
+            lambda start, stop: POPCOUNT[
+                np.bitwise_xor(codes[start:stop], query_bits)
+            ].sum(axis=1, dtype=np.int32),
+        )
+        # The fraction of differing signs estimates the angle between them
+        return np.cos(np.pi * hamming / dim).astype(np.float32)
+    scores = blockwise(
+        len(codes),
+        lambda start, stop: codes[start:stop].astype(np.float32) @ query_vector,
+    )
+    if mode == "int8":
+        scores *= scales
+    return scores
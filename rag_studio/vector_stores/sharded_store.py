@@ -0,0 +1,243 @@
+"""A vector store that hash-partitions documents across several shards.
+
+Each shard is a NumpyVectorStore (or IvfFlatVectorStore) persisted in its own
+shard-<i> sub-directory, and a manifest records how many were written. Every node of a document lands in the same shard, so
+a delete only touches one shard. Queries run against all of the shards
+concurrently - the matrix products release the GIL, so a thread pool spreads
+them across cores - and the per-shard top-k results are merged."""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+from rag_studio.segment_log import write_json_atomically
+from rag_studio.vector_stores.numpy_store import DEFAULT_PERSIST_NAME, NumpyVectorStore
+
+logger = logging.getLogger(__name__)
+
+SHARD_DIR_PATTERN = re.compile(r"^shard-(\d+)$")
+SHARD_MANIFEST_NAME = "shards.json"
+
+
+def shard_for(key, shard_count):
+    """Stable across processes, unlike hash()."""
+    digest = hashlib.sha1(key.encode("UTF-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+def shard_dir(persist_dir, shard):
+    return f"{persist_dir}/shard-{shard}"
+
+
+def shard_dirs_on_disk(persist_dir):
+    if not os.path.isdir(persist_dir):
+        return []
+    shards = sorted(
+        int(match.group(1))
+        for match in map(SHARD_DIR_PATTERN.match, os.listdir(persist_dir))
+        if match
+    )
+    return [shard_dir(persist_dir, shard) for shard in shards]
+
+
+def existing_shard_dirs(persist_dir):
+    """The shard dirs written by the last persist, as listed in its manifest.
+    Any others - say left in a repo by a push from before the shard count was
+    lowered - hold stale vectors, and are ignored."""
+    manifest_path = f"{persist_dir}/{SHARD_MANIFEST_NAME}"
+    if not os.path.exists(manifest_path):
+        # Persisted before there was a manifest
+        return shard_dirs_on_disk(persist_dir)
+    with open(manifest_path, encoding="UTF-8") as f:
+        shard_count = json.load(f)["shard_count"]
+    return [shard_dir(persist_dir, shard) for shard in range(shard_count)]
+
+
+def partition(stores, shard_count, shard_class, **kwargs):
+    """Redistribute the live rows of the given stores across shard_count new
+    stores - used to shard an existing index, or change its shard count."""
+    rows_by_shard = [([], [], []) for _ in range(shard_count)]
+    for store in stores:
+        matrix = store._consolidate()
+        for row, (node_id, ref_doc_id) in enumerate(
+            zip(store._ids, store._ref_doc_ids)
+        ):
+            if store._deleted[row]:
+                continue
+            vectors, ids, ref_doc_ids = rows_by_shard[
+                shard_for(ref_doc_id or node_id, shard_count)
+            ]
+            vectors.append(matrix[row])
+            ids.append(node_id)
+            ref_doc_ids.append(ref_doc_id)
+    shards = []
+    for vectors, ids, ref_doc_ids in rows_by_shard:
+        shard = shard_class(
+            matrix=np.asarray(vectors, dtype=np.float32) if vectors else None,
+            ids=ids,
+            ref_doc_ids=ref_doc_ids,
+            **kwargs,
+        )
+        shard._dirty = True
+        shards.append(shard)
+    return shards
+
+
+class ShardedVectorStore(BasePydanticVectorStore):
+    stores_text: bool = False
+
+    _shards: List[NumpyVectorStore] = PrivateAttr()
+    _executor: Any = PrivateAttr()
+
+    def __init__(self, shards, **kwargs):
+        super().__init__(**kwargs)
+        self._shards = shards
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(shards), thread_name_prefix="vector-shard"
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ShardedVectorStore"
+
+    @classmethod
+    def from_persist_dir(
+        cls, persist_dir, shard_count, shard_class=NumpyVectorStore, **kwargs
+    ):
+        """Load the shards in parallel. An unsharded store, or shards persisted
+        with a different shard count, are re-partitioned. Extra kwargs are
+        passed through to the shard constructor."""
+        dirs = existing_shard_dirs(persist_dir)
+        load_dirs = dirs or [persist_dir]
+        with ThreadPoolExecutor(max_workers=len(load_dirs)) as executor:
+            stores = list(
+                executor.map(
+                    lambda path: shard_class.from_persist_dir(path, **kwargs),
+                    load_dirs,
+                )
+            )
+        if len(dirs) == shard_count:
+            return cls(stores)
+        logger.info(
+            "Partitioning %d vectors into %d shards",
+            sum(len(store) for store in stores),
+            shard_count,
+        )
+        return cls(partition(stores, shard_count, shard_class, **kwargs))
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @property
+    def shards(self):
+        return list(self._shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def __bool__(self):
+        # Like NumpyVectorStore - an empty store mustn't be replaced by
+        # StorageContext.from_defaults
+        return True
+
+    @property
+    def tombstone_count(self):
+        return sum(shard.tombstone_count for shard in self._shards)
+
+    def _shard_for_node(self, node: BaseNode):
+        return self._shards[
+            shard_for(node.ref_doc_id or node.node_id, len(self._shards))
+        ]
+
+    def get(self, text_id: str) -> List[float]:
+        for shard in self._shards:
+            if text_id in shard._row_by_id:
+                return shard.get(text_id)
+        raise KeyError(text_id)
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        nodes_by_shard = {}
+        for node in nodes:
+            nodes_by_shard.setdefault(id(self._shard_for_node(node)), []).append(node)
+        for shard in self._shards:
+            shard_nodes = nodes_by_shard.get(id(shard))
+            if shard_nodes:
+                shard.add(shard_nodes, **add_kwargs)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self._shards[shard_for(ref_doc_id, len(self._shards))].delete(
+            ref_doc_id, **delete_kwargs
+        )
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        results = list(
+            self._executor.map(lambda shard: shard.query(query, **kwargs), self._shards)
+        )
+        return self._merge(query, results)
+
+    def query_batch(
+        self, queries: List[VectorStoreQuery]
+    ) -> List[VectorStoreQueryResult]:
+        results_by_shard = list(
+            self._executor.map(lambda shard: shard.query_batch(queries), self._shards)
+        )
+        return [
+            self._merge(query, [results[position] for results in results_by_shard])
+            for position, query in enumerate(queries)
+        ]
+
+    @staticmethod
+    def _merge(query, results):
+        merged = sorted(
+            (
+                (similarity, node_id)
+                for result in results
+                for similarity, node_id in zip(result.similarities, result.ids)
+            ),
+            reverse=True,
+        )[: query.similarity_top_k]
+        return VectorStoreQueryResult(
+            nodes=None,
+            similarities=[similarity for similarity, _ in merged],
+            ids=[node_id for _, node_id in merged],
+        )
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        """persist_path is the path StorageContext would persist a single store
+        to - the shards go in sub-directories next to it."""
+        persist_dir = os.path.dirname(persist_path)
+        list(
+            self._executor.map(
+                lambda item: item[1].persist(
+                    f"{shard_dir(persist_dir, item[0])}/{DEFAULT_PERSIST_NAME}.json",
+                    fs=fs,
+                ),
+                enumerate(self._shards),
+            )
+        )
+        write_json_atomically(
+            f"{persist_dir}/{SHARD_MANIFEST_NAME}", {"shard_count": len(self._shards)}
+        )
+        # Shard dirs beyond the current count, or an unsharded store that we
+        # partitioned, are now stale
+        for path in shard_dirs_on_disk(persist_dir)[len(self._shards) :]:
+            shutil.rmtree(path, ignore_errors=True)
+        for file_name in os.listdir(persist_dir):
+            if file_name.startswith(DEFAULT_PERSIST_NAME):
+                os.remove(os.path.join(persist_dir, file_name))
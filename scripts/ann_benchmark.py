@@ -0,0 +1,85 @@
+"""Recall vs latency of the IVF vector store against exact search.
+
+Run from the repo root, e.g.
+    PYTHONPATH=. python scripts/ann_benchmark.py --num-vectors 200000
+"""
+
+import argparse
+import time
+
+import numpy as np
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from rag_studio.vector_stores.ivf_store import IvfFlatVectorStore
+from rag_studio.vector_stores.numpy_store import NumpyVectorStore
+
+
+def make_clustered_vectors(rng, num_vectors, dim, num_clusters):
+    """Embeddings of real text are far from uniform - mimic that with clusters."""
+    centres = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+    labels = rng.integers(num_clusters, size=num_vectors)
+    noise = 0.5 * rng.standard_normal((num_vectors, dim)).astype(np.float32)
+    return centres[labels] + noise
+
+
+def fill_store(store, vectors, batch_size=10000):
+    for start in range(0, len(vectors), batch_size):
+        store.add(
+            [
+                TextNode(id_=str(row), text="", embedding=vectors[row].tolist())
+                for row in range(start, min(start + batch_size, len(vectors)))
+            ]
+        )
+
+
+def run_queries(store, queries, top_k):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        result = store.query(
+            VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=top_k)
+        )
+        results.append(set(result.ids))
+    elapsed_ms = 1000 * (time.perf_counter() - start) / len(queries)
+    return results, elapsed_ms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-vectors", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--nprobes", type=int, nargs="+", default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_clustered_vectors(rng, args.num_vectors, args.dim, 200)
+    query_rows = rng.choice(args.num_vectors, size=args.num_queries, replace=False)
+    queries = vectors[query_rows] + 0.3 * rng.standard_normal(
+        (args.num_queries, args.dim)
+    ).astype(np.float32)
+
+    exact = NumpyVectorStore()
+    fill_store(exact, vectors)
+    truth, exact_ms = run_queries(exact, queries, args.top_k)
+    print(f"exact: recall@{args.top_k}=1.000 latency={exact_ms:.2f}ms")
+
+    ivf = IvfFlatVectorStore(min_train_size=0)
+    start = time.perf_counter()
+    fill_store(ivf, vectors)
+    print(f"ivf: built in {time.perf_counter() - start:.1f}s")
+    for nprobe in args.nprobes:
+        ivf.nprobe = nprobe
+        found, ivf_ms = run_queries(ivf, queries, args.top_k)
+        recall = np.mean(
+            [len(f & t) / len(t) for f, t in zip(found, truth)]
+        )
+        print(
+            f"ivf nprobe={nprobe}: recall@{args.top_k}={recall:.3f} latency={ivf_ms:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
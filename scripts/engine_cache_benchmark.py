@@ -0,0 +1,62 @@
+"""Per-request overhead of getting a query / chat engine from RagStore, with
+the engine cache vs building from scratch (as every request used to).
+
+Run from the repo root, e.g.
+    PYTHONPATH=. python scripts/engine_cache_benchmark.py
+"""
+
+import argparse
+import time
+
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+
+from rag_studio.model_settings import (
+    chat_prompts_from_settings,
+    query_prompts_from_settings,
+)
+from rag_studio.ragstore import RagStore
+from rag_studio.tests.test_utils import cleanup_temp_folder, make_temp_folder
+
+
+def time_per_call_us(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return 1e6 * (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    temp_folder = make_temp_folder()
+    rag_storage = RagStore(temp_folder, embed_model=MockEmbedding(embed_dim=8))
+    rag_storage.add_document("data/paul_graham_essay.txt")
+    llm = MockLLM()
+    query_prompts = query_prompts_from_settings({})
+    chat_prompts = chat_prompts_from_settings({})
+
+    uncached_query = time_per_call_us(
+        lambda: rag_storage._build_query_engine(llm, query_prompts), args.iterations
+    )
+    cached_query = time_per_call_us(
+        lambda: rag_storage.make_query_engine(llm, query_prompts), args.iterations
+    )
+    uncached_chat = time_per_call_us(
+        lambda: rag_storage.index.as_chat_engine(
+            chat_mode="condense_plus_context", llm=llm, **chat_prompts
+        ),
+        args.iterations,
+    )
+    cached_chat = time_per_call_us(
+        lambda: rag_storage.make_chat_engine(llm, chat_prompts), args.iterations
+    )
+    print(f"query engine: uncached={uncached_query:.1f}us cached={cached_query:.1f}us")
+    print(f"chat engine: uncached={uncached_chat:.1f}us cached={cached_chat:.1f}us")
+    cleanup_temp_folder(temp_folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Throughput and latency of a running inference server as the number of
+concurrent clients grows.
+
+Start the inference server, then run from the repo root, e.g.
+    PYTHONPATH=. python scripts/inference_load_test.py --url http://localhost:8000 \
+        --concurrency 1 2 4 8 16 32 --requests-per-client 8
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import statistics
+import time
+import urllib.request
+
+QUESTIONS = [
+    "What did the author work on before college?",
+    "Why did the author switch from philosophy to AI?",
+    "What was Viaweb?",
+    "How did Y Combinator start?",
+    "What did the author learn from painting?",
+    "What is Arc?",
+    "Why did the author leave Yahoo?",
+    "What was the author's experience with the IBM 1401?",
+]
+
+
+def request_body(args, question):
+    body = {
+        "model": "rag_model",
+        "max_tokens": args.max_tokens,
+        "temperature": args.temperature,
+        "stream": args.stream,
+    }
+    if args.endpoint == "chat":
+        body["messages"] = [{"role": "user", "content": question}]
+    else:
+        body["prompt"] = question
+    return body
+
+
+def send(args, question):
+    """Returns (seconds to the first byte of the answer, total seconds)."""
+    path = "/v1/chat/completions" if args.endpoint == "chat" else "/v1/completions"
+    request = urllib.request.Request(
+        args.url.rstrip("/") + path,
+        data=json.dumps(request_body(args, question)).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=args.timeout) as response:
+        first = None
+        for _ in response:
+            if first is None:
+                first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+
+def client(args, client_id):
+    return [
+        send(args, QUESTIONS[(client_id + n) % len(QUESTIONS)])
+        for n in range(args.requests_per_client)
+    ]
+
+
+def run_level(args, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = [
+            timing
+            for timings in pool.map(lambda c: client(args, c), range(concurrency))
+            for timing in timings
+        ]
+    elapsed = time.perf_counter() - start
+    latencies = sorted(total for _, total in results)
+    first_bytes = sorted(first for first, _ in results)
+    return {
+        "requests_per_second": len(results) / elapsed,
+        "p50_seconds": statistics.median(latencies),
+        "p95_seconds": latencies[int(0.95 * (len(latencies) - 1))],
+        "p50_first_byte_seconds": statistics.median(first_bytes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--endpoint", choices=["chat", "completions"], default="chat")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests-per-client", type=int, default=4)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    print(
+        f"{'clients':>8} {'req/s':>8} {'p50 s':>8} {'p95 s':>8} {'p50 first byte s':>17}"
+    )
+    baseline = None
+    for concurrency in args.concurrency:
+        level = run_level(args, concurrency)
+        baseline = baseline or level["requests_per_second"]
+        print(
+            f"{concurrency:>8} {level['requests_per_second']:>8.2f} "
+            f"{level['p50_seconds']:>8.2f} {level['p95_seconds']:>8.2f} "
+            f"{level['p50_first_byte_seconds']:>17.2f}"
+            f"  ({level['requests_per_second'] / baseline:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Memory, latency and recall of the quantized vector store modes.
+
+Embeds the contexts of the retrieval goldens as the corpus, then checks how
+often each golden query finds its expected context in the top k. Random
+distractor vectors can be added to measure latency and memory at a more
+realistic corpus size. Run from the repo root, e.g.
+    PYTHONPATH=. python scripts/quantization_benchmark.py --distractors 200000
+"""
+
+import argparse
+import csv
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+from rag_studio.model_settings import DEFAULT_EMBEDDING_MODEL
+from rag_studio.vector_stores.numpy_store import DEFAULT_PERSIST_NAME, NumpyVectorStore
+from rag_studio.vector_stores.quantization import QUANTIZATION_MODES
+
+
+def read_goldens(path):
+    with open(path, "r", encoding="UTF-8") as f:
+        rows = list(csv.DictReader(f))
+    contexts = sorted({row["expected_context"] for row in rows})
+    context_ids = {context: f"context-{n}" for n, context in enumerate(contexts)}
+    queries = [(row["query"], context_ids[row["expected_context"]]) for row in rows]
+    return contexts, queries
+
+
+def build_store(persist_dir, vectors, ids, **kwargs):
+    """Persist and reload, so the full precision matrix is memory-mapped as it
+    would be in a running server."""
+    store = NumpyVectorStore(**kwargs)
+    for start in range(0, len(ids), 10000):
+        store.add(
+            [
+                TextNode(id_=ids[row], text="", embedding=vectors[row].tolist())
+                for row in range(start, min(start + 10000, len(ids)))
+            ]
+        )
+    store.persist(f"{persist_dir}/{DEFAULT_PERSIST_NAME}.json")
+    return NumpyVectorStore.from_persist_dir(persist_dir, **kwargs)
+
+
+def resident_bytes(store):
+    """What a query scans - the codes when quantized, otherwise the matrix."""
+    if store.quantization == "none":
+        return store._matrix.nbytes
+    store._sync_codes()
+    return store._codes.nbytes + (0 if store._scales is None else store._scales.nbytes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--goldens", default="data/sample_retrieval_goldens.csv")
+    parser.add_argument("--embedding-model", default=DEFAULT_EMBEDDING_MODEL)
+    parser.add_argument("--distractors", type=int, default=0)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    args = parser.parse_args()
+
+    contexts, queries = read_goldens(args.goldens)
+    embed_model = HuggingFaceEmbedding(model_name=args.embedding_model)
+    print(f"Embedding {len(contexts)} contexts and {len(queries)} queries")
+    context_vectors = np.asarray(
+        embed_model.get_text_embedding_batch(contexts), dtype=np.float32
+    )
+    query_vectors = [
+        embed_model.get_query_embedding(query) for query, _ in queries
+    ]
+    ids = [f"context-{n}" for n in range(len(contexts))]
+
+    rng = np.random.default_rng(0)
+    if args.distractors:
+        # Perturbed copies of the real contexts, so they sit in the same region
+        # of the embedding space rather than being trivially far away
+        base = context_vectors[rng.integers(len(contexts), size=args.distractors)]
+        noise = rng.standard_normal(base.shape).astype(np.float32)
+        distractors = base + 0.05 * noise * np.linalg.norm(base, axis=1, keepdims=True)
+        context_vectors = np.vstack([context_vectors, distractors])
+        ids += [f"distractor-{n}" for n in range(args.distractors)]
+
+    configs = [("none", False)] + [
+        (mode, rescore) for mode in QUANTIZATION_MODES[1:] for rescore in (False, True)
+    ]
+    print(f"{'mode':<10}{'rescore':<9}{'memory MB':>10}{'latency ms':>12}{f'recall@{args.top_k}':>11}")
+    for mode, rescore in configs:
+        persist_dir = tempfile.mkdtemp()
+        store = build_store(
+            persist_dir,
+            context_vectors,
+            ids,
+            quantization=mode,
+            rescore=rescore,
+            rescore_factor=args.rescore_factor,
+        )
+        memory_mb = resident_bytes(store) / 2**20
+        hits = 0
+        start = time.perf_counter()
+        for query_vector, (_, expected_id) in zip(query_vectors, queries):
+            result = store.query(
+                VectorStoreQuery(
+                    query_embedding=query_vector, similarity_top_k=args.top_k
+                )
+            )
+            hits += expected_id in result.ids
+        latency_ms = 1000 * (time.perf_counter() - start) / len(queries)
+        print(
+            f"{mode:<10}{str(rescore):<9}{memory_mb:>10.1f}{latency_ms:>12.2f}"
+            f"{hits / len(queries):>11.3f}"
+        )
+        shutil.rmtree(persist_dir)
+
+
+if __name__ == "__main__":
+    main()